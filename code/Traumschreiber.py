@@ -1,17 +1,409 @@
 import asyncio
+import json
 import logging
+import os
 import struct
+import threading
+import time
 import txdbus as dbus
 
 import numpy as np
 from twisted.internet import reactor, defer, task
 from txdbus import client as dbus_client
 
-def async_sleep(time):
+from metrics import StreamMetrics
+
+# set in threads that run a coroutine without the reactor, see run_blocking
+_blocking = threading.local()
+
+def async_sleep(seconds):
+    """ Deferred that fires after `seconds`. Under run_blocking (no reactor), it sleeps
+    and returns a fired Deferred instead. """
+    if getattr(_blocking, "enabled", False):
+        time.sleep(seconds)
+        return defer.succeed(None)
     d = defer.Deferred()
-    reactor.callLater(time, d.callback, None)
+    reactor.callLater(seconds, d.callback, None)
     return d
 
+def run_blocking(coroutine):
+    """ Run `coroutine` to completion in the calling thread (or process) without the reactor,
+    e.g. a stimulus presentation (see presenter.Presenter). It may only await async_sleep or
+    Deferreds that have already fired. Returns its result. """
+    _blocking.enabled = True
+    try:
+        coroutine.send(None)
+    except StopIteration as e:
+        return e.value
+    finally:
+        _blocking.enabled = False
+    coroutine.close()
+    raise RuntimeError("Coroutine awaited a Deferred that had not fired (it needs the reactor).")
+
+class SampleClock(object):
+    """ Assigns monotonic nanosecond timestamps (see time.monotonic_ns) to samples
+
+    Sample i is stamped a + b*i, where offset a and period b are fitted online to
+    the arrival times of the notifications (exponentially weighted linear
+    regression with a horizon of roughly `horizon` seconds). Starting from the
+    device's nominal sample rate, this corrects the drift between device and host
+    clock, while arrival jitter and reactor stalls (bunched notifications) only
+    slightly disturb the fit.
+
+    Arrivals can only lag behind the sampling, so a stall shows up as residuals
+    that shrink back to normal once the backlog is processed. If instead the
+    residual stays above `gap_tolerance` sample periods for `gap_time` seconds,
+    samples were lost on the way: the sample index is advanced by the missing
+    count (accumulated in `lost`), which keeps later timestamps correct.
+    """
+    def __init__(self, sample_rate=250, horizon=30, gap_tolerance=3, gap_time=0.5):
+        self.nominal_period = 1e9/sample_rate
+        self.forget = 1 - 1/(horizon*sample_rate)
+        self.gap_tolerance = gap_tolerance
+        self.gap_time = gap_time*1e9
+        # source of the arrival times (replaced by the simulator, which delivers packets in bursts)
+        self.now = time.monotonic_ns
+        self.reset()
+
+    def reset(self):
+        # index of the next sample & number of samples detected as lost
+        self.index = 0
+        self.lost = 0
+        self._t0 = None
+        self._last = None
+        # weighted regression sums of (sample index, arrival time since t0)
+        self._w = self._sx = self._sy = self._sxx = self._sxy = 0.0
+        self._elevated_since = None
+        self._elevated_min = 0.0
+        # lower envelope of the residuals, i.e. the smallest arrival latency relative to the fit
+        self._floor = 0.0
+
+    @property
+    def period(self):
+        """ Current estimate of the sample period (ns) """
+        return self._fit()[1]
+
+    def _fit(self):
+        if self._w == 0:
+            return 0.0, self.nominal_period
+        var = self._sxx - self._sx**2/self._w
+        # until the samples span a few periods, stick to the nominal rate
+        if var < self._w * 100:
+            b = self.nominal_period
+        else:
+            b = (self._sxy - self._sx*self._sy/self._w) / var
+        return (self._sy - b*self._sx)/self._w, b
+
+    def stamp(self, n, arrival=None, out=None):
+        """ Returns the int64 timestamps of the next `n` samples, which arrived at `arrival`
+        (default: now) """
+        if arrival is None:
+            arrival = self.now()
+        if self._t0 is None:
+            self._t0 = arrival
+        y = float(arrival - self._t0)
+        a, b = self._fit()
+
+        # residual of the newest sample: arrival latency relative to the fit
+        residual = y - (a + b*(self.index+n-1)) if self._w else 0.0
+        if residual - self._floor > self.gap_tolerance*b:
+            if self._elevated_since is None:
+                self._elevated_since, self._elevated_min = arrival, residual
+            else:
+                self._elevated_min = min(self._elevated_min, residual)
+                if arrival - self._elevated_since >= self.gap_time:
+                    missing = int(round((self._elevated_min - self._floor) / b))
+                    logging.warning("Detected {} lost samples".format(missing))
+                    self.index += missing
+                    self.lost += missing
+                    self._elevated_since = None
+        else:
+            self._elevated_since = None
+            # follow drops of the residual immediately, rises only slowly
+            self._floor = residual if residual < self._floor else self._floor + 0.01*(residual - self._floor)
+
+        # update the regression with the newest sample, unless it arrived late (stall or gap)
+        if self._elevated_since is None:
+            x = float(self.index+n-1)
+            f = self.forget**n
+            self._w = f*self._w + 1
+            self._sx = f*self._sx + x
+            self._sy = f*self._sy + y
+            self._sxx = f*self._sxx + x*x
+            self._sxy = f*self._sxy + x*y
+            a, b = self._fit()
+
+        if out is None:
+            out = np.empty(n, dtype=np.int64)
+        out[:] = self._t0 + a + b*np.arange(self.index, self.index+n)
+        # keep the timestamps strictly monotonic, even if the fit moves backwards
+        if self._last is not None and out[0] <= self._last:
+            np.maximum(out, self._last + 1 + np.arange(n), out=out)
+        self._last = out[n-1]
+        self.index += n
+        return out
+
+class BlockBuffer(object):
+    """ Collects raw biosignal notification payloads in a preallocated byte buffer
+
+    Every sample consists of 8 little-endian int16 values (16 bytes). Once
+    `block_size` samples are collected (or `flush` is called), `callback` is
+    called with an (N,8) int16 view on the buffer, which is reused afterwards.
+    If a SampleClock is given, the samples are stamped on arrival and `callback`
+    gets the (N,) int64 timestamps as second argument.
+    """
+    def __init__(self, callback, block_size=32, n_channels=8, clock=None):
+        self.callback = callback
+        self.block_size = block_size
+        self.clock = clock
+        self.sample_bytes = 2*n_channels
+        self._raw = np.zeros(block_size*self.sample_bytes, dtype=np.uint8)
+        self._samples = self._raw.view('<i2').reshape((block_size, n_channels))
+        self._timestamps = np.zeros(block_size, dtype=np.int64)
+        self._pos = 0
+
+    def push(self, value):
+        """ Copy the bytes of one notification into the buffer, handing on full blocks """
+        nbytes = len(value)
+        stamps = self.clock.stamp(nbytes // self.sample_bytes) if self.clock is not None else None
+        if self._pos + nbytes < len(self._raw):
+            # common case: the notification fits into the current block
+            if stamps is not None:
+                i = self._pos // self.sample_bytes
+                self._timestamps[i:i+len(stamps)] = stamps
+            self._raw[self._pos:self._pos+nbytes] = value
+            self._pos += nbytes
+            return
+
+        # notification fills the current block, split it
+        done = stamped = 0
+        while done < nbytes:
+            k = min(nbytes-done, len(self._raw)-self._pos)
+            complete = self._pos // self.sample_bytes
+            self._raw[self._pos:self._pos+k] = value[done:done+k]
+            self._pos += k
+            done += k
+            if stamps is not None:
+                new = min(self._pos // self.sample_bytes - complete, len(stamps) - stamped)
+                self._timestamps[complete:complete+new] = stamps[stamped:stamped+new]
+                stamped += new
+            if self._pos == len(self._raw):
+                self.flush()
+
+    def flush(self):
+        """ Hand the complete samples collected so far to the callback """
+        n = self._pos // self.sample_bytes
+        if n == 0:
+            return
+        rest = self._pos - n*self.sample_bytes
+        try:
+            if self.clock is not None:
+                self.callback(self._samples[:n], self._timestamps[:n])
+            else:
+                self.callback(self._samples[:n])
+        finally:
+            if rest:
+                self._raw[:rest] = self._raw[n*self.sample_bytes:self._pos]
+            self._pos = rest
+
+def _matches(object_interfaces, interface, props):
+    """ Whether an object (its {interface: {property: value}} dict) implements `interface`
+    with the given property values (None matches anything) """
+    if interface not in object_interfaces:
+        return False
+    for prop_name, prop_val in props.items():
+        if prop_val is not None and object_interfaces[interface].get(prop_name) != prop_val:
+            return False
+    return True
+
+class ObjectCache(object):
+    """ Local copy of the BlueZ object tree, kept up to date from DBus signals
+
+    The tree is fetched once with GetManagedObjects and then updated from the
+    manager's InterfacesAdded/InterfacesRemoved signals and the PropertiesChanged
+    signals of all BlueZ objects, so lookups do not need a round trip and code can
+    wait for an object or property to show up (`wait_for`) instead of polling.
+
+    `bus` and `manager` only need to provide the few txdbus methods used here
+    (addMatch, getRemoteObject; callRemote, notifyOnSignal), e.g. a mock.
+
+    Usage:
+
+        cache = ObjectCache(bus, manager)
+        await cache.start()
+        path = await cache.wait_for("org.bluez.Device1", timeout=10, Address=addr)
+    """
+    def __init__(self, bus, manager):
+        self.bus = bus
+        self.manager = manager
+        # object path -> {interface: {property: value}}
+        self.objects = {}
+        # [(condition, deferred)] of pending wait_for calls
+        self._waiters = []
+
+    async def start(self):
+        await self.manager.notifyOnSignal("InterfacesAdded", self._interfaces_added)
+        await self.manager.notifyOnSignal("InterfacesRemoved", self._interfaces_removed)
+        await self.bus.addMatch(self._properties_changed, mtype="signal", sender="org.bluez",
+                interface="org.freedesktop.DBus.Properties", member="PropertiesChanged")
+        objects = await self.manager.callRemote("GetManagedObjects")
+        for path, interfaces in objects.items():
+            self.objects.setdefault(path, {}).update({i: dict(p) for i, p in interfaces.items()})
+        self._update()
+        return self
+
+    def _interfaces_added(self, path, interfaces):
+        self.objects.setdefault(path, {}).update({i: dict(p) for i, p in interfaces.items()})
+        self._update()
+
+    def _interfaces_removed(self, path, interfaces):
+        object_interfaces = self.objects.get(path, {})
+        for interface in interfaces:
+            object_interfaces.pop(interface, None)
+        if not object_interfaces:
+            self.objects.pop(path, None)
+        self._update()
+
+    def _properties_changed(self, message):
+        interface, changed, invalidated = message.body[:3]
+        if interface == "org.bluez.GattCharacteristic1" and "Value" in changed:
+            # biosignals notifications, not worth keeping
+            return
+        props = self.objects.setdefault(message.path, {}).setdefault(interface, {})
+        props.update(changed)
+        for name in invalidated:
+            props.pop(name, None)
+        self._update()
+
+    def _update(self):
+        """ Fire the waiters whose condition is met now """
+        for waiter in list(self._waiters):
+            condition, d = waiter
+            result = condition()
+            if result is not None:
+                self._waiters.remove(waiter)
+                d.callback(result)
+
+    def find(self, interface, prefix=None, **props):
+        """ Path of the first object implementing `interface` with the given properties
+        (and a path starting with `prefix`), or None """
+        for path, object_interfaces in self.objects.items():
+            if (prefix is None or path.startswith(prefix)) and _matches(object_interfaces, interface, props):
+                return path
+        return None
+
+    def get(self, path, interface, name, default=None):
+        return self.objects.get(path, {}).get(interface, {}).get(name, default)
+
+    def wait_until(self, condition, timeout=None):
+        """ Deferred firing with the first non-None result of `condition()`, evaluated now and
+        after every change of the tree; fails with defer.TimeoutError after `timeout` seconds """
+        d = defer.Deferred()
+        result = condition()
+        if result is not None:
+            d.callback(result)
+            return d
+        waiter = (condition, d)
+        self._waiters.append(waiter)
+        def cancelled(failure):
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            return failure
+        d.addErrback(cancelled)
+        if timeout is not None:
+            d.addTimeout(timeout, reactor)
+        return d
+
+    def wait_for(self, interface, prefix=None, timeout=None, **props):
+        """ Deferred firing with the path of the object matching `find(interface, prefix, **props)`,
+        as soon as there is one """
+        return self.wait_until(lambda: self.find(interface, prefix, **props), timeout)
+
+    async def get_object(self, path, interface):
+        """ The remote object at `path` & its properties object (like Traumschreiber._find_object) """
+        obj = await self.bus.getRemoteObject("org.bluez", path, interface)
+        obj_props = await self.bus.getRemoteObject("org.bluez", path, "org.freedesktop.DBus.Properties")
+        return obj, obj_props
+
+class CommandQueue(object):
+    """ Coalescing, acknowledged writes to the device's config characteristic
+
+    Every value written is the complete device state (LEDs, color, gain, misc),
+    so only the newest pending value needs to be written: updates submitted
+    while a write is in flight (or while waiting for the rate limit of one write
+    per `min_interval` seconds) are merged into the next single write. `submit`
+    returns a Deferred that fires once a write containing the value has been
+    acknowledged, or fails after `retries` retries. The latency of a command is
+    thus bounded by about two writes plus `min_interval`. `writes` counts the
+    acknowledged writes, `failures` the failed attempts.
+
+    `write(value)` has to return a Deferred (e.g. a txdbus callRemote).
+    """
+    def __init__(self, write, min_interval=0.02, retries=3, retry_delay=0.05):
+        self.write = write
+        self.min_interval = min_interval
+        self.retries = retries
+        self.retry_delay = retry_delay
+        # newest value not written yet & the deferreds waiting for it
+        self._value = None
+        self._waiters = []
+        self._running = False
+        self._last_write = 0.0
+        self.writes = 0
+        self.coalesced = 0
+        self.failures = 0
+
+    def submit(self, value):
+        if self._value is not None:
+            self.coalesced += 1
+        self._value = value
+        d = defer.Deferred()
+        self._waiters.append(d)
+        if not self._running:
+            defer.ensureDeferred(self._run()).addErrback(
+                    lambda failure: logging.error("Command queue failed: {!r}".format(failure.value)))
+        return d
+
+    async def _run(self):
+        self._running = True
+        waiters = []
+        try:
+            while self._value is not None:
+                wait = self._last_write + self.min_interval - time.monotonic()
+                if wait > 0:
+                    # more updates can be merged in the meantime
+                    await async_sleep(wait)
+                value, waiters = self._value, self._waiters
+                self._value, self._waiters = None, []
+
+                for attempt in range(self.retries+1):
+                    try:
+                        await self.write(value)
+                    except Exception as e:
+                        self.failures += 1
+                        logging.warning("Writing {} failed ({}/{}): {}".format(value, attempt+1, self.retries+1, e))
+                        error = e
+                        await async_sleep(self.retry_delay)
+                    else:
+                        error = None
+                        self.writes += 1
+                        break
+                self._last_write = time.monotonic()
+                waiters, done = [], waiters
+                for d in done:
+                    if error is None:
+                        d.callback(value)
+                    else:
+                        d.errback(error)
+        finally:
+            self._running = False
+            # an unexpected error must not leave the submitters waiting
+            pending = waiters + self._waiters
+            self._value, self._waiters = None, []
+            for d in pending:
+                if not d.called:
+                    d.errback(Exception("Command queue stopped before the write was acknowledged."))
+
 class Traumschreiber(object):
     """ Traumschreiber EEG asynchronous context manager
 
@@ -34,19 +426,47 @@ class Traumschreiber(object):
     BIOSIGNALS_UUID = "faa7b588-19e5-f590-0545-c99f193c5c3e"
     LEDS_UUID = "fcbea85a-4d87-18a2-2141-0d8d2437c0a4"
 
-    def __init__(self, addr=None, scan=10):
+    CACHE_FILE = os.path.expanduser("~/.traumschreiber.json")
+    # fast connect: Connect calls per (re)connection & the pause between them (s)
+    CONNECT_ATTEMPTS = 3
+    CONNECT_RETRY_DELAY = 1
+
+    def __init__(self, addr=None, scan=10, sample_rate=250, fast_connect=False, timeout=10, cache_file=CACHE_FILE):
         """ Scan for a given period (scan) and attempt to open a connection to the
-        Traumschreiber device with given Bluetooth-device address (addr)
+        Traumschreiber device with given Bluetooth-device address (addr).
+        The nominal sample rate (sample_rate) is used for timestamping samples.
+
+        With `fast_connect`, the BlueZ object tree is cached (see ObjectCache) and
+        each step waits for the objects/properties it needs (up to `timeout` seconds)
+        instead of sleeping; discovery only runs (for up to `scan` seconds) if the
+        device is not known to BlueZ yet. The device's object path is remembered in
+        `cache_file` between sessions. Connect is retried up to CONNECT_ATTEMPTS times.
         """
         self.addr=addr
         self.scan=scan
+        self.sample_rate=sample_rate
+        self.fast_connect=fast_connect
+        self.timeout=timeout
+        self.cache_file=cache_file
+        self.objects = None
+        self.clock = None
         self.a_on = 0
         self.b_on = 0
         self.color= (0,0,0)
         self.gain = 1
         self.misc= 0
+        self._notifier = None
+        self._wrapped_callback = None
+        self.metrics = None
+        # writes to the config characteristic, see set
+        self.commands = CommandQueue(lambda value: self.cfg_char.callRemote("WriteValue", value, {}))
+        self._block_buffer = None
+        self._flush_loop = None
 
     async def __aenter__(self):
+        if self.fast_connect:
+            return await self._fast_connect()
+
         logging.info("Connecting...")
         self.bus = await dbus_client.connect(reactor, "system")
         self.manager = await self.bus.getRemoteObject("org.bluez","/",
@@ -133,22 +553,177 @@ class Traumschreiber(object):
             raise Exception("Failed to find characteristic.")
 
         # set leds to ensure alignment of the command
-        for i in range(7):
-            await self.set()
+        await self.set()
         return self
 
-    async def start_listening(self, callback):
-        """ Call this function to start listening to data packages from the device """
-        logging.info("Start listening...")
-        def wrapped_callback(_1, data ,_2):
+    def _cached_device_path(self):
+        try:
+            with open(self.cache_file) as f:
+                return json.load(f).get(self.addr)
+        except (OSError, ValueError):
+            return None
+
+    def _cache_device_path(self, path):
+        try:
             try:
-                if "Value" in data:
-                    np_data = np.frombuffer(np.array(data["Value"], dtype=np.int8), dtype=np.dtype('<i2')).reshape((1,8))
-                    callback(np_data)
-            except Exception as e:
-                logging.warning("Encountered exception in data callback method: {}".format(e))
+                with open(self.cache_file) as f:
+                    paths = json.load(f)
+            except (OSError, ValueError):
+                paths = {}
+            paths[self.addr] = path
+            with open(self.cache_file, "w") as f:
+                json.dump(paths, f)
+        except OSError as e:
+            logging.warning("Could not cache the device path: {}".format(e))
+
+    async def _fast_connect(self, bus=None, manager=None):
+        """ Connect using a cached object tree & signal-driven waits (see `fast_connect`) """
+        logging.info("Connecting (fast)...")
+        self.bus = bus or await dbus_client.connect(reactor, "system")
+        self.manager = manager or await self.bus.getRemoteObject("org.bluez","/",
+                "org.freedesktop.DBus.ObjectManager")
+        if self.objects is None:
+            self.objects = await ObjectCache(self.bus, self.manager).start()
+        objects = self.objects
+
+        adapter_path = objects.find("org.bluez.Adapter1")
+        if adapter_path is None:
+            raise Exception("No matching object detected with interface org.bluez.Adapter1")
+        self.adapter, _ = await objects.get_object(adapter_path, "org.bluez.Adapter1")
+
+        # a device path from a previous session saves the discovery, if BlueZ still knows it
+        device_path = self._cached_device_path()
+        if device_path is None or not _matches(objects.objects.get(device_path, {}), "org.bluez.Device1", {"Address": self.addr}):
+            device_path = objects.find("org.bluez.Device1", Name="traumschreiber", Address=self.addr)
+        if device_path is None:
+            logging.info("Start scanning...")
+            await self.adapter.callRemote("StartDiscovery")
+            try:
+                device_path = await objects.wait_for("org.bluez.Device1", timeout=self.scan or self.timeout,
+                        Name="traumschreiber", Address=self.addr)
+            finally:
+                await self.adapter.callRemote("StopDiscovery")
+            logging.info("Done scanning.")
+        logging.info("Matched {}".format(device_path))
+        self.device, self.device_props = await objects.get_object(device_path, "org.bluez.Device1")
+        await self._connect_device(device_path)
+        self._cache_device_path(device_path)
+
+        # set leds to ensure alignment of the command
+        await self.set()
+        return self
 
-        self._notifier = await self.biosignals_char_props.notifyOnSignal("PropertiesChanged", wrapped_callback)
+    async def _connect_device(self, device_path):
+        """ Connect to the device and look up the characteristics once its services are resolved """
+        objects = self.objects
+        connected = lambda: True if objects.get(device_path, "org.bluez.Device1", "Connected") else None
+        # BlueZ often aborts the first LE connection attempt, so retry a few times
+        for attempt in range(self.CONNECT_ATTEMPTS):
+            if connected():
+                break
+            try:
+                logging.info("Connecting...")
+                await self.device.callRemote("Connect")
+                await objects.wait_until(connected, timeout=self.timeout)
+            except Exception as e:
+                logging.warning("Connection failed with error {} ({}/{})".format(e, attempt+1, self.CONNECT_ATTEMPTS))
+                if attempt+1 == self.CONNECT_ATTEMPTS:
+                    raise
+                await async_sleep(self.CONNECT_RETRY_DELAY)
+        await objects.wait_until(lambda: True if objects.get(device_path, "org.bluez.Device1", "ServicesResolved") else None,
+                timeout=self.timeout)
+        logging.info("Device connected.")
+
+        char_path = await objects.wait_for("org.bluez.GattCharacteristic1", prefix=device_path,
+                timeout=self.timeout, UUID=self.BIOSIGNALS_UUID)
+        self.biosignals_char, self.biosignals_char_props = await objects.get_object(char_path, "org.bluez.GattCharacteristic1")
+        char_path = await objects.wait_for("org.bluez.GattCharacteristic1", prefix=device_path,
+                timeout=self.timeout, UUID=self.LEDS_UUID)
+        self.cfg_char, self.leds_char_props = await objects.get_object(char_path, "org.bluez.GattCharacteristic1")
+
+    async def reconnect(self):
+        """ Reconnect after the connection dropped (requires `fast_connect`) & resume listening """
+        assert self.objects is not None, "reconnect requires fast_connect"
+        listening = self._notifier is not None
+        if listening:
+            self.biosignals_char_props.cancelSignalNotification(self._notifier)
+            self._notifier = None
+        await self._connect_device(self.device.objectPath)
+        if listening:
+            self._notifier = await self.biosignals_char_props.notifyOnSignal("PropertiesChanged", self._wrapped_callback)
+            await self.biosignals_char.callRemote("StartNotify")
+        await self.set()
+
+    def _notification_callback(self, callback, block_size=None, block_interval=None, timestamps=False):
+        """ Set up the clock & block buffer for `start_listening` and return the function that
+        handles a PropertiesChanged notification of the biosignals characteristic """
+        self._block_buffer = None
+        self._flush_loop = None
+        self.clock = SampleClock(self.sample_rate) if timestamps else None
+        clock = self.clock
+        # every packet is counted & timed, see StreamMetrics
+        self.metrics = StreamMetrics(clock)
+        record, error = self.metrics.record, self.metrics.error
+        monotonic_ns = time.monotonic_ns
+        if block_size:
+            self._block_buffer = BlockBuffer(callback, block_size, clock=clock)
+            if block_interval:
+                self._flush_loop = task.LoopingCall(self._block_buffer.flush)
+                self._flush_loop.start(block_interval, now=False)
+
+            push = self._block_buffer.push
+            sample_bytes = self._block_buffer.sample_bytes
+            def wrapped_callback(_1, data ,_2):
+                arrival = monotonic_ns()
+                try:
+                    if "Value" in data:
+                        value = data["Value"]
+                        push(value)
+                        record(len(value) // sample_bytes, arrival, monotonic_ns() - arrival)
+                except Exception as e:
+                    error(e)
+        else:
+            def wrapped_callback(_1, data ,_2):
+                arrival = monotonic_ns()
+                try:
+                    if "Value" in data:
+                        np_data = np.frombuffer(np.array(data["Value"], dtype=np.uint8), dtype=np.dtype('<i2')).reshape((1,8))
+                        if clock is not None:
+                            callback(np_data, clock.stamp(1))
+                        else:
+                            callback(np_data)
+                        record(1, arrival, monotonic_ns() - arrival)
+                except Exception as e:
+                    error(e)
+        return wrapped_callback
+
+    def _stop_blocks(self):
+        """ Stop the periodic flushing (& metrics reports) and hand on the samples still buffered """
+        if self.metrics is not None:
+            self.metrics.stop_reporting()
+        if self._flush_loop is not None and self._flush_loop.running:
+            self._flush_loop.stop()
+        if self._block_buffer is not None:
+            self._block_buffer.flush()
+
+    async def start_listening(self, callback, block_size=None, block_interval=None, timestamps=False):
+        """ Call this function to start listening to data packages from the device
+
+        By default, `callback` is called with a (1,8) int16 array for every sample. If `block_size`
+        is given, the raw notification bytes are collected in a preallocated buffer instead and
+        `callback` is called with (N,8) int16 blocks of (up to) `block_size` samples, at least every
+        `block_interval` seconds if that is given. The block is a view on the reused buffer, so
+        consumers have to copy it if they need it after returning.
+
+        If `timestamps` is set, `callback` additionally gets the (N,) int64 monotonic timestamps (ns)
+        of the samples, see SampleClock; the clock is available as `self.clock`.
+
+        Packet rate, lost samples, jitter & callback times are collected in `self.metrics`
+        (see StreamMetrics).
+        """
+        logging.info("Start listening...")
+        self._wrapped_callback = self._notification_callback(callback, block_size, block_interval, timestamps)
+        self._notifier = await self.biosignals_char_props.notifyOnSignal("PropertiesChanged", self._wrapped_callback)
         await self.biosignals_char.callRemote("StartNotify")
 
     async def stop_listening(self):
@@ -157,6 +732,7 @@ class Traumschreiber(object):
             logging.info("Stop listening...")
             self.biosignals_char_props.cancelSignalNotification(self._notifier)
             await self.biosignals_char.callRemote("StopNotify")
+            self._stop_blocks()
 
     async def disconnect_unpair_forget(self, disconnect=True, unpair=True, forget=True):
         """ Disconnect and unpair the device (duh) """
@@ -178,9 +754,9 @@ class Traumschreiber(object):
                 logging.info(e)
 
     async def __aexit__(self, *args):
-        self.stop_listening()
+        await self.stop_listening()
         logging.info("Disconnecting...")
-        await self.disconnect_unpair_forget(self, unpair=False, forget=False)
+        await self.disconnect_unpair_forget(unpair=False, forget=False)
 
     async def _get(self, obj, prop):
         return await obj.callRemote("Get", "org.freedesktop.DBus.Properties", prop)
@@ -207,29 +783,31 @@ class Traumschreiber(object):
         else:
             raise Exception("No matching object detected with interface {}{}".format(interface, "" if len(props)==0 else " (with properties: {})".format(props)))
 
+    def _config_value(self, a_on=None, b_on=None, color=None, gain=None, misc=None):
+        """ Update the device properties and return the value to write to the LEDs characteristic """
+        if not a_on is None:
+            self.a_on = a_on
+        if not b_on is None:
+            self.b_on = b_on
+        if not color is None:
+            self.color = color
+        if not gain is None:
+            assert gain in [0.5]+[2**i for i in range(7)], "Gain must be one of the following: 0.5x, 1x, 2x, 4x, 8x, 16x, 32x, 64x (got {})".format(gain)
+            self.gain = 0b111 if gain < 1 else {1:0b000, 2:0b001, 4:0b010, 8:0b011, 16:0b100, 32:0b101,64:0b110}[gain]
+        if not misc is None:
+            self.misc = misc
+        return [self.a_on<<1|self.b_on, self.color[0], self.color[1], self.color[2], self.gain, self.misc]
+
     async def set(self, a_on=None, b_on=None, color=None, gain=None, misc=None):
         """ Set Traumschreiber device properties.
 
+        Returns once the new state has been written to the device. Calls in quick succession
+        are merged into a single write (see CommandQueue); raises if the write keeps failing.
+
         Args:
             a_on (0 or 1):  turns LED 'a' on (1) or off (0), default: no change
             b_on (0 or 1):  turns LED 'b' on (1) or off (0), default: no change
             color:          sets the color of both LEDs to an RGB tuple of ints (0,0,0) < (r,g,b) < (255,255,255)
             gain:           sets the gain of the Traumschreiber device's amplifier (½x,1x,2x,4x,8x,16x,32x,64x)
         """
-        try:
-            if not a_on is None:
-                self.a_on = a_on
-            if not b_on is None:
-                self.b_on = b_on
-            if not color is None:
-                self.color = color
-            if not gain is None:
-                assert gain in [0.5]+[2**i for i in range(7)], "Gain must be one of the following: 0.5x, 1x, 2x, 4x, 8x, 16x, 32x, 64x (got {})".format(gain)
-                self.gain = 0b111 if gain < 1 else {1:0b000, 2:0b001, 4:0b010, 8:0b011, 16:0b100, 32:0b101,64:0b110}[gain]
-            if not misc is None:
-                self.misc = misc
-
-            val = [self.a_on<<1|self.b_on, self.color[0], self.color[1], self.color[2], self.gain, self.misc]
-            self.cfg_char.callRemote("WriteValue", val, {})
-        except Exception as e:
-            logging.error("Raised exception {} in set method.".format(e))
+        await self.commands.submit(self._config_value(a_on, b_on, color, gain, misc))
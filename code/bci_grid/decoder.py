@@ -0,0 +1,171 @@
+import numpy as np
+
+from epochs import OnlineEpocher, onset_indices, epoch, baseline_correct
+from recording import read_recording
+
+
+def _logsumexp(x):
+    m = x.max()
+    return m + np.log(np.exp(x - m).sum())
+
+
+class SpellerDecoder(object):
+    """ Bayesian evidence accumulation for the P300 speller
+
+    Each flash epoch is reduced to features (channel-wise means over `decimate`
+    samples) and scored by a linear classifier. The classifier scores of target
+    and non-target flashes are modelled as Gaussians (means `mu`, shared
+    `sigma`), so every score adds its log-likelihood ratio to the log-posterior
+    of all symbols in the flashed row/column. Once the posterior of one symbol
+    reaches `threshold`, the decoder has `decided`.
+
+    Usage:
+
+        decoder = SpellerDecoder.fit(epochs, is_target)     # (n, channels, times) training epochs
+        decoder.reset()
+        decoder.update(epoch, flashed)                      # flashed: (rows, cols) bool mask
+        if decoder.decided: print(decoder.prediction)
+    """
+    def __init__(self, weights, bias=0.0, mu=(0.0, 1.0), sigma=1.0, decimate=10, grid_shape=(5,6), threshold=0.95, min_flashes=0):
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.bias = float(bias)
+        self.mu = (float(mu[0]), float(mu[1]))
+        self.sigma = float(sigma)
+        self.decimate = decimate
+        self.grid_shape = grid_shape
+        self.threshold = threshold
+        self.min_flashes = min_flashes
+        self.log_posterior = np.zeros(grid_shape)
+        self.reset()
+
+    def reset(self):
+        """ Start a new symbol: uniform prior """
+        self.log_posterior[...] = -np.log(self.log_posterior.size)
+        self.n_flashes = 0
+
+    def features(self, epochs):
+        """ (..., n_channels, n_times) epochs -> (..., n_features) decimated features """
+        epochs = np.asarray(epochs)
+        n_bins = epochs.shape[-1] // self.decimate
+        binned = epochs[..., :n_bins*self.decimate].reshape(epochs.shape[:-1] + (n_bins, self.decimate))
+        return binned.mean(axis=-1).reshape(epochs.shape[:-2] + (-1,))
+
+    def score(self, epochs):
+        return self.features(epochs) @ self.weights + self.bias
+
+    def add_flash(self, flashed, score):
+        """ Add the evidence of one flash with classifier `score` on the symbols in the `flashed` mask """
+        mu0, mu1 = self.mu
+        llr = ((score - mu0)**2 - (score - mu1)**2) / (2*self.sigma**2)
+        self.log_posterior[flashed] += llr
+        self.log_posterior -= _logsumexp(self.log_posterior)
+        self.n_flashes += 1
+
+    def update(self, epoch, flashed):
+        self.add_flash(flashed, self.score(epoch))
+
+    @property
+    def posterior(self):
+        return np.exp(self.log_posterior)
+
+    @property
+    def prediction(self):
+        """ Grid coordinates (row, col) of the currently most likely symbol """
+        return np.unravel_index(np.argmax(self.log_posterior), self.grid_shape)
+
+    @property
+    def decided(self):
+        return self.n_flashes >= self.min_flashes and self.log_posterior.max() >= np.log(self.threshold)
+
+    @classmethod
+    def fit(cls, epochs, is_target, shrinkage=0.1, **kwargs):
+        """ Train a shrinkage LDA on (n, n_channels, n_times) epochs with boolean target labels
+        and estimate the score distributions of targets & non-targets """
+        decoder = cls(np.zeros(1), **kwargs)
+        x = decoder.features(epochs)
+        is_target = np.asarray(is_target, dtype=bool)
+        m1, m0 = x[is_target].mean(axis=0), x[~is_target].mean(axis=0)
+        centered = np.vstack((x[is_target] - m1, x[~is_target] - m0))
+        cov = centered.T @ centered / max(len(x) - 2, 1)
+        cov = (1-shrinkage)*cov + shrinkage*np.trace(cov)/len(cov)*np.eye(len(cov))
+        decoder.weights = np.linalg.solve(cov, m1 - m0)
+        decoder.bias = -decoder.weights @ (m0 + m1) / 2
+
+        scores = x @ decoder.weights + decoder.bias
+        decoder.mu = (float(scores[~is_target].mean()), float(scores[is_target].mean()))
+        residuals = np.hstack((scores[~is_target] - decoder.mu[0], scores[is_target] - decoder.mu[1]))
+        decoder.sigma = float(residuals.std())
+        return decoder
+
+    def save(self, path):
+        np.savez(path, weights=self.weights, bias=self.bias, mu=self.mu, sigma=self.sigma,
+                decimate=self.decimate, grid_shape=self.grid_shape)
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        f = np.load(path)
+        return cls(f["weights"], float(f["bias"]), tuple(f["mu"]), float(f["sigma"]),
+                int(f["decimate"]), tuple(f["grid_shape"]), **kwargs)
+
+
+class OnlineSpeller(object):
+    """ Scores flashes as soon as their epoch is complete, for early stopping in the experiment
+
+    The data callback feeds the (rereferenced) sample stream into `write`, the
+    experiment reports each flash onset with `add_flash` and checks `decided`
+    after every flash. Epochs with a peak-to-peak amplitude above `reject_threshold`
+    (see epochs.reject) are not scored.
+    """
+    def __init__(self, decoder, n_channels=9, n_times=200, offset=-25, reject_threshold=None):
+        self.decoder = decoder
+        rows, cols = decoder.grid_shape
+        # one condition per row & column flash: 0..rows-1 are rows, rows.. are columns
+        self._masks = np.zeros((rows+cols, rows, cols), dtype=bool)
+        for r in range(rows):
+            self._masks[r, r, :] = True
+        for c in range(cols):
+            self._masks[rows+c, :, c] = True
+        self.epocher = OnlineEpocher(n_channels, n_times, offset, n_conditions=rows+cols,
+                threshold=reject_threshold, callback=self._score)
+
+    def _score(self, epoch, condition, timestamp):
+        self.decoder.update(epoch, self._masks[condition])
+
+    def write(self, block, timestamps):
+        self.epocher.write(block, timestamps)
+
+    def add_flash(self, timestamp, rowcol, num):
+        self.epocher.add_event(timestamp, num if rowcol == "row" else self.decoder.grid_shape[0] + num)
+
+    def reset(self):
+        # flashes of the previous symbol that are still pending are dropped
+        self.epocher.clear_pending()
+        self.decoder.reset()
+
+    @property
+    def grid_shape(self):
+        return self.decoder.grid_shape
+
+    @property
+    def decided(self):
+        return self.decoder.decided
+
+    @property
+    def prediction(self):
+        return self.decoder.prediction
+
+    @property
+    def n_flashes(self):
+        return self.decoder.n_flashes
+
+
+def fit_recording(recording_path, events_path, n_times=200, offset=-25, grid_shape=(5,6), **kwargs):
+    """ Fit a SpellerDecoder on a training session recorded by bci_grid/train.py """
+    recording, events = read_recording(recording_path), read_recording(events_path)
+    onsets = events.records[(events["kind"] == 1) & (events["target"] >= 0)]
+    epochs, valid = epoch(recording.channels, onset_indices(recording.timestamps, onsets["timestamp"]), n_times, offset)
+    epochs = baseline_correct(epochs, (0, -offset) if offset < 0 else None)
+    onsets = onsets[valid]
+    target_row, target_col = np.unravel_index(onsets["target"], grid_shape)
+    is_target = (onsets["row"] == target_row) | (onsets["col"] == target_col)
+    return SpellerDecoder.fit(epochs, is_target, grid_shape=grid_shape, **kwargs)
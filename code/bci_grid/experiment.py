@@ -1,5 +1,6 @@
-from utils import *
 from Traumschreiber import *
+from utils import *
+from recording import dense_labels
 from twisted.internet import reactor, defer, task
 import itertools
 import random
@@ -8,6 +9,25 @@ import random
 # This module-level variable (buh!) keeps track of the current state of the experiment
 state = {"interval": 0}
 
+# Fields of the stimulus events logged by the experiment (see recording.EventLog):
+# kind is 1 for flash onsets, 0 for offsets; row/col is the flashed row/column or -1
+EVENT_FIELDS = {
+    "kind": (np.int8, ()),
+    "row": (np.int8, ()),
+    "col": (np.int8, ()),
+    "target": (np.int8, ()),
+    "interval": (np.int32, ())}
+
+def dense_highlighted(events, timestamps, grid_shape=(5,6)):
+    """ Rebuild the (N, rows, cols) highlight masks of samples with the given timestamps
+    from the logged events (an EventLog, or the records of a recording.read_recording file) """
+    kind = dense_labels(events["timestamp"], events["kind"], timestamps, 0)
+    row = dense_labels(events["timestamp"], events["row"], timestamps, -1)
+    col = dense_labels(events["timestamp"], events["col"], timestamps, -1)
+    on = (kind == 1)[:,None,None]
+    return on & ((row[:,None,None] == np.arange(grid_shape[0])[None,:,None])
+               | (col[:,None,None] == np.arange(grid_shape[1])[None,None,:]))
+
 def char2idx(char, grid_shape):
     """ Finds a symbol in the symbol list and converts its position to grid coordinates"""
     symbols = "ABCDEFGHIJKLMNOPQRSTUVWXYZ !?."
@@ -17,7 +37,7 @@ def char2idx(char, grid_shape):
 
 
 # This is an asynchroneous co-routine for running the experiment itself
-async def experiment(targets=None, max_runs=None, repetitions=12, flash_time=0.125):
+async def experiment(targets=None, max_runs=None, repetitions=12, flash_time=0.125, events=None, decoder=None):
     """ BCI - EEG decoding - Grid stimulus (COROUTINE)
 
     A grid of symbols is shown on screen, rows and columns of which are randomly
@@ -30,10 +50,21 @@ async def experiment(targets=None, max_runs=None, repetitions=12, flash_time=0.1
         repetitions (int):  Number of repetitions to use per symbol. Defaults to 1 (no additional repetitions).
                             For each repetition, each column and row of the grid will be highlighted exactly once.
         flash_time (float): Time in seconds of each flashing each row/column. Defaults to 0,4s.
+                            Rounded to whole display frames.
+        events (EventLog):  Log to record flash onsets/offsets to (fields: EVENT_FIELDS), keyed
+                            by flip timestamp. Defaults to no logging.
+        decoder (OnlineSpeller): Online decoder that is told about every flash (see bci_grid.decoder).
+                            Repetitions of a symbol stop as soon as it has `decided`; its
+                            `prediction` is stored in state["prediction"]. Defaults to no decoding.
+
+    Returns:
+        dict: flip timing statistics of the run (see FrameClock.stats)
     """
     global state
 
     width,height = boilerplate()
+    clock = FrameClock()
+    clock.calibrate()
 
     # Create 5x6 grid of symbols
     grid_shape = (5,6)
@@ -52,7 +83,6 @@ async def experiment(targets=None, max_runs=None, repetitions=12, flash_time=0.1
         if draw_grid:
             g.draw()
         glFlush()
-        pygame.display.flip()
 
     # Little helper function to poll & parse the events triggered
     def poll_events():
@@ -71,12 +101,17 @@ async def experiment(targets=None, max_runs=None, repetitions=12, flash_time=0.1
 
         # Reset highlights and clear screen before each trial
         flashed=g.flash([],[])
-        render(False)
+        if decoder is not None:
+            decoder.reset()
 
         # right now, there is neither a stimulus nor targets
-        state["highlighted"] = flashed
-        state["target"] = None
-        await async_sleep(2)
+        def clear(t):
+            state["highlighted"] = flashed
+            state["target"] = None
+            state["flip_time"] = t
+            if events is not None:
+                events.append(t, kind=0, row=-1, col=-1, target=-1, interval=state["interval"])
+        await clock.present(lambda: render(False), clock.frames(2), onset=clear)
 
         # Set symbol to focus, if any
         if target is not None:
@@ -85,13 +120,11 @@ async def experiment(targets=None, max_runs=None, repetitions=12, flash_time=0.1
             # Flash the symbol to focus on a couple of times
             for i in range(10):
                 # draw grid w/ marked symbol but w/o any highlights
-                g.symbols[char_idx2d[0], char_idx2d[1]].color=np.array([1.0,0.0,0.0,1.0])
-                render()
-                await async_sleep(0.1)
+                g.colors[char_idx2d[0], char_idx2d[1]] = (1.0,0.0,0.0,1.0)
+                await clock.present(render, clock.frames(0.1))
                 # draw plain grid
-                g.symbols[char_idx2d[0], char_idx2d[1]].color=np.array([1.0,1.0,1.0,0.25])
-                render()
-                await async_sleep(0.1)
+                g.colors[char_idx2d[0], char_idx2d[1]] = (1.0,1.0,1.0,0.25)
+                await clock.present(render, clock.frames(0.1))
 
         # start repetitions
         repeat = repetitions
@@ -99,47 +132,66 @@ async def experiment(targets=None, max_runs=None, repetitions=12, flash_time=0.1
             # If it's currently paused, poll for events
             if pause:
                 # Poll event queue
-                events = poll_events()
-                if "QUIT" in events:
-                    return
-                if "PAUSE" in events:
+                pressed = poll_events()
+                if "QUIT" in pressed:
+                    return clock.stats()
+                if "PAUSE" in pressed:
                     pause = False
+                    clock.interrupt()
                     await async_sleep(1)
                     continue
 
             random.shuffle(combinations)
             for rowcol,num in combinations:
                 # Poll event queue
-                events = poll_events()
-                if "QUIT" in events:
-                    return
-                if "PAUSE" in events:
+                pressed = poll_events()
+                if "QUIT" in pressed:
+                    return clock.stats()
+                if "PAUSE" in pressed:
                     pause = True
                     break
 
                 # Flash appropriate symbols
                 flashed = g.flash(rows=num) if rowcol=="row" else g.flash(cols=num)
-                # draw the grid
-                render()
-
-                # record the current interval, stimulus and target
-                state["highlighted"] = flashed
-                state["target"] = None if not target else char_idx
-                state["interval"] += 1
 
-                # sleep a while
-                await async_sleep(flash_time)
+                # record the current interval, stimulus and target as soon as it is on screen
+                def flash_on(t):
+                    state["highlighted"] = flashed
+                    state["target"] = None if not target else char_idx
+                    state["interval"] += 1
+                    state["flip_time"] = t
+                    if events is not None:
+                        events.append(t, kind=1, row=num if rowcol=="row" else -1, col=num if rowcol=="col" else -1,
+                                target=-1 if not target else char_idx, interval=state["interval"])
+                    if decoder is not None:
+                        decoder.add_flash(t, rowcol, num)
+                await clock.present(render, clock.frames(flash_time), onset=flash_on)
 
                 # Stop flashing
-                flashed = g.flash(rows=[], cols=[])
-                # draw the grid
-                render()
-
-                # sleep a while
-                await async_sleep(flash_time/2)
+                cleared = g.flash(rows=[], cols=[])
+                def flash_off(t):
+                    state["highlighted"] = cleared
+                    state["flip_time"] = t
+                    if events is not None:
+                        events.append(t, kind=0, row=-1, col=-1,
+                                target=-1 if not target else char_idx, interval=state["interval"])
+                await clock.present(render, clock.frames(flash_time/2), onset=flash_off)
+
+                # dynamic stopping: no more flashes once the decoder is confident
+                if decoder is not None and decoder.decided:
+                    repeat = 0
+                    break
 
             else:
                 repeat-=1
 
+        if decoder is not None:
+            state["prediction"] = decoder.prediction
+            logging.info("Predicted symbol {} after {} flashes (target: {})".format(
+                decoder.prediction, decoder.n_flashes, target))
+
     # The experiment is done!
+    stats = clock.stats()
+    logging.info("Frame timing: {}".format(stats))
     pygame.quit()
+    return stats
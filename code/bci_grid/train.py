@@ -1,28 +1,23 @@
 import itertools
 import random
-import datetime
-import pandas
 
-from .experiment import state, experiment
+from .experiment import state, experiment, EVENT_FIELDS
 from Traumschreiber import *
+from simulator import SimulatedTraumschreiber
 from twisted.internet import reactor, defer, task
 #from twisted.enterprise import adbapi
 from utils import *
+from recording import RecordingWriter, EventLog
+from presenter import Presenter
+from .decoder import SpellerDecoder, OnlineSpeller
 
 
 db_ready = False
 dbpool = None
 
-#3600s*250 = 900000 samples
-MAX_SAMPLES = 100000
-
 # reference channel
 REF_CHANNEL = 7
 
-data_store = []
-data_idx = 0
-# rData_in = np.zeros((1,9), dtype='<i2')
-
 ########################################
 # ID of the traumschreiber you are using
 ID = 3
@@ -31,36 +26,58 @@ GAIN = 32
 
 TRAUMSCHREIBER_ADDR = "74:72:61:75:6D:{:02x}".format(ID)
 
-def data_callback(data_in):
-    global data_idx
+# use a simulated device (synthetic EEG, see simulator.SimulatedTraumschreiber) instead of the Traumschreiber
+SIMULATE = False
+Device = SimulatedTraumschreiber if SIMULATE else Traumschreiber
+
+# samples are delivered in blocks of up to BLOCK_SIZE samples, at least every BLOCK_INTERVAL seconds
+BLOCK_SIZE = 32
+BLOCK_INTERVAL = 0.1
+
+# present the stimuli in a separate "process" or "thread" (see presenter.Presenter), so display
+# flips do not delay the samples; None: on the reactor, which then blocks in every flip (vsync)
+PRESENTER = "thread"
 
-    inrow =  np.hstack((datetime.datetime.now(), reref_channels(data_in, REF_CHANNEL), state["highlighted"].ravel(), state["interval"], state["target"]))
-    data_store.append(inrow)
-    data_idx += 1
+# decoder fitted on a previous session (bci_grid.decoder.fit_recording(...).save(path)); when
+# set, flashes are decoded online and each symbol stops as soon as the decoder is confident
+DECODER = None
+DECODER_THRESHOLD = 0.95
+speller = OnlineSpeller(SpellerDecoder.load(DECODER, threshold=DECODER_THRESHOLD)) if DECODER else None
 
-def data_save(ex):
-    df = pandas.DataFrame(data_store, columns=
-        ["timestamp"] +
-        ["channel{}".format(i) for i in range(9)] +
-        ["highlighted{}".format(i) for i in range(30)]+
-        ["interval"] +
-        ["target"]).set_index("timestamp")
+# recording is streamed to disk while the experiment runs; read it with recording.read_recording
+data_store = RecordingWriter("recording.bin", n_channels=9, gain=GAIN, reference=REF_CHANNEL, address=TRAUMSCHREIBER_ADDR)
+# stimulus events are logged separately, keyed by the (monotonic) time they were shown;
+# per-sample labels can be rebuilt with recording.dense_labels
+events = EventLog(EVENT_FIELDS, path="events.bin")
 
-    df.to_pickle("recording.pkl")
+# rereferenced samples are written here before being appended to the recording
+reref_buffer = np.zeros((BLOCK_SIZE,9), dtype='<i2')
+
+def data_callback(data_in, timestamps):
+    samples = reref_block(data_in, REF_CHANNEL, out=reref_buffer[:len(data_in)])
+    data_store.extend(samples, timestamp=timestamps)
+    if speller is not None:
+        speller.write(samples, timestamps)
+
+def data_save(result):
+    data_store.close()
+    events.close()
+    return result
 
 async def run_experiment(addr, training_text="", **kwargs):
     global db_ready
-    async with Traumschreiber(addr=addr) as t:
-        await t.start_listening(data_callback)
-        await t.set(gain=GAIN)
-        await t.set(gain=GAIN)
+    async with Device(addr=addr) as t:
+        await t.start_listening(data_callback, block_size=BLOCK_SIZE, block_interval=BLOCK_INTERVAL, timestamps=True)
         await t.set(gain=GAIN)
-        await experiment(**kwargs)
+        if PRESENTER:
+            await Presenter(experiment, events=events, decoder=speller, process=PRESENTER == "process", **kwargs).run()
+        else:
+            await experiment(events=events, decoder=speller, **kwargs)
         db_ready = False
 
 def main(reactor):
     ex = defer.ensureDeferred(run_experiment(TRAUMSCHREIBER_ADDR, targets="ASDADMVKA"))
-    ex.addCallback(data_save)
+    ex.addBoth(data_save)
     return ex
 
 task.react(main)
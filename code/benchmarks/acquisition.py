@@ -0,0 +1,169 @@
+""" Benchmark of the acquisition path: notification -> decoding -> rereferencing -> recording
+
+Drives the notification handler of Traumschreiber.start_listening (without a
+device) with synthetic payloads, as fast as possible, through the data callback
+of the experiment scripts into a RecordingWriter. For each variant (per-sample
+notifications and block buffers of several sizes) it reports
+
+    throughput          samples/s, including closing (flushing) the recording
+    latency             percentiles (us) from handing a sample's notification to the
+                        handler until the data callback has processed it
+    peak_memory         peak traced memory (bytes, tracemalloc) during the run
+    retained_blocks     memory blocks still allocated after the run, per sample (leaks/growth;
+                        not the number of allocations made during the run)
+    retained_bytes      traced bytes still allocated after the run, per sample
+
+as JSON, so results of different versions can be compared.
+
+Run from the code directory:
+
+    python -m benchmarks.acquisition --samples 50000 --output acquisition.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from Traumschreiber import Traumschreiber
+from recording import RecordingWriter
+from utils import reref_channels, reref_block
+
+REF_CHANNEL = 7
+
+# name -> block size (None: the per-sample callback)
+VARIANTS = {
+    "per_sample": None,
+    "block_8": 8,
+    "block_32": 32,
+    "block_128": 128,
+}
+
+
+def payloads(n_samples, seed=0):
+    """ Synthetic notifications of one sample each, as delivered by txdbus (list of byte values) """
+    raw = np.random.default_rng(seed).integers(-2**11, 2**11, (n_samples, 8)).astype('<i2')
+    return [{"Value": list(sample.tobytes())} for sample in raw]
+
+
+def run_variant(notifications, block_size, path, trace=False):
+    """ Push all notifications through the handler, returns the measurements of one run
+    (memory is only measured with `trace`, as tracing slows everything down) """
+    n = len(notifications)
+    pushed = np.zeros(n, dtype=np.int64)
+    latencies = np.zeros(n, dtype=np.int64)
+    delivered = [0]
+
+    data_store = RecordingWriter(path, n_channels=9)
+    if block_size is None:
+        # per-sample: each sample is rereferenced & recorded on its own
+        def data_callback(data_in, timestamps):
+            data_store.extend(reref_channels(data_in, REF_CHANNEL), timestamp=timestamps)
+            i, k = delivered[0], len(data_in)
+            latencies[i:i+k] = time.perf_counter_ns() - pushed[i:i+k]
+            delivered[0] += k
+    else:
+        reref_buffer = np.zeros((block_size, 9), dtype='<i2')
+        def data_callback(data_in, timestamps):
+            data_store.extend(reref_block(data_in, REF_CHANNEL, out=reref_buffer[:len(data_in)]), timestamp=timestamps)
+            i, k = delivered[0], len(data_in)
+            latencies[i:i+k] = time.perf_counter_ns() - pushed[i:i+k]
+            delivered[0] += k
+
+    device = Traumschreiber()
+    handler = device._notification_callback(data_callback, block_size, timestamps=True)
+    # samples arrive as fast as they can be processed, not paced like the device's,
+    # so the clock's gap detection would misfire
+    device.clock.gap_time = float("inf")
+
+    blocks_before = sys.getallocatedblocks()
+    if trace:
+        tracemalloc.start()
+    start = time.perf_counter()
+    for i, notification in enumerate(notifications):
+        pushed[i] = time.perf_counter_ns()
+        handler(None, notification, None)
+    device._stop_blocks()
+    data_store.close()
+    elapsed = time.perf_counter() - start
+    if trace:
+        traced, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    blocks_after = sys.getallocatedblocks()
+
+    if delivered[0] != n:
+        raise RuntimeError("Only {} of {} samples were delivered".format(delivered[0], n))
+    if trace:
+        return {
+            "peak_memory": peak,
+            "retained_blocks": (blocks_after - blocks_before) / n,
+            "retained_bytes": traced / n}
+
+    latencies = latencies / 1e3
+    return {
+        "block_size": block_size,
+        "samples": n,
+        "seconds": elapsed,
+        "throughput": n / elapsed,
+        "latency_us": {
+            "p50": float(np.percentile(latencies, 50)),
+            "p90": float(np.percentile(latencies, 90)),
+            "p99": float(np.percentile(latencies, 99)),
+            "max": float(latencies.max())},
+    }
+
+
+def environment():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def run(variants=None, samples=50000, repeat=3):
+    """ Run the benchmark; each variant is repeated `repeat` times, the run with the median
+    throughput is reported, followed by one traced run for the memory measurements """
+    notifications = payloads(samples)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in variants or VARIANTS:
+            runs = [run_variant(notifications, VARIANTS[name], os.path.join(tmp, "{}.bin".format(name)))
+                    for _ in range(repeat)]
+            runs.sort(key=lambda r: r["throughput"])
+            results[name] = runs[len(runs)//2]
+            results[name].update(run_variant(notifications, VARIANTS[name], os.path.join(tmp, "{}.bin".format(name)), trace=True))
+    return {"benchmark": "acquisition", "environment": environment(), "results": results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--samples", type=int, default=50000, help="samples (notifications) per run")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per variant (the median is reported)")
+    parser.add_argument("--variants", nargs="*", choices=list(VARIANTS), help="variants to run (default: all)")
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    results = run(args.variants, args.samples, args.repeat)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
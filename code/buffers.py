@@ -0,0 +1,89 @@
+import numpy as np
+
+
+class RingBuffer(object):
+    """ Fixed-size circular buffer of multi-channel samples
+
+    New samples overwrite the oldest ones at the write index, so appending costs
+    O(len(block)) regardless of the buffer length (no np.roll of the history).
+
+    Usage:
+
+        ring = RingBuffer(60*250, 9)
+        ring.write(block)               # (N, 9) block of new samples
+        history = ring.latest()         # chronologically ordered copy
+    """
+
+    def __init__(self, length, n_channels, dtype='<i2'):
+        self.length = length
+        self.n_channels = n_channels
+        self.data = np.zeros((length, n_channels), dtype=dtype)
+        # position the next sample will be written to
+        self.index = 0
+        # total number of samples written so far
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.length)
+
+    def write(self, block):
+        """ Append an (N, n_channels) block, overwriting the oldest samples """
+        n = len(block)
+        if n > self.length:
+            # only the most recent samples fit
+            self.index = (self.index + n - self.length) % self.length
+            self.count += n - self.length
+            block = block[n-self.length:]
+            n = self.length
+        k = min(n, self.length - self.index)
+        self.data[self.index:self.index+k] = block[:k]
+        if k < n:
+            self.data[:n-k] = block[k:]
+        self.index = (self.index + n) % self.length
+        self.count += n
+
+    def latest(self, n=None, out=None):
+        """ Returns the last `n` (default: all `length`) samples in chronological order,
+        written into `out` if given.
+        """
+        n = self.length if n is None else min(n, self.length)
+        if out is None:
+            out = np.empty((n, self.n_channels), dtype=self.data.dtype)
+        start = (self.index - n) % self.length
+        k = min(n, self.length - start)
+        out[:k] = self.data[start:start+k]
+        out[k:n] = self.data[:n-k]
+        return out
+
+    def read(self, start, n, out=None):
+        """ Returns the `n` samples starting at absolute sample index `start` (counting all
+        samples ever written), which have to still be in the buffer.
+        """
+        if start < self.count - self.length or start + n > self.count:
+            raise IndexError("Samples {}-{} are not in the buffer".format(start, start+n))
+        if out is None:
+            out = np.empty((n, self.n_channels), dtype=self.data.dtype)
+        i = start % self.length
+        k = min(n, self.length - i)
+        out[:k] = self.data[i:i+k]
+        out[k:n] = self.data[:n-k]
+        return out
+
+
+def minmax_decimate(data, n_bins, out=None):
+    """ Reduce an (N, C) signal to (2*n_bins, C) points for plotting
+
+    `data` is split into `n_bins` consecutive bins and the minimum and maximum of
+    each bin are returned alternately, so every peak survives decimation while
+    the number of plotted points only depends on `n_bins` (e.g. the axis width in
+    pixels). Samples that do not fill a complete bin at the start are dropped.
+    """
+    n, n_channels = data.shape
+    n_bins = max(1, min(n_bins, n))
+    bin_size = n // n_bins
+    bins = data[n - n_bins*bin_size:].reshape((n_bins, bin_size, n_channels))
+    if out is None:
+        out = np.empty((2*n_bins, n_channels), dtype=data.dtype)
+    np.min(bins, axis=1, out=out[0::2])
+    np.max(bins, axis=1, out=out[1::2])
+    return out
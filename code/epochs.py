@@ -0,0 +1,183 @@
+import logging
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from buffers import RingBuffer
+
+
+def onset_indices(timestamps, event_timestamps):
+    """ Index of the first sample at or after each event timestamp (both sorted) """
+    return np.searchsorted(timestamps, event_timestamps, side="left")
+
+
+def epoch(data, onsets, n_times, offset=0, out=None):
+    """ Cut stimulus-locked windows out of a continuous (N, n_channels) recording
+
+    Window i covers samples [onsets[i]+offset, onsets[i]+offset+n_times); a negative
+    `offset` includes a pre-stimulus baseline. The windows are gathered from a
+    strided (sliding window) view of `data`, so a memory-mapped recording is only
+    read where needed. Events whose window does not fit into the recording are
+    dropped.
+
+    Returns:
+        epochs (n_events, n_channels, n_times) in the dtype of `data` (or `out`)
+        valid (bool array): which of the given onsets were used
+    """
+    starts = np.asarray(onsets) + offset
+    valid = (starts >= 0) & (starts + n_times <= len(data))
+    windows = sliding_window_view(data, n_times, axis=0)
+    if out is None:
+        return windows[starts[valid]], valid
+    out[...] = windows[starts[valid]]
+    return out, valid
+
+
+def baseline_correct(epochs, baseline=None, out=None):
+    """ Subtract the mean over the baseline samples [start, stop) of each epoch & channel.
+    Defaults to the whole epoch. Integer epochs are converted to float32.
+    """
+    if out is None:
+        out = epochs.astype(np.float32) if epochs.dtype.kind in "iu" else epochs
+    elif out is not epochs:
+        out[...] = epochs
+    start, stop = baseline if baseline is not None else (None, None)
+    out -= out[..., start:stop].mean(axis=-1, keepdims=True)
+    return out
+
+
+def reject(epochs, threshold):
+    """ Returns a boolean mask of the epochs to keep: those with a peak-to-peak amplitude
+    below `threshold` on all channels """
+    return (np.ptp(epochs, axis=-1) < threshold).all(axis=-1)
+
+
+class EpochAverager(object):
+    """ Running per-condition sums & counts of epochs, e.g. target vs. non-target """
+
+    def __init__(self, n_conditions, n_channels, n_times):
+        self.sums = np.zeros((n_conditions, n_channels, n_times), dtype=np.float64)
+        self.counts = np.zeros(n_conditions, dtype=np.int64)
+
+    def add(self, epochs, conditions):
+        """ Add (n_events, n_channels, n_times) epochs with the given condition indices """
+        conditions = np.broadcast_to(conditions, (len(epochs),))
+        counts = np.bincount(conditions, minlength=len(self.counts))
+        for condition in np.flatnonzero(counts):
+            self.sums[condition] += epochs[conditions == condition].sum(axis=0, dtype=np.float64)
+        self.counts += counts
+
+    def average(self, condition=None):
+        """ The average epoch of `condition` (default: all conditions, (n_conditions, n_channels, n_times)) """
+        counts = np.maximum(self.counts, 1)[:,None,None]
+        averages = self.sums / counts
+        return averages if condition is None else averages[condition]
+
+    def grand_average(self):
+        """ The average over all epochs regardless of condition """
+        return self.sums.sum(axis=0) / max(self.counts.sum(), 1)
+
+
+class OnlineEpocher(object):
+    """ Cuts epochs out of a live stream as soon as their window is complete
+
+    Feed it the (rereferenced) sample blocks with their timestamps via `write` and
+    the stimulus events via `add_event`. Each complete epoch is baseline corrected,
+    checked against the rejection threshold, added to `averager` and handed to
+    `callback(epoch, condition, timestamp)` if given.
+
+    Events may be added after their samples have been written (e.g. flip times
+    reported by a presenter.Presenter): onsets are looked up in the timestamps of
+    the last `history` samples. Events whose window is no longer in the history
+    are logged and counted in `dropped`.
+
+    Usage:
+
+        epocher = OnlineEpocher(9, n_times=200, offset=-25, n_conditions=2)
+        epocher.add_event(flip_time, condition=1)
+        epocher.write(block, timestamps)
+        epocher.averager.average(1)
+    """
+
+    def __init__(self, n_channels, n_times, offset=0, n_conditions=2, baseline=None, threshold=None, history=None, callback=None):
+        self.n_times = n_times
+        self.offset = offset
+        self.baseline = baseline if baseline is not None else ((0, -offset) if offset < 0 else None)
+        self.threshold = threshold
+        self.callback = callback
+        self.averager = EpochAverager(n_conditions, n_channels, n_times)
+        self.rejected = 0
+
+        history = history or 4*(n_times + abs(offset))
+        self._samples = RingBuffer(history, n_channels, dtype=np.float32)
+        # timestamps of the samples in the history, to place events that arrive after their samples
+        self._timestamps = RingBuffer(history, 1, dtype=np.int64)
+        self._epoch = np.zeros((1, n_channels, n_times), dtype=np.float32)
+        # events whose window is not complete yet: [timestamp, condition, onset sample index or None]
+        self._pending = []
+        self.dropped = 0
+
+    def add_event(self, timestamp, condition):
+        self._pending.append([timestamp, condition, None])
+
+    def clear_pending(self):
+        """ Forget the events whose epoch is not complete yet, returns how many there were """
+        n = len(self._pending)
+        del self._pending[:]
+        return n
+
+    def _drop(self, event, reason):
+        self.dropped += 1
+        logging.warning("Dropped event at {} (condition {}): {}".format(event[0], event[1], reason))
+
+    def write(self, block, timestamps):
+        """ Append an (N, n_channels) block with its (N,) timestamps & process completed epochs """
+        self._samples.write(block)
+        self._timestamps.write(np.reshape(timestamps, (-1, 1)))
+        if not self._pending:
+            return
+
+        # locate the onsets of events in the history, which also covers events that
+        # are only reported after their samples have arrived (e.g. through a Presenter)
+        count = self._samples.count
+        oldest = max(count - self._samples.length, 0)
+        stamps = None
+        for event in self._pending:
+            if event[2] is None:
+                if stamps is None:
+                    stamps = self._timestamps.latest(count - oldest)[:,0]
+                i = np.searchsorted(stamps, event[0], side="left")
+                if i == len(stamps):
+                    break
+                event[2] = oldest + i
+                if i == 0 and stamps[0] > event[0]:
+                    # the event is older than the oldest sample in the history: its samples
+                    # have fallen out of it already, or it happened before the first sample
+                    event[2] = -1
+
+        done = 0
+        for event in self._pending:
+            if event[2] is None:
+                break
+            first = event[2] + self.offset
+            if event[2] < 0 or first < oldest:
+                # window fell out of the history already (or started before the first sample)
+                self._drop(event, "window is not in the history of {} samples".format(self._samples.length))
+                done += 1
+                continue
+            if first + self.n_times > count:
+                break
+            self._process(first, event[1], event[0])
+            done += 1
+        del self._pending[:done]
+
+    def _process(self, first, condition, timestamp):
+        epoch = self._epoch
+        self._samples.read(first, self.n_times, out=epoch[0].T)
+        baseline_correct(epoch, self.baseline, out=epoch)
+        if self.threshold is not None and not reject(epoch, self.threshold)[0]:
+            self.rejected += 1
+            return
+        self.averager.add(epoch, condition)
+        if self.callback is not None:
+            self.callback(epoch[0], condition, timestamp)
@@ -1,5 +1,5 @@
-from utils import *
 from Traumschreiber import *
+from utils import *
 from twisted.internet import reactor, defer, task
 import itertools
 import random
@@ -8,8 +8,13 @@ import random
 # This module-level variable (buh!) keeps track of the current state of the experiment
 state = {"interval": 0, "highlighted": False}
 
+# Fields of the stimulus events logged by the experiment (see recording.EventLog)
+EVENT_FIELDS = {
+    "highlighted": (np.bool_, ()),
+    "interval": (np.int32, ())}
+
 # This is an asynchroneous co-routine for running the experiment itself
-async def experiment(flashes=100, on_duration=1.0, off_duration=1.0, mode="fixed"):
+async def experiment(flashes=100, on_duration=1.0, off_duration=1.0, mode="fixed", events=None):
     """ ERP test stimulus
 
     Shows flashes of bright stimuli alternating with a black screen.
@@ -19,17 +24,24 @@ async def experiment(flashes=100, on_duration=1.0, off_duration=1.0, mode="fixed
         on_duration (float):  Duration of the flashes if mode == "fixed", else mean duration of flashes
         off_duration (float): Interval between flashes if mode == "fixed", else mean interval between flashes
         mode (str):           Either "fixed" (default) or "random"; if "random", intervals are randomly drawn
+                              Durations are rounded to whole display frames.
+        events (EventLog):    Log to record flash onsets/offsets to (fields: EVENT_FIELDS), keyed
+                              by flip timestamp. Defaults to no logging.
+
+    Returns:
+        dict: flip timing statistics of the run (see FrameClock.stats)
     """
     global state
 
     width,height = boilerplate()
+    clock = FrameClock()
+    clock.calibrate()
 
     # Little helper function to do the actual rendering
     def render(color=(0,0,0,1)):
         glClearColor(*color)
         glClear(GL_COLOR_BUFFER_BIT|GL_DEPTH_BUFFER_BIT)
         glFlush()
-        pygame.display.flip()
 
     # Little helper function to poll & parse the events triggered
     def poll_events():
@@ -46,26 +58,36 @@ async def experiment(flashes=100, on_duration=1.0, off_duration=1.0, mode="fixed
     # start repetitions
     for i in range(flashes):
         # Poll event queue
-        events = poll_events()
-        if "QUIT" in events:
-            return
-        if "PAUSE" in events:
+        pressed = poll_events()
+        if "QUIT" in pressed:
+            return clock.stats()
+        if "PAUSE" in pressed:
+            clock.interrupt()
             await async_sleep(1)
             continue
 
 
-        # bright screen
-        render((1,1,1,1))
-        state["highlighted"] = True
+        # bright screen, labeled from the moment it is actually shown
+        def flash_on(t):
+            state["highlighted"] = True
+            state["flip_time"] = t
+            if events is not None:
+                events.append(t, highlighted=True, interval=state["interval"])
         on = on_duration if mode == "fixed" else np.random.exponential(on_duration)
-        await async_sleep(on)
+        await clock.present(lambda: render((1,1,1,1)), clock.frames(on), onset=flash_on)
 
         # black screen
-        render()
-        state["highlighted"] = False
+        def flash_off(t):
+            state["highlighted"] = False
+            state["flip_time"] = t
+            if events is not None:
+                events.append(t, highlighted=False, interval=state["interval"])
         off = off_duration if mode == "fixed" else np.random.exponential(off_duration)
-        await async_sleep(off)
+        await clock.present(render, clock.frames(off), onset=flash_off)
         state["interval"] += 1
 
     # The experiment is done!
+    stats = clock.stats()
+    logging.info("Frame timing: {}".format(stats))
     pygame.quit()
+    return stats
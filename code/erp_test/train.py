@@ -1,17 +1,18 @@
 import itertools
 import random
-import datetime
-import pandas
 
-from .experiment import state, experiment
+from .experiment import state, experiment, EVENT_FIELDS
 from Traumschreiber import *
+from simulator import SimulatedTraumschreiber
 from twisted.internet import reactor, defer, task
 #from twisted.enterprise import adbapi
 from utils import *
+from recording import RecordingWriter, EventLog
+from presenter import Presenter
+from pipeline import Pipeline
 
 # reference channel
 REF_CHANNEL = 7
-data_store = []
 
 ########################################
 # ID of the traumschreiber you are using
@@ -21,32 +22,63 @@ GAIN = 32
 
 TRAUMSCHREIBER_ADDR = "74:72:61:75:6D:{:02x}".format(ID)
 
-def data_callback(data_in):
-    inrow =  np.hstack((datetime.datetime.now(), reref_channels(data_in, REF_CHANNEL).ravel(), state["highlighted"], state["interval"]))
-    data_store.append(inrow)
+# use a simulated device (synthetic EEG, see simulator.SimulatedTraumschreiber) instead of the Traumschreiber
+SIMULATE = False
+Device = SimulatedTraumschreiber if SIMULATE else Traumschreiber
 
-def data_save(ex):
-    df = pandas.DataFrame(data_store, columns=
-        ["timestamp"] +
-        ["channel{}".format(i) for i in range(9)] +
-        ["highlighted"]+
-        ["interval"]).set_index("timestamp")
+# samples are delivered in blocks of up to BLOCK_SIZE samples, at least every BLOCK_INTERVAL seconds
+BLOCK_SIZE = 32
+BLOCK_INTERVAL = 0.1
 
-    df.to_pickle("erp_test/recording.pkl")
+# present the stimuli in a separate "process" or "thread" (see presenter.Presenter), so display
+# flips do not delay the samples; None: on the reactor, which then blocks in every flip (vsync)
+PRESENTER = "thread"
+
+# rereference & record in a worker thread (see pipeline.Pipeline); the reactor only copies the samples
+PIPELINE = False
+
+# recording is streamed to disk while the experiment runs; read it with recording.read_recording
+data_store = RecordingWriter("erp_test/recording.bin", n_channels=9, gain=GAIN, reference=REF_CHANNEL, address=TRAUMSCHREIBER_ADDR)
+# stimulus events are logged separately, keyed by the (monotonic) time they were shown;
+# per-sample labels can be rebuilt with recording.dense_labels
+events = EventLog(EVENT_FIELDS, path="erp_test/events.bin")
+
+# rereferenced samples are written here before being appended to the recording
+reref_buffer = np.zeros((BLOCK_SIZE,9), dtype='<i2')
+
+def record(data_in, timestamps):
+    data_store.extend(reref_block(data_in, REF_CHANNEL, out=reref_buffer[:len(data_in)]), timestamp=timestamps)
+
+if PIPELINE:
+    pipeline = Pipeline(n_channels=8)
+    pipeline.add(record, block_size=BLOCK_SIZE)
+    pipeline.start()
+    data_callback = pipeline.write
+else:
+    pipeline = None
+    data_callback = record
+
+def data_save(result):
+    if pipeline is not None:
+        pipeline.stop()
+    data_store.close()
+    events.close()
+    return result
 
 async def run_experiment(addr, training_text="", **kwargs):
     global db_ready
-    async with Traumschreiber(addr=addr) as t:
-        await t.start_listening(data_callback)
-        await t.set(gain=GAIN)
-        await t.set(gain=GAIN)
+    async with Device(addr=addr) as t:
+        await t.start_listening(data_callback, block_size=BLOCK_SIZE, block_interval=BLOCK_INTERVAL, timestamps=True)
         await t.set(gain=GAIN)
-        await experiment(**kwargs)
+        if PRESENTER:
+            await Presenter(experiment, events=events, process=PRESENTER == "process", **kwargs).run()
+        else:
+            await experiment(events=events, **kwargs)
         db_ready = False
 
 def main(reactor):
     ex = defer.ensureDeferred(run_experiment(TRAUMSCHREIBER_ADDR, flashes=100, on_duration=0.1, off_duration=0.5))
-    ex.addCallback(data_save)
+    ex.addBoth(data_save)
     return ex
 
 task.react(main)
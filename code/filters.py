@@ -0,0 +1,120 @@
+import numpy as np
+
+try:
+    from scipy.signal import sosfilt
+except ImportError:
+    sosfilt = None
+
+
+def _biquad(b, a):
+    """ Normalized second-order section [b0, b1, b2, 1, a1, a2] """
+    return np.hstack((np.asarray(b)/a[0], [1.0], np.asarray(a[1:])/a[0]))
+
+def butter_sections(kind, cutoff, sample_rate, order=4):
+    """ Second-order sections of a Butterworth low- or high-pass filter of even `order`
+    (RBJ cookbook biquads with the Butterworth pole Qs) """
+    assert kind in ("lowpass", "highpass"), "kind has to be 'lowpass' or 'highpass' (got {})".format(kind)
+    assert order % 2 == 0, "Only even filter orders are supported (got {})".format(order)
+    w0 = 2*np.pi*cutoff/sample_rate
+    cos_w0, sin_w0 = np.cos(w0), np.sin(w0)
+    sections = []
+    for k in range(order//2):
+        q = 1/(2*np.cos((2*k+1)*np.pi/(2*order)))
+        alpha = sin_w0/(2*q)
+        if kind == "lowpass":
+            b = [(1-cos_w0)/2, 1-cos_w0, (1-cos_w0)/2]
+        else:
+            b = [(1+cos_w0)/2, -(1+cos_w0), (1+cos_w0)/2]
+        sections.append(_biquad(b, [1+alpha, -2*cos_w0, 1-alpha]))
+    return np.array(sections)
+
+def bandpass_sections(low, high, sample_rate, order=4):
+    """ Second-order sections of a Butterworth band-pass (high-pass at `low`, low-pass at `high`) """
+    return np.vstack((butter_sections("highpass", low, sample_rate, order),
+                      butter_sections("lowpass", high, sample_rate, order)))
+
+def notch_sections(freq, sample_rate, q=30):
+    """ Second-order section of a notch filter at `freq` (e.g. 50Hz line noise) """
+    w0 = 2*np.pi*freq/sample_rate
+    alpha = np.sin(w0)/(2*q)
+    return _biquad([1, -2*np.cos(w0), 1], [1+alpha, -2*np.cos(w0), 1-alpha])[None,:]
+
+
+class FilterBank(object):
+    """ Causal, stateful IIR filter (cascade of second-order sections) for all channels
+
+    The filter state is kept between calls to `process`, so a stream can be
+    filtered block by block with the same result as filtering it at once. The
+    state is initialized to the steady state of the first sample, which avoids
+    the transient caused by the large DC offset of the raw signals. Uses
+    scipy.signal.sosfilt if available, else a numpy implementation vectorized
+    across channels.
+
+    Usage:
+
+        bank = FilterBank(np.vstack((bandpass_sections(1, 40, 250), notch_sections(50, 250))), n_channels=9)
+        filtered = bank.process(block)                  # (N,9) block
+        await t.start_listening(bank.wrap(data_callback), block_size=32)
+    """
+    def __init__(self, sos, n_channels=9):
+        self.sos = np.atleast_2d(np.asarray(sos, dtype=np.float64))
+        self.n_channels = n_channels
+        self.zi = np.zeros((len(self.sos), 2, n_channels))
+        self._initialized = False
+
+    def reset(self):
+        self.zi[...] = 0
+        self._initialized = False
+
+    def _steady_state(self, x0):
+        """ Filter state for a constant input x0 (per channel) """
+        gain = np.ones(self.n_channels)*x0
+        for s, (b0, b1, b2, _, a1, a2) in enumerate(self.sos):
+            y = gain*(b0+b1+b2)/(1+a1+a2)
+            self.zi[s,1] = b2*gain - a2*y
+            self.zi[s,0] = b1*gain - a1*y + self.zi[s,1]
+            gain = y
+
+    def process(self, block, out=None):
+        """ Filter an (N, n_channels) block, returns the filtered (N, n_channels) float block """
+        if not self._initialized:
+            self._steady_state(block[0])
+            self._initialized = True
+        if sosfilt is not None:
+            y, self.zi = sosfilt(self.sos, block, axis=0, zi=self.zi)
+            if out is None:
+                return y
+            out[...] = y
+            return out
+
+        if out is None:
+            out = np.empty(block.shape, dtype=np.float64)
+        out[...] = block
+        # direct form II transposed, one section after the other
+        for s, (b0, b1, b2, _, a1, a2) in enumerate(self.sos):
+            z1, z2 = self.zi[s]
+            for i in range(len(out)):
+                x = out[i].copy()
+                out[i] = b0*x + z1
+                z1 = b1*x - a1*out[i] + z2
+                z2 = b2*x - a2*out[i]
+            self.zi[s,0], self.zi[s,1] = z1, z2
+        return out
+
+    def wrap(self, callback):
+        """ Returns a data callback that filters each block before passing it (and any further
+        arguments, e.g. timestamps) on to `callback` """
+        def filtered_callback(block, *args):
+            callback(self.process(block), *args)
+        return filtered_callback
+
+
+def eeg_filter_bank(n_channels=9, sample_rate=250, band=(1, 40), notch=50, order=4):
+    """ The default acquisition filter: Butterworth band-pass `band` & notch at `notch` Hz
+    (either can be None to leave it out) """
+    sections = []
+    if band is not None:
+        sections.append(bandpass_sections(band[0], band[1], sample_rate, order))
+    if notch is not None:
+        sections.append(notch_sections(notch, sample_rate))
+    return FilterBank(np.vstack(sections), n_channels)
@@ -0,0 +1,192 @@
+import logging
+import time
+
+import numpy as np
+from twisted.internet import reactor, defer
+from txdbus import client as dbus_client
+
+from Traumschreiber import Traumschreiber, ObjectCache
+from buffers import RingBuffer
+
+
+class MergedBuffer(object):
+    """ Per-device ring buffers of (rereferenced or raw) samples & their timestamps
+
+    `write(device, block, timestamps)` appends a block of one device; `aligned(n)`
+    returns the latest `n` samples of all devices, time-aligned: every device's
+    window ends at its last sample before a common end time (the newest time all
+    devices that are still streaming have reached). Devices whose newest sample is
+    older than `stall_timeout` seconds do not hold back the others; their rows
+    are marked invalid.
+    """
+    def __init__(self, n_devices, length, n_channels=8, dtype='<i2', stall_timeout=0.5):
+        self.n_devices = n_devices
+        self.n_channels = n_channels
+        self.stall_timeout = int(stall_timeout*1e9)
+        self.samples = [RingBuffer(length, n_channels, dtype) for _ in range(n_devices)]
+        self.timestamps = [RingBuffer(length, 1, np.int64) for _ in range(n_devices)]
+        # host time (time.monotonic_ns) of the last block of each device
+        self.last_write = np.zeros(n_devices, dtype=np.int64)
+
+    def write(self, device, block, timestamps):
+        self.samples[device].write(block)
+        self.timestamps[device].write(timestamps[:,None])
+        self.last_write[device] = time.monotonic_ns()
+
+    def streaming(self, now=None):
+        """ (n_devices,) bool: which devices delivered samples within the last `stall_timeout` """
+        now = time.monotonic_ns() if now is None else now
+        return (self.last_write > 0) & (now - self.last_write < self.stall_timeout)
+
+    def aligned(self, n, out=None, timestamps_out=None):
+        """ Latest `n` time-aligned samples of all devices
+
+        Returns:
+            samples (n_devices, n, n_channels)
+            timestamps (n_devices, n) int64 monotonic timestamps (ns) of each device's samples
+            valid (n_devices,) bool: devices that are streaming & have `n` samples before the end time
+        """
+        if out is None:
+            out = np.zeros((self.n_devices, n, self.n_channels), dtype=self.samples[0].data.dtype)
+        if timestamps_out is None:
+            timestamps_out = np.zeros((self.n_devices, n), dtype=np.int64)
+        valid = self.streaming()
+        newest = [ring.data[(ring.index-1) % ring.length, 0] if ring.count else 0 for ring in self.timestamps]
+        end = min((t for t, v in zip(newest, valid) if v), default=0)
+
+        for i in range(self.n_devices):
+            ring = self.timestamps[i]
+            if not valid[i]:
+                continue
+            # number of samples of this device newer than the common end time
+            stamps = ring.latest(len(ring))[:,0]
+            newer = len(stamps) - np.searchsorted(stamps, end, side="right")
+            start = ring.count - newer - n
+            if start < max(ring.count - ring.length, 0):
+                valid[i] = False
+                continue
+            self.samples[i].read(start, n, out=out[i])
+            ring.read(start, n, out=timestamps_out[i,:,None])
+        return out, timestamps_out, valid
+
+
+class DeviceGroup(object):
+    """ Several Traumschreibers recording at once (asynchronous context manager)
+
+    All devices share one system bus connection and one ObjectCache; discovery
+    runs once for all devices that are not known yet and they are connected in
+    parallel (see Traumschreiber's fast_connect). A device that fails to connect
+    is logged and left out (`failed`), unless none connects at all.
+
+    Samples are delivered in blocks with per-device timestamps (see SampleClock)
+    into `buffer` (a MergedBuffer of `history` seconds) and, if given, to
+    `callback(device_index, block, timestamps)`. Each device is handled on its
+    own, so a stalled device does not hold back the others. Devices that fail to
+    start or stop listening are logged & added to `failed` as well; `set` raises
+    if any device's write failed.
+
+    Usage:
+
+        async with DeviceGroup(["74:72:61:75:6D:03", "74:72:61:75:6D:04"]) as group:
+            await group.start_listening(block_size=32, block_interval=0.1)
+            await group.set(gain=32)
+            samples, timestamps, valid = group.buffer.aligned(250)     # (2, 250, 8), (2, 250), (2,)
+    """
+    def __init__(self, addrs, scan=10, sample_rate=250, history=10, timeout=10, stall_timeout=0.5, bus=None, manager=None):
+        self.addrs = list(addrs)
+        self.scan = scan
+        self.sample_rate = sample_rate
+        self.history = history
+        self.timeout = timeout
+        self.stall_timeout = stall_timeout
+        self.bus = bus
+        self.manager = manager
+        self.objects = None
+        self.devices = []
+        self.failed = []
+        self.buffer = None
+
+    def __len__(self):
+        return len(self.devices)
+
+    async def __aenter__(self):
+        logging.info("Connecting to {} devices...".format(len(self.addrs)))
+        if self.bus is None:
+            self.bus = await dbus_client.connect(reactor, "system")
+        if self.manager is None:
+            self.manager = await self.bus.getRemoteObject("org.bluez","/", "org.freedesktop.DBus.ObjectManager")
+        self.objects = await ObjectCache(self.bus, self.manager).start()
+
+        # one discovery for all devices that are not known yet, instead of one per device
+        unknown = [addr for addr in self.addrs if self.objects.find("org.bluez.Device1", Address=addr) is None]
+        if unknown and self.scan:
+            adapter, _ = await self.objects.get_object(self.objects.find("org.bluez.Adapter1"), "org.bluez.Adapter1")
+            logging.info("Start scanning...")
+            await adapter.callRemote("StartDiscovery")
+            await defer.DeferredList([self.objects.wait_for("org.bluez.Device1", timeout=self.scan, Address=addr)
+                    for addr in unknown], consumeErrors=True)
+            await adapter.callRemote("StopDiscovery")
+            logging.info("Done scanning.")
+
+        devices = [Traumschreiber(addr, scan=0, sample_rate=self.sample_rate, fast_connect=True, timeout=self.timeout)
+                   for addr in self.addrs]
+        for device in devices:
+            device.objects = self.objects
+        results = await defer.DeferredList([defer.ensureDeferred(device._fast_connect(self.bus, self.manager))
+                for device in devices], consumeErrors=True)
+        for device, (success, result) in zip(devices, results):
+            if success:
+                self.devices.append(device)
+            else:
+                logging.warning("Failed to connect to {}: {!r}".format(device.addr, result.value))
+                self.failed.append(device.addr)
+        if not self.devices:
+            raise Exception("Failed to connect to any device.")
+        return self
+
+    async def __aexit__(self, *args):
+        await self.stop_listening()
+        logging.info("Disconnecting...")
+        await defer.DeferredList([defer.ensureDeferred(device.disconnect_unpair_forget(unpair=False, forget=False))
+                for device in self.devices], consumeErrors=True)
+
+    async def start_listening(self, callback=None, block_size=32, block_interval=0.1):
+        """ Start all devices' notifications, see the class docstring """
+        self.buffer = MergedBuffer(len(self.devices), int(self.history*self.sample_rate),
+                stall_timeout=self.stall_timeout)
+        write = self.buffer.write
+        def device_callback(index):
+            def data_callback(block, timestamps):
+                write(index, block, timestamps)
+                if callback is not None:
+                    callback(index, block, timestamps)
+            return data_callback
+        results = await defer.DeferredList([defer.ensureDeferred(device.start_listening(device_callback(i),
+                block_size=block_size, block_interval=block_interval, timestamps=True))
+                for i, device in enumerate(self.devices)], consumeErrors=True)
+        self._failures(results, "start listening on")
+
+    async def stop_listening(self):
+        results = await defer.DeferredList([defer.ensureDeferred(device.stop_listening()) for device in self.devices],
+                consumeErrors=True)
+        self._failures(results, "stop listening on")
+
+    async def set(self, **kwargs):
+        """ Set the same properties on all devices (see Traumschreiber.set), raises if any write failed """
+        results = await defer.DeferredList([defer.ensureDeferred(device.set(**kwargs)) for device in self.devices],
+                consumeErrors=True)
+        failed = self._failures(results, "set {} on".format(kwargs))
+        if failed:
+            raise Exception("Failed to set {} on {}.".format(kwargs, ", ".join(failed)))
+
+    def _failures(self, results, action):
+        """ Log the devices whose call failed (DeferredList results, in the order of `devices`),
+        add them to `failed` & return their addresses """
+        failed = []
+        for device, (success, result) in zip(self.devices, results):
+            if not success:
+                logging.warning("Failed to {} {}: {!r}".format(action, device.addr, result.value))
+                failed.append(device.addr)
+                if device.addr not in self.failed:
+                    self.failed.append(device.addr)
+        return failed
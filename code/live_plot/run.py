@@ -5,9 +5,11 @@ logging.basicConfig(level=loglevel)
 import numpy as np
 
 from Traumschreiber import *
+from simulator import SimulatedTraumschreiber
 from twisted.internet import reactor, defer, task
 
-from utils import reref_channels
+from utils import reref_channels, reref_block
+from buffers import RingBuffer, minmax_decimate
 
 SHOWPLOT = True
 
@@ -19,21 +21,33 @@ ID = 4
 GAIN = 16
 TRAUMSCHREIBER_ADDR = "74:72:61:75:6D:{:02x}".format(ID)
 
+# use a simulated device (synthetic EEG, see simulator.SimulatedTraumschreiber) instead of the Traumschreiber
+SIMULATE = False
+Device = SimulatedTraumschreiber if SIMULATE else Traumschreiber
+
 # reference channel
 REF_CHANNEL = 5
 
-duration=2500
-cnt = 0
-data = np.zeros((duration,9), dtype='<i2')
-
-def data_callback(data_in):
-    global data
-    global cnt
-
-    data = np.roll(data, -1, axis=0)
-    data[-1,:] = np.hstack(([[0]],data_in))
-    # data[-1,:] = reref_channels(data_in, REF_CHANNEL)
-    cnt += 1
+# samples per second & seconds of history to show
+SAMPLE_RATE = 250
+HISTORY = 60
+# samples are delivered in blocks of up to BLOCK_SIZE samples, at least every BLOCK_INTERVAL seconds
+BLOCK_SIZE = 25
+BLOCK_INTERVAL = 0.1
+# seconds between logged stream metrics (packet rate, lost samples, jitter, callback times)
+METRICS_INTERVAL = 10
+
+duration = HISTORY*SAMPLE_RATE
+device = None
+data = RingBuffer(duration, 9, dtype='<i2')
+# first column stays 0 (unreferenced), see reref_block for the rereferenced signal
+block = np.zeros((BLOCK_SIZE,9), dtype='<i2')
+
+def data_callback(data_in, timestamps):
+    n = len(data_in)
+    block[:n,1:] = data_in
+    # reref_block(data_in, REF_CHANNEL, out=block[:n])
+    data.write(block[:n])
 
 if SHOWPLOT:
     import matplotlib
@@ -41,18 +55,25 @@ if SHOWPLOT:
     from matplotlib import pyplot as pp
     def plot():
         try:
+            data.latest(out=history)
+            minmax_decimate(history, n_bins, out=decimated)
             for i,line in enumerate(lines):
                 fig.canvas.restore_region(background[i])
-                line.set_data(tt, data[:,i])
+                line.set_data(tt, decimated[:,i])
                 ax[i].draw_artist(line)
-                #fig.canvas.set_window_title("Data (received {} packages/second)".format(pkgs_per_second))
                 fig.canvas.blit(ax[i].bbox)
+            if device is not None and device.metrics is not None:
+                fig.canvas.manager.set_window_title("Data (received {packet_rate:.0f} packages/second, {lost} lost)".format(
+                    **device.metrics.snapshot()))
         except Exception as e:
             print("Encountered exception in plot callback: {}".format(e))
 
 async def run():
-    async with Traumschreiber(addr=TRAUMSCHREIBER_ADDR) as t:
-        await t.start_listening(data_callback)
+    global device
+    async with Device(addr=TRAUMSCHREIBER_ADDR) as t:
+        device = t
+        await t.start_listening(data_callback, block_size=BLOCK_SIZE, block_interval=BLOCK_INTERVAL, timestamps=True)
+        t.metrics.start_reporting(METRICS_INTERVAL)
         # await async_sleep(1)
         await t.set(gain=GAIN)
         # await t.set(a_on=1,b_on=1,color=(255,0,0), gain=GAIN)
@@ -83,8 +104,13 @@ if SHOWPLOT:
     fig.show()
     fig.canvas.draw()
 
-    tt = np.arange(duration)
-    lines = [ax[i].plot(tt, data[:,i])[0] for i in range(9)]
+    # one min/max pair per horizontal pixel, independent of the length of the history
+    n_bins = min(int(ax[0].bbox.width), duration)
+    history = np.zeros((duration,9), dtype='<i2')
+    decimated = minmax_decimate(history, n_bins)
+    bin_size = duration // n_bins
+    tt = np.repeat(np.arange(duration - n_bins*bin_size, duration, bin_size), 2) / SAMPLE_RATE - HISTORY
+    lines = [ax[i].plot(tt, decimated[:,i])[0] for i in range(9)]
     hlines = [(ax[i].axhline(y=2**11, c="black"), ax[i].axhline(y=-2**11, c="black")) for i in range(9)]
     ax[0].set_ylim([-2**12, 2**12])
     background = [fig.canvas.copy_from_bbox(ax[i].bbox) for i in range(9)]
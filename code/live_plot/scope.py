@@ -0,0 +1,83 @@
+import logging
+loglevel = logging.INFO
+logging.basicConfig(level=loglevel)
+import numpy as np
+
+from Traumschreiber import *
+from simulator import SimulatedTraumschreiber
+from twisted.internet import reactor, defer, task
+
+from utils import *
+from filters import eeg_filter_bank
+
+########################################
+# ID of the traumschreiber you are using
+ID = 4
+########################################
+
+GAIN = 16
+TRAUMSCHREIBER_ADDR = "74:72:61:75:6D:{:02x}".format(ID)
+
+# use a simulated device (synthetic EEG, see simulator.SimulatedTraumschreiber) instead of the Traumschreiber
+SIMULATE = False
+Device = SimulatedTraumschreiber if SIMULATE else Traumschreiber
+
+# reference channel
+REF_CHANNEL = 5
+
+# samples per second & seconds of history to show
+SAMPLE_RATE = 250
+HISTORY = 10
+# samples are delivered in blocks of up to BLOCK_SIZE samples, at least every BLOCK_INTERVAL seconds
+BLOCK_SIZE = 8
+BLOCK_INTERVAL = 1/60
+FPS = 60
+# band-pass (Hz) & notch (Hz) applied to the rereferenced signal, None to show it unfiltered
+FILTER_BAND = (1, 40)
+FILTER_NOTCH = 50
+
+block = np.zeros((BLOCK_SIZE,9), dtype='<i2')
+filtered = np.zeros((BLOCK_SIZE,9))
+filter_bank = eeg_filter_bank(9, SAMPLE_RATE, FILTER_BAND, FILTER_NOTCH) if FILTER_BAND or FILTER_NOTCH else None
+scope = None
+
+def data_callback(data_in):
+    n = len(data_in)
+    samples = reref_block(data_in, REF_CHANNEL, out=block[:n])
+    if filter_bank is not None:
+        samples = filter_bank.process(samples, out=filtered[:n])
+    if scope is not None:
+        scope.write(samples)
+
+def poll_events():
+    for event in pygame.event.get():
+        if event.type == pygame.QUIT or (event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE):
+            return True
+    return False
+
+async def run():
+    global scope
+
+    width, height = boilerplate()
+    glClearColor(0, 0, 0, 1)
+    scope = Scope(n_channels=9, length=HISTORY*SAMPLE_RATE, coords=((-0.95,0.95), (0.95,-0.95)))
+
+    async with Device(addr=TRAUMSCHREIBER_ADDR) as t:
+        await t.start_listening(data_callback, block_size=BLOCK_SIZE, block_interval=BLOCK_INTERVAL)
+        await t.set(gain=GAIN)
+
+        # render on the reactor in between notifications; the scope only uploads new samples
+        while not poll_events():
+            glClear(GL_COLOR_BUFFER_BIT|GL_DEPTH_BUFFER_BIT)
+            scope.draw()
+            glFlush()
+            pygame.display.flip()
+            await async_sleep(1/FPS)
+
+    pygame.quit()
+
+def main(reactor):
+    d = defer.ensureDeferred(run())
+    return d
+
+task.react(main)
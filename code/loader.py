@@ -0,0 +1,112 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from recording import read_recording
+
+
+class WindowLoader(object):
+    """ Shuffled minibatches of fixed-length windows from memory-mapped recordings
+
+    Every recording (a file written by recording.RecordingWriter) is opened as a
+    memory map and viewed as a sliding window view of its channels, so the
+    dataset is never loaded as a whole: a batch only reads the windows it
+    contains, each copied (and converted to `dtype`) once, straight into the
+    batch array. The windows of a batch are read in file order for locality. Batches are
+    assembled on a thread pool, `prefetch` batches ahead of the training loop.
+
+    Labels are given per window, by
+        - the name of a label field of the recordings, taken at the last sample of each window
+        - a function `labels(recording, starts)` returning the labels of the windows starting
+          at sample indices `starts` of `recording` (e.g. using recording.dense_labels & an event log)
+        - None, to yield the windows only
+
+    Usage:
+
+        loader = WindowLoader(["s1/recording.bin", "s2/recording.bin"], window=250, stride=25,
+                              labels=my_labels, batch_size=64)
+        for epoch in range(10):
+            for windows, labels in loader:      # (64, 9, 250) float32, (64,)
+                ...
+    """
+
+    def __init__(self, recordings, window, stride=1, labels=None, batch_size=32, shuffle=True, drop_last=False,
+                 dtype=np.float32, prefetch=2, workers=2, seed=None):
+        self.recordings = []
+        for r in recordings:
+            recording = read_recording(r) if isinstance(r, str) else r
+            if len(recording) < window:
+                logging.warning("Skipping {} ({} samples, shorter than a window of {})".format(
+                    getattr(recording, "path", "recording"), len(recording), window))
+                continue
+            self.recordings.append(recording)
+        if not self.recordings:
+            raise ValueError("No recording has a window of {} samples".format(window))
+        self.window = window
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.dtype = dtype
+        self.prefetch = prefetch
+        self.workers = workers
+        self.rng = np.random.default_rng(seed)
+
+        # (n_windows, n_channels, window) views on the memory maps
+        self._windows = [sliding_window_view(r.channels, window, axis=0) for r in self.recordings]
+        # each window is identified by (recording, start sample)
+        starts = [np.arange(0, len(r) - window + 1, stride) for r in self.recordings]
+        self._recording_index = np.concatenate([np.full(len(s), i) for i, s in enumerate(starts)]).astype(np.int64)
+        self._starts = np.concatenate(starts).astype(np.int64)
+        self._labels = None
+        if labels is not None:
+            self._labels = np.concatenate([self._window_labels(labels, r, s) for r, s in zip(self.recordings, starts)])
+
+    def _window_labels(self, labels, recording, starts):
+        if callable(labels):
+            return np.asarray(labels(recording, starts))
+        return np.asarray(recording[labels][starts + self.window - 1])
+
+    @property
+    def n_windows(self):
+        return len(self._starts)
+
+    def __len__(self):
+        """ Number of batches per epoch """
+        if self.drop_last:
+            return self.n_windows // self.batch_size
+        return -(-self.n_windows // self.batch_size)
+
+    def batch(self, indices):
+        """ Read the windows with the given (global) indices, returns (windows, labels) or windows """
+        indices = np.sort(indices)
+        out = np.empty((len(indices),) + self._windows[0].shape[1:], dtype=self.dtype)
+        recordings = self._recording_index[indices]
+        # sorted, so the windows of each recording are a contiguous run of the batch
+        bounds = np.flatnonzero(np.diff(recordings)) + 1
+        for a, b in zip(np.r_[0, bounds], np.r_[bounds, len(indices)]):
+            windows, starts = self._windows[recordings[a]], self._starts[indices[a:b]]
+            if windows.dtype == out.dtype:
+                np.take(windows, starts, axis=0, out=out[a:b])
+            else:
+                for k, start in enumerate(starts):
+                    out[a+k] = windows[start]
+        if self._labels is None:
+            return out
+        return out, self._labels[indices]
+
+    def __iter__(self):
+        """ One epoch of batches, prefetched in the background """
+        order = self.rng.permutation(self.n_windows) if self.shuffle else np.arange(self.n_windows)
+        batches = [order[i:i+self.batch_size] for i in range(0, len(order), self.batch_size)]
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches.pop()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            pending = [pool.submit(self.batch, b) for b in batches[:self.prefetch]]
+            for i in range(len(batches)):
+                if i + self.prefetch < len(batches):
+                    pending.append(pool.submit(self.batch, batches[i + self.prefetch]))
+                yield pending[i].result()
+                pending[i] = None
@@ -0,0 +1,167 @@
+import csv
+import logging
+import time
+
+from twisted.internet import task
+
+
+class StreamMetrics(object):
+    """ Health of a notification stream: packet rate, lost samples, jitter & callback times
+
+    `record` is called from the notification handler for every packet and only
+    does a few integer operations: counters, sums of the inter-arrival times of
+    the current one second window and a log2 histogram of the callback execution
+    times. There is a single writer (the reactor), so no locks are needed;
+    readers pull a consistent enough `snapshot` at any time, or let
+    `start_reporting` log it / append it to a CSV file periodically.
+
+    Rates and jitter refer to the last complete window; lost samples are taken
+    from the SampleClock (if timestamps are enabled). The attributes are only
+    updated when packets arrive: `snapshot` also closes the current window at
+    the time it is taken, so a stalled stream shows falling rates (0 after a
+    silent window) and a growing `since_last_packet`.
+
+    Usage:
+
+        await t.start_listening(data_callback, block_size=32)
+        t.metrics.start_reporting(10, csv_path="metrics.csv")
+        t.metrics.packet_rate
+        t.metrics.snapshot()
+    """
+    WINDOW = 1000000000
+
+    def __init__(self, clock=None):
+        self.clock = clock
+        self._reporter = None
+        self._csv_path = None
+        self.reset()
+
+    def reset(self):
+        self.packets = 0
+        self.samples = 0
+        self.errors = 0
+        # histogram of callback times: bin k counts durations of [2**(k-1), 2**k) ns
+        self.callback_histogram = [0]*40
+        self.max_callback = 0
+        self.max_interval = 0
+        # statistics of the last complete window
+        self.packet_rate = 0.0
+        self.sample_rate = 0.0
+        self.jitter = 0.0
+        self.mean_interval = 0.0
+        self._last_arrival = 0
+        self._window_end = 0
+        self._window_packets = self._window_samples = 0
+        self._window_n = self._window_sum = self._window_sumsq = 0
+
+    def record(self, n_samples, arrival, duration):
+        """ Count a packet of `n_samples` samples that arrived at `arrival` (ns, time.monotonic_ns)
+        and whose handling took `duration` ns """
+        self.packets += 1
+        self.samples += n_samples
+        self.callback_histogram[min(duration.bit_length(), 39)] += 1
+        if duration > self.max_callback:
+            self.max_callback = duration
+        if self._last_arrival:
+            interval = arrival - self._last_arrival
+            self._window_n += 1
+            self._window_sum += interval
+            self._window_sumsq += interval*interval
+            if interval > self.max_interval:
+                self.max_interval = interval
+        else:
+            self._window_end = arrival + self.WINDOW
+        self._last_arrival = arrival
+        if arrival >= self._window_end:
+            self._roll(arrival)
+
+    def _roll(self, arrival):
+        """ Close the current window """
+        seconds = (arrival - self._window_end + self.WINDOW) / 1e9
+        self.packet_rate = (self.packets - self._window_packets) / seconds
+        self.sample_rate = (self.samples - self._window_samples) / seconds
+        if self._window_n:
+            mean = self._window_sum / self._window_n
+            self.mean_interval = mean / 1e6
+            self.jitter = max(self._window_sumsq / self._window_n - mean*mean, 0.0)**0.5 / 1e6
+        self._window_packets, self._window_samples = self.packets, self.samples
+        self._window_n = self._window_sum = self._window_sumsq = 0
+        self._window_end = arrival + self.WINDOW
+
+    def error(self, e):
+        """ Count an exception raised while handling a packet; logs the 1st, 2nd, 4th, 8th, ... """
+        self.errors += 1
+        if self.errors & (self.errors - 1) == 0:
+            logging.warning("Encountered exception in data callback method ({} so far): {}".format(self.errors, e))
+
+    @property
+    def lost(self):
+        return self.clock.lost if self.clock is not None else 0
+
+    def callback_percentile(self, q):
+        """ Upper bound (us) of the `q`th percentile of the callback times, from the histogram """
+        total = sum(self.callback_histogram)
+        if total == 0:
+            return 0.0
+        count = 0
+        for k, n in enumerate(self.callback_histogram):
+            count += n
+            if count >= total*q/100:
+                return 2**k / 1e3
+        return 2**(len(self.callback_histogram)-1) / 1e3
+
+    def snapshot(self, now=None):
+        """ Current values of all metrics at `now` (default: time.monotonic_ns(); times in ms,
+        callback times in us) """
+        now = time.monotonic_ns() if now is None else now
+        packet_rate, sample_rate, jitter = self.packet_rate, self.sample_rate, self.jitter
+        since_last_packet = (now - self._last_arrival) if self._last_arrival else 0
+        if self._last_arrival and now >= self._window_end:
+            # no packet closed the window in time: rates over the window up to now
+            seconds = (now - self._window_end + self.WINDOW) / 1e9
+            packet_rate = (self.packets - self._window_packets) / seconds
+            sample_rate = (self.samples - self._window_samples) / seconds
+            if since_last_packet > self.WINDOW:
+                packet_rate = sample_rate = jitter = 0.0
+        return {
+            "time": now,
+            "packets": self.packets,
+            "samples": self.samples,
+            "lost": self.lost,
+            "errors": self.errors,
+            "packet_rate": packet_rate,
+            "sample_rate": sample_rate,
+            "mean_interval": self.mean_interval,
+            "jitter": jitter,
+            "max_interval": max(self.max_interval, since_last_packet) / 1e6,
+            "since_last_packet": since_last_packet / 1e6,
+            "callback_p50": self.callback_percentile(50),
+            "callback_p99": self.callback_percentile(99),
+            "max_callback": self.max_callback / 1e3,
+            "callback_histogram": list(self.callback_histogram),
+        }
+
+    def report(self):
+        snapshot = self.snapshot()
+        logging.info("Stream: {packet_rate:.1f} packets/s, {sample_rate:.1f} samples/s, {lost} lost, {errors} errors, "
+                     "jitter {jitter:.2f}ms (max interval {max_interval:.1f}ms, last packet {since_last_packet:.0f}ms ago), "
+                     "callback {callback_p50:.0f}/{callback_p99:.0f}us (p50/p99)".format(**snapshot))
+        if self._csv_path is not None:
+            del snapshot["callback_histogram"]
+            with open(self._csv_path, "a", newline="") as f:
+                writer = csv.DictWriter(f, fieldnames=list(snapshot))
+                if f.tell() == 0:
+                    writer.writeheader()
+                writer.writerow(snapshot)
+
+    def start_reporting(self, interval=10, csv_path=None):
+        """ Log the metrics every `interval` seconds and append them to `csv_path` if given """
+        self.stop_reporting()
+        self._csv_path = csv_path
+        self._reporter = task.LoopingCall(self.report)
+        self._reporter.start(interval, now=False)
+
+    def stop_reporting(self):
+        if self._reporter is not None and self._reporter.running:
+            self._reporter.stop()
+        self._reporter = None
@@ -0,0 +1,325 @@
+import logging
+import multiprocessing
+import threading
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# header fields (int64)
+RESERVED, WRITTEN, CLOSED, PRESSURE = range(4)
+HEADER_SIZE = 8
+# per consumer fields (int64)
+CURSOR, START, OVERRUNS, ERRORS, ACTIVE = range(5)
+CONSUMER_SIZE = 5
+
+
+class SharedRing(object):
+    """ Single-producer, multi-consumer ring buffer of samples & timestamps in shared memory
+
+    The producer (the reactor) only copies blocks into the ring and never waits
+    for a consumer. Every consumer (see Worker) has its own read cursor in the
+    shared header and reads at its own pace, from a thread or another process.
+
+    A consumer that falls more than `length` samples behind loses the oldest
+    samples: they are counted as its `overruns` and it continues with the oldest
+    samples still in the ring. The producer publishes `reserved` (before copying a
+    block) and `written` (after copying), so a consumer detects samples that were
+    overwritten while it copied them (seqlock style) and never returns torn
+    data. Whenever the backlog of the slowest consumer exceeds `high_water` (a
+    fraction of `length`) the `pressure` counter is increased and `on_pressure`
+    (if given) is called with the backlog, e.g. to lower the display rate.
+
+    The ring is described by `spec` (a picklable dict), which is used to attach
+    to it from processes started with multiprocessing.
+
+    Usage:
+
+        ring = SharedRing(2**16, 8)
+        slot = ring.add_consumer()
+        ring.write(block, timestamps)                   # (N, 8), (N,) int64
+        samples, timestamps = ring.read(slot, 256)      # in the consumer
+        ring.close(); ring.unlink()
+    """
+    def __init__(self, length, n_channels, dtype='<i2', max_consumers=8, high_water=0.5, on_pressure=None, name=None):
+        self.length = length
+        self.n_channels = n_channels
+        self.dtype = np.dtype(dtype)
+        self.max_consumers = max_consumers
+        self.high_water = int(high_water*length)
+        self.on_pressure = on_pressure
+        self._pressure = False
+
+        size = 8*(HEADER_SIZE + CONSUMER_SIZE*max_consumers + length) + length*n_channels*self.dtype.itemsize
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        offset = 0
+        self.header = np.ndarray(HEADER_SIZE, dtype=np.int64, buffer=self.shm.buf, offset=offset)
+        offset += 8*HEADER_SIZE
+        self.consumers = np.ndarray((max_consumers, CONSUMER_SIZE), dtype=np.int64, buffer=self.shm.buf, offset=offset)
+        offset += 8*CONSUMER_SIZE*max_consumers
+        self.timestamps = np.ndarray(length, dtype=np.int64, buffer=self.shm.buf, offset=offset)
+        offset += 8*length
+        self.data = np.ndarray((length, n_channels), dtype=self.dtype, buffer=self.shm.buf, offset=offset)
+        if self.owner:
+            self.header[:] = 0
+            self.consumers[:] = 0
+        # per consumer output buffers (of this process), see read
+        self._out = {}
+
+    @property
+    def spec(self):
+        return {"name": self.shm.name, "length": self.length, "n_channels": self.n_channels,
+                "dtype": self.dtype.str, "max_consumers": self.max_consumers}
+
+    @classmethod
+    def attach(cls, spec):
+        """ Open the ring described by `spec` (created by another process) """
+        return cls(**spec)
+
+    @property
+    def written(self):
+        return int(self.header[WRITTEN])
+
+    @property
+    def closed(self):
+        return bool(self.header[CLOSED])
+
+    @property
+    def pressure(self):
+        return int(self.header[PRESSURE])
+
+    def add_consumer(self):
+        """ Register a consumer, which starts reading at the next sample written. Returns its slot.
+        (Consumers have to be added by the producer, i.e. before starting the workers.) """
+        free = np.flatnonzero(self.consumers[:,ACTIVE] == 0)
+        if len(free) == 0:
+            raise Exception("No more than {} consumers supported.".format(self.max_consumers))
+        slot = int(free[0])
+        self.consumers[slot] = 0
+        self.consumers[slot,CURSOR] = self.consumers[slot,START] = self.header[WRITTEN]
+        self.consumers[slot,ACTIVE] = 1
+        return slot
+
+    def remove_consumer(self, slot):
+        self.consumers[slot,ACTIVE] = 0
+
+    def backlog(self, slot=None):
+        """ Samples written but not read yet by consumer `slot` (default: the slowest active consumer) """
+        if slot is not None:
+            return int(self.header[WRITTEN] - self.consumers[slot,CURSOR])
+        active = self.consumers[:,ACTIVE] == 1
+        if not active.any():
+            return 0
+        return int(self.header[WRITTEN] - self.consumers[active,CURSOR].min())
+
+    def write(self, block, timestamps):
+        """ Append an (N, n_channels) block and its (N,) timestamps, overwriting the oldest samples """
+        n = len(block)
+        if n > self.length:
+            block, timestamps, n = block[-self.length:], timestamps[-self.length:], self.length
+        start = int(self.header[WRITTEN])
+        self.header[RESERVED] = start + n
+        i = start % self.length
+        k = min(n, self.length - i)
+        self.data[i:i+k] = block[:k]
+        self.timestamps[i:i+k] = timestamps[:k]
+        if k < n:
+            self.data[:n-k] = block[k:]
+            self.timestamps[:n-k] = timestamps[k:]
+        self.header[WRITTEN] = start + n
+
+        backlog = self.backlog()
+        if backlog > self.high_water:
+            if not self._pressure:
+                self._pressure = True
+                self.header[PRESSURE] += 1
+                if self.on_pressure is not None:
+                    self.on_pressure(backlog)
+        else:
+            self._pressure = False
+
+    def read(self, slot, max_n):
+        """ Up to `max_n` of the samples consumer `slot` has not read yet, as (samples, timestamps).
+
+        The arrays are views of buffers owned by the consumer, which are reused by the next read.
+        """
+        if slot not in self._out:
+            self._out[slot] = (np.empty((max_n, self.n_channels), dtype=self.dtype), np.empty(max_n, dtype=np.int64))
+        out, timestamps_out = self._out[slot]
+        if len(out) < max_n:
+            out, timestamps_out = self._out[slot] = (np.empty((max_n, self.n_channels), dtype=self.dtype),
+                                                     np.empty(max_n, dtype=np.int64))
+
+        consumer = self.consumers[slot]
+        cursor = int(consumer[CURSOR])
+        written = int(self.header[WRITTEN])
+        if cursor < written - self.length:
+            consumer[OVERRUNS] += written - self.length - cursor
+            cursor = written - self.length
+        n = min(written - cursor, max_n)
+        i = cursor % self.length
+        k = min(n, self.length - i)
+        out[:k] = self.data[i:i+k]
+        timestamps_out[:k] = self.timestamps[i:i+k]
+        out[k:n] = self.data[:n-k]
+        timestamps_out[k:n] = self.timestamps[:n-k]
+
+        # samples the producer (started to) overwrite while they were copied
+        torn = min(int(self.header[RESERVED]) - self.length - cursor, n)
+        if torn > 0:
+            consumer[OVERRUNS] += torn
+            consumer[CURSOR] = cursor + n
+            return out[torn:n], timestamps_out[torn:n]
+        consumer[CURSOR] = cursor + n
+        return out[:n], timestamps_out[:n]
+
+    def stats(self, slot):
+        consumer = self.consumers[slot]
+        return {
+            "processed": int(consumer[CURSOR] - consumer[START] - consumer[OVERRUNS]),
+            "backlog": self.backlog(slot),
+            "overruns": int(consumer[OVERRUNS]),
+            "errors": int(consumer[ERRORS]),
+        }
+
+    def close(self):
+        """ Mark the stream as finished: consumers exit once they have read all samples """
+        self.header[CLOSED] = 1
+
+    def release(self):
+        """ Unmap the shared memory (of this process) """
+        self.header = self.consumers = self.timestamps = self.data = None
+        self._out = {}
+        self.shm.close()
+
+    def unlink(self):
+        self.release()
+        if self.owner:
+            self.shm.unlink()
+
+
+def consume(ring, slot, function, block_size=256, poll_interval=0.005):
+    """ Worker loop: pass blocks of up to `block_size` new samples to `function(samples, timestamps)`
+    until the ring is closed & drained. `ring` is a SharedRing or its spec. Calls `function.close()`
+    at the end, if it exists. """
+    attached = isinstance(ring, dict)
+    if attached:
+        ring = SharedRing.attach(ring)
+    try:
+        while True:
+            samples, timestamps = ring.read(slot, block_size)
+            if len(samples):
+                try:
+                    function(samples, timestamps)
+                except Exception as e:
+                    ring.consumers[slot,ERRORS] += 1
+                    errors = int(ring.consumers[slot,ERRORS])
+                    if errors & (errors - 1) == 0:
+                        logging.warning("Encountered exception in worker {} ({} so far): {}".format(slot, errors, e))
+            elif ring.closed and ring.backlog(slot) == 0:
+                break
+            else:
+                time.sleep(poll_interval)
+    finally:
+        close = getattr(function, "close", None)
+        if close is not None:
+            close()
+        if attached:
+            ring.release()
+
+
+class Worker(object):
+    """ A consumer of a SharedRing, running `function(samples, timestamps)` in a thread or (with
+    `process`) a separate process, see `consume`.
+
+    A process needs a picklable `function` (e.g. an instance of a module level class) and
+    creates its own resources (files, filter states, models) on its first call. Threads are
+    enough for work that releases the GIL (numpy, file I/O); pure Python work scales across
+    cores only in processes.
+    """
+    def __init__(self, ring, function, block_size=256, poll_interval=0.005, process=False, name=None):
+        self.ring = ring
+        self.slot = ring.add_consumer()
+        self.name = name or getattr(function, "__name__", type(function).__name__)
+        if process:
+            self._runner = multiprocessing.Process(target=consume, name=self.name, daemon=True,
+                    args=(ring.spec, self.slot, function, block_size, poll_interval))
+        else:
+            self._runner = threading.Thread(target=consume, name=self.name, daemon=True,
+                    args=(ring, self.slot, function, block_size, poll_interval))
+
+    def start(self):
+        self._runner.start()
+
+    def join(self, timeout=None):
+        self._runner.join(timeout)
+        if self._runner.is_alive():
+            logging.warning("Worker {} did not finish within {}s.".format(self.name, timeout))
+
+    def stats(self):
+        return self.ring.stats(self.slot)
+
+
+class Pipeline(object):
+    """ Processing of the sample stream off the reactor
+
+    `write(block, timestamps)` is the data callback of Traumschreiber.start_listening
+    (with timestamps=True): it only copies the block into a SharedRing. Filtering,
+    feature extraction, classification, recording etc. run in workers (threads or
+    processes), each reading the ring at its own pace, so slow processing neither
+    delays the DBus dispatch nor the other workers. `stats()` reports backlog and
+    overruns (samples a worker lost by falling behind) per worker.
+
+    Usage:
+
+        with Pipeline(n_channels=8) as pipeline:
+            pipeline.add(record)                            # record(samples, timestamps), thread
+            pipeline.add(Classifier(), process=True)
+            pipeline.start()
+            await t.start_listening(pipeline.write, block_size=32, timestamps=True)
+            ...
+            pipeline.stats()
+    """
+    def __init__(self, n_channels=8, length=2**16, dtype='<i2', high_water=0.5, on_pressure=None):
+        self.ring = SharedRing(length, n_channels, dtype, high_water=high_water, on_pressure=on_pressure)
+        self.workers = []
+        self.write = self.ring.write
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def add(self, function, process=False, block_size=256, poll_interval=0.005, name=None):
+        worker = Worker(self.ring, function, block_size, poll_interval, process, name)
+        self.workers.append(worker)
+        return worker
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self, timeout=5):
+        """ Let the workers process the remaining samples, then free the shared memory """
+        if self.ring.header is None:
+            return
+        self.ring.close()
+        for worker in self.workers:
+            worker.join(timeout)
+        for worker in self.workers:
+            stats = worker.stats()
+            if stats["overruns"]:
+                logging.warning("Worker {} lost {} samples (overruns).".format(worker.name, stats["overruns"]))
+        self.ring.unlink()
+
+    def stats(self):
+        return {
+            "written": self.ring.written,
+            "pressure": self.ring.pressure,
+            "workers": {worker.name: worker.stats() for worker in self.workers},
+        }
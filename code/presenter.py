@@ -0,0 +1,218 @@
+import logging
+import multiprocessing
+import queue
+import threading
+
+import numpy as np
+
+from pipeline import SharedRing, OVERRUNS
+from utils import async_sleep, run_blocking
+
+# RemoteDecoder calls
+RESET, ADD_FLASH = range(2)
+CALL_FIELDS = ("method", "col", "num")
+DECODER_FIELDS = ("trial", "decided", "prediction", "n_flashes")
+
+
+class EventChannel(object):
+    """ Timestamped records of integer fields through a SharedRing, from one process or thread
+    to another. Has the `append` of recording.EventLog, so an experiment can log to it directly.
+
+    Usage:
+
+        channel = EventChannel(EVENT_FIELDS)
+        channel.append(t, kind=1, row=2)                # producer
+        for t, fields in channel.poll(): ...            # consumer
+    """
+    def __init__(self, fields, length=4096, ring=None):
+        self.fields = list(fields)
+        if ring is None:
+            self.ring = SharedRing(length, len(self.fields), np.int64, max_consumers=1)
+            self.slot = self.ring.add_consumer()
+        else:
+            self.ring = SharedRing.attach(ring)
+            self.slot = 0
+        self._row = np.zeros((1, len(self.fields)), dtype=np.int64)
+        self._timestamp = np.zeros(1, dtype=np.int64)
+
+    @property
+    def spec(self):
+        return {"fields": self.fields, "ring": self.ring.spec}
+
+    @classmethod
+    def attach(cls, spec):
+        """ Open the channel described by `spec` (created by another process or thread) """
+        return cls(**spec)
+
+    def append(self, timestamp, **fields):
+        self._row[0] = [fields.get(name, 0) for name in self.fields]
+        self._timestamp[0] = timestamp
+        self.ring.write(self._row, self._timestamp)
+
+    def poll(self, max_n=256):
+        """ Records appended since the last poll, as a list of (timestamp, {field: value}) """
+        records, timestamps = self.ring.read(self.slot, max_n)
+        return [(int(t), dict(zip(self.fields, row.tolist()))) for row, t in zip(records, timestamps)]
+
+    @property
+    def overruns(self):
+        return int(self.ring.consumers[self.slot, OVERRUNS])
+
+    def release(self):
+        self.ring.release()
+
+    def unlink(self):
+        self.ring.unlink()
+
+
+class RemoteDecoder(object):
+    """ Stands in for the experiment's `decoder` (an OnlineSpeller, see bci_grid.decoder) in the
+    presenter: `reset` & `add_flash` are forwarded to the real decoder, `decided`, `prediction`
+    & `n_flashes` are the latest state it published (of the current trial). The prediction is
+    published as a flat index into `grid_shape` and returned as (row, col), like the decoder's. """
+    def __init__(self, calls, state, grid_shape):
+        self.calls = calls
+        self.state = state
+        self.grid_shape = tuple(grid_shape)
+        self.trial = 0
+        self._state = dict.fromkeys(DECODER_FIELDS[1:], 0)
+        self._state["prediction"] = -1
+
+    def reset(self):
+        self.trial += 1
+        self._state.update(decided=0, prediction=-1, n_flashes=0)
+        self.calls.append(0, method=RESET)
+
+    def add_flash(self, t, rowcol, num):
+        self.calls.append(t, method=ADD_FLASH, col=int(rowcol == "col"), num=num)
+
+    def _update(self):
+        for _, state in self.state.poll():
+            if state["trial"] == self.trial:
+                self._state.update(state)
+
+    @property
+    def decided(self):
+        self._update()
+        return bool(self._state["decided"])
+
+    @property
+    def prediction(self):
+        self._update()
+        if self._state["prediction"] < 0:
+            return None
+        return np.unravel_index(self._state["prediction"], self.grid_shape)
+
+    @property
+    def n_flashes(self):
+        self._update()
+        return self._state["n_flashes"]
+
+
+def _present(experiment, kwargs, events, calls, state, grid_shape, results):
+    """ Presenter thread / process: run the experiment without the reactor, with the channels
+    described by the specs `events`, `calls` & `state` (or None) """
+    channels = [EventChannel.attach(spec) for spec in (events, calls, state) if spec is not None]
+    try:
+        if events is not None:
+            kwargs["events"] = channels[0]
+        if calls is not None:
+            kwargs["decoder"] = RemoteDecoder(channels[-2], channels[-1], grid_shape)
+        results.put((True, run_blocking(experiment(**kwargs))))
+    except Exception as e:
+        logging.exception("Stimulus presentation failed")
+        results.put((False, repr(e)))
+    finally:
+        for channel in channels:
+            channel.release()
+
+
+class Presenter(object):
+    """ Runs a stimulus presentation (e.g. bci_grid.experiment.experiment) in its own thread or,
+    with `process`, its own process, off the reactor that receives the samples
+
+    The experiment coroutine runs under utils.run_blocking there, so its display flips (which
+    block until the vertical sync) and event polling neither delay sample delivery nor get
+    delayed by it. Its `events` are published through an EventChannel (shared memory) and
+    appended to `events` (an EventLog) on the reactor; flip times are time.monotonic_ns, the
+    clock of the sample timestamps (see Traumschreiber.SampleClock), so stimuli stay aligned
+    to the sample stream. A `decoder` (OnlineSpeller) stays on the reactor, where the samples
+    are: the experiment gets a RemoteDecoder, whose state is updated every `poll_interval`.
+    The decoder needs a `grid_shape` (see OnlineSpeller).
+
+    A process needs the fork start method (the default on Linux): the experiment scripts
+    start the reactor at import time.
+
+    Usage:
+
+        presenter = Presenter(experiment, events=events, decoder=speller, targets="HELLO")
+        stats = await presenter.run()
+    """
+    def __init__(self, experiment, events=None, decoder=None, process=True, poll_interval=0.005, **kwargs):
+        self.experiment = experiment
+        self.events = events
+        self.decoder = decoder
+        self.process = process
+        self.poll_interval = poll_interval
+        self.kwargs = kwargs
+        self.channel = self.calls = self.state = None
+        self._published = None
+        self._trial = 0
+
+        if events is not None:
+            self.channel = EventChannel(events.fields)
+        if decoder is not None:
+            self.calls = EventChannel(CALL_FIELDS)
+            self.state = EventChannel(DECODER_FIELDS)
+
+        grid_shape = None if decoder is None else tuple(decoder.grid_shape)
+        specs = [None if channel is None else channel.spec for channel in (self.channel, self.calls, self.state)]
+        if process:
+            self._results = multiprocessing.SimpleQueue()
+            self._runner = multiprocessing.Process(target=_present, name="Presenter", daemon=True,
+                    args=(experiment, kwargs, *specs, grid_shape, self._results))
+        else:
+            self._results = queue.SimpleQueue()
+            self._runner = threading.Thread(target=_present, name="Presenter", daemon=True,
+                    args=(experiment, kwargs, *specs, grid_shape, self._results))
+
+    def poll(self):
+        """ Hand the presenter's events & decoder calls to the reactor side, publish the decoder's state """
+        if self.channel is not None:
+            for t, fields in self.channel.poll():
+                self.events.append(t, **fields)
+        if self.decoder is not None:
+            for t, call in self.calls.poll():
+                if call["method"] == RESET:
+                    self._trial += 1
+                    self.decoder.reset()
+                else:
+                    self.decoder.add_flash(t, "col" if call["col"] else "row", call["num"])
+            prediction = self.decoder.prediction
+            prediction = -1 if prediction is None else int(np.ravel_multi_index(prediction, self.decoder.grid_shape))
+            state = (self._trial, int(self.decoder.decided), prediction, self.decoder.n_flashes)
+            if state != self._published:
+                self.state.append(0, **dict(zip(DECODER_FIELDS, state)))
+                self._published = state
+
+    async def run(self):
+        """ Start the presentation & wait for it to finish, returns the experiment's result """
+        self._runner.start()
+        try:
+            while self._runner.is_alive():
+                self.poll()
+                await async_sleep(self.poll_interval)
+            self._runner.join()
+            self.poll()
+        finally:
+            for channel in (self.channel, self.calls, self.state):
+                if channel is not None:
+                    if channel.overruns:
+                        logging.warning("Lost {} presenter events.".format(channel.overruns))
+                    channel.unlink()
+        if self._results.empty():
+            raise Exception("Stimulus presentation exited without a result.")
+        success, result = self._results.get()
+        if not success:
+            raise Exception("Stimulus presentation failed: {}".format(result))
+        return result
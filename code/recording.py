@@ -0,0 +1,393 @@
+import json
+import logging
+import os
+import queue
+import struct
+import threading
+import time
+
+import numpy as np
+import pandas
+
+
+class ColumnStore(object):
+    """ Growable, preallocated column-oriented table
+
+    Every column is a typed numpy array with room for `capacity` rows. Rows are
+    written in place, so appending does not allocate until the capacity is
+    exhausted; then all columns double in size (amortized O(1) per row).
+
+    Usage:
+
+        store = ColumnStore({"timestamp": (np.int64, ()), "channels": (np.int16, (9,))})
+        store.append(timestamp=0, channels=np.zeros(9))
+        store.extend(timestamp=np.arange(10), channels=np.zeros((10,9)))
+        store["channels"]   # view on the (11,9) rows written so far
+    """
+
+    def __init__(self, columns, capacity=1024):
+        """ Preallocate `capacity` rows for each column in `columns`, a dict mapping
+        column names to (dtype, shape) tuples, where shape is the shape of one row.
+        """
+        self.capacity = max(int(capacity), 1)
+        self.size = 0
+        self._data = {name: np.zeros((self.capacity,)+tuple(shape), dtype=dtype)
+                for name, (dtype, shape) in columns.items()}
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, name):
+        """ Returns a view on the rows of column `name` written so far """
+        return self._data[name][:self.size]
+
+    @property
+    def columns(self):
+        return list(self._data.keys())
+
+    def reserve(self, n):
+        """ Make sure there is room for `n` more rows, growing all columns if needed """
+        needed = self.size + n
+        if needed <= self.capacity:
+            return
+        capacity = self.capacity
+        while capacity < needed:
+            capacity *= 2
+        for name, arr in self._data.items():
+            grown = np.zeros((capacity,)+arr.shape[1:], dtype=arr.dtype)
+            grown[:self.size] = arr[:self.size]
+            self._data[name] = grown
+        self.capacity = capacity
+
+    def append(self, **values):
+        """ Append a single row; a value has to be given for every column """
+        if self.size == self.capacity:
+            self.reserve(1)
+        i = self.size
+        for name, arr in self._data.items():
+            arr[i] = values[name]
+        self.size += 1
+
+    def extend(self, n=None, **values):
+        """ Append a block of `n` rows. Values can be arrays with `n` rows or
+        scalars/single rows, which are broadcast over the block. If `n` is not
+        given, it is taken from the length of the first column's value.
+        """
+        if n is None:
+            n = len(values[next(iter(self._data))])
+        self.reserve(n)
+        i = self.size
+        for name, arr in self._data.items():
+            arr[i:i+n] = values[name]
+        self.size += n
+
+    def clear(self):
+        """ Forget all rows, but keep the allocated memory """
+        self.size = 0
+
+    def _frame_columns(self):
+        """ Flattens the columns into a dict of 1D views (one per DataFrame column) """
+        frame_columns = {}
+        for name, arr in self._data.items():
+            arr = arr[:self.size]
+            if arr.ndim == 1:
+                frame_columns[name] = arr
+            else:
+                flat = arr.reshape((self.size, -1))
+                for i in range(flat.shape[1]):
+                    frame_columns["{}{}".format(name, i)] = flat[:,i]
+        return frame_columns
+
+    def to_dataframe(self, index=None):
+        """ Returns a pandas DataFrame backed by (not copied from) the stored columns.
+
+        Multi-dimensional columns are split into one DataFrame column per entry,
+        named e.g. "channel0", "channel1", ... Since the frame shares memory with
+        the store, it should not be used across further appends that grow the store.
+        """
+        frame_columns = self._frame_columns()
+        if index is not None:
+            index = frame_columns.pop(index)
+        return pandas.DataFrame(frame_columns, index=index, copy=False)
+
+
+def dense_labels(event_timestamps, event_values, timestamps, default=0):
+    """ Expand sparse events into one value per sample
+
+    Every sample (given by `timestamps`) gets the value of the last event at or
+    before its timestamp, or `default` if there was none yet. Event timestamps
+    have to be sorted.
+    """
+    idx = np.searchsorted(event_timestamps, timestamps, side="right") - 1
+    event_values = np.asarray(event_values)
+    out = np.empty((len(idx),)+event_values.shape[1:], dtype=event_values.dtype)
+    if len(event_values):
+        np.take(event_values, idx, axis=0, out=out, mode="clip")
+    out[idx < 0] = default
+    return out
+
+
+class EventLog(ColumnStore):
+    """ Sparse table of stimulus events keyed by (monotonic, ns) timestamp
+
+    Instead of copying the stimulus state into every sample, one row is stored
+    per change of the state (e.g. flash onset/offset). Dense per-sample labels
+    are only built on request with `dense`. If `path` is given, events are also
+    streamed to disk as they are appended (see RecordingWriter, without channels).
+
+    Usage:
+
+        events = EventLog({"highlighted": (np.bool_, ()), "interval": (np.int32, ())}, path="events.bin")
+        events.append(flip_time, highlighted=True, interval=3)
+        labels = events.dense("highlighted", recording.timestamps)
+    """
+
+    def __init__(self, fields, capacity=1024, path=None, **meta):
+        columns = {"timestamp": (np.int64, ())}
+        columns.update(fields)
+        super().__init__(columns, capacity)
+        self.fields = fields
+        self.writer = RecordingWriter(path, n_channels=0, labels=fields, block_size=1, **meta) if path else None
+
+    def append(self, timestamp, **fields):
+        super().append(timestamp=timestamp, **fields)
+        if self.writer is not None:
+            self.writer.write(1, timestamp=timestamp, **fields)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+    def dense(self, name, timestamps, default=0):
+        """ Value of event field `name` for every sample timestamp (see dense_labels) """
+        return dense_labels(self["timestamp"], self[name], timestamps, default)
+
+    def to_dataframe(self):
+        """ Returns the events as a pandas DataFrame indexed by (monotonic) timestamp """
+        frame_columns = self._frame_columns()
+        index = pandas.DatetimeIndex(frame_columns.pop("timestamp").view("datetime64[ns]"),
+                copy=False, name="timestamp")
+        return pandas.DataFrame(frame_columns, index=index, copy=False)
+
+
+MAGIC = b"TFLOWREC"
+VERSION = 1
+
+
+def record_dtype(n_channels=9, labels=None):
+    """ Packed per-sample record layout used on disk: timestamp, channels (if any), labels """
+    fields = [("timestamp", "<i8", ())]
+    if n_channels:
+        fields.append(("channel", "<i2", (n_channels,)))
+    for name, (dtype, shape) in (labels or {}).items():
+        fields.append((name, np.dtype(dtype).str, tuple(shape)))
+    return np.dtype([(name, dtype, shape) for name, dtype, shape in fields])
+
+
+def _dtype_to_header(dtype):
+    return [{"name": name, "dtype": dtype.fields[name][0].base.str, "shape": list(dtype.fields[name][0].shape)}
+            for name in dtype.names]
+
+
+def _dtype_from_header(fields):
+    return np.dtype([(f["name"], f["dtype"], tuple(f["shape"])) for f in fields])
+
+
+class RecordingWriter(object):
+    """ Append-only, crash-safe recording file writer
+
+    Samples are collected into fixed-size blocks of packed records (see
+    `record_dtype`) which are handed to a background thread as soon as they are
+    full (or older than `max_latency` seconds) and written & flushed there. A
+    crash therefore loses at most the last unflushed block, and nothing expensive
+    happens at the end of a run. Files can be read with `read_recording`.
+
+    The file starts with a magic string, the header length and a JSON header
+    describing the record fields, channel names and any extra metadata (e.g. gain).
+    The header also stores `clock_offset`, the difference between the wall clock
+    and the monotonic clock (ns) when the file was created, to convert monotonic
+    sample timestamps (see Traumschreiber.SampleClock) to Unix time.
+
+    Usage:
+
+        writer = RecordingWriter("recording.bin", labels={"interval": (np.int32, ())}, gain=32)
+        writer.extend(reref_channels(data_in, 7), timestamp=time.time_ns(), interval=3)
+        writer.close()
+    """
+
+    def __init__(self, path, n_channels=9, labels=None, block_size=1024, max_latency=1.0, fsync=False, **meta):
+        self.path = path
+        self.dtype = record_dtype(n_channels, labels)
+        self.block_size = block_size
+        self.max_latency = max_latency
+        self.fsync = fsync
+        self.n_channels = n_channels
+        self.size = 0
+
+        header = dict(meta, version=VERSION, fields=_dtype_to_header(self.dtype),
+                channels=["channel{}".format(i) for i in range(n_channels or 0)],
+                clock_offset=time.time_ns() - time.monotonic_ns())
+        header = json.dumps(header).encode("utf-8")
+        # pad the header, such that records start at an 8 byte boundary
+        header += b" "*(-(len(MAGIC)+4+len(header)) % 8)
+
+        self._file = open(path, "wb")
+        self._file.write(MAGIC)
+        self._file.write(struct.pack("<I", len(header)))
+        self._file.write(header)
+        self._file.flush()
+
+        self._free = queue.Queue()
+        self._full = queue.Queue()
+        self._block = np.zeros(block_size, dtype=self.dtype)
+        self._n = 0
+        self._block_started = time.monotonic()
+        self._thread = threading.Thread(target=self._write_blocks, name="RecordingWriter", daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.size
+
+    def _write_blocks(self):
+        while True:
+            item = self._full.get()
+            if item is None:
+                break
+            block, n = item
+            try:
+                self._file.write(block[:n].data)
+                self._file.flush()
+                if self.fsync:
+                    os.fsync(self._file.fileno())
+            except Exception as e:
+                logging.error("Failed writing block to {}: {}".format(self.path, e))
+            self._free.put(block)
+
+    def _hand_off(self):
+        """ Pass the current block to the writer thread and continue with a free one """
+        if self._n == 0:
+            return
+        self._full.put((self._block, self._n))
+        try:
+            self._block = self._free.get_nowait()
+        except queue.Empty:
+            self._block = np.zeros(self.block_size, dtype=self.dtype)
+        self._n = 0
+        self._block_started = time.monotonic()
+
+    def append(self, channels, timestamp, **labels):
+        """ Append one sample (`channels` of shape (n_channels,) or (1, n_channels)) """
+        self.extend(np.reshape(channels, (1, self.n_channels)), timestamp, **labels)
+
+    def extend(self, channels, timestamp, **labels):
+        """ Append a block of samples (`channels` of shape (N, n_channels)). Timestamps and labels
+        can be given per sample or once for the whole block.
+        """
+        self.write(len(channels), channel=channels, timestamp=timestamp, **labels)
+
+    def write(self, n, **values):
+        """ Append `n` records, with a value (per record or broadcast) for every field """
+        done = 0
+        while done < n:
+            k = min(n - done, self.block_size - self._n)
+            rows = self._block[self._n:self._n+k]
+            for name in self.dtype.names:
+                value = values[name]
+                rows[name] = value[done:done+k] if np.ndim(value) > rows[name].ndim-1 else value
+            self._n += k
+            done += k
+            if self._n == self.block_size:
+                self._hand_off()
+        self.size += n
+        if self._n and time.monotonic() - self._block_started > self.max_latency:
+            self._hand_off()
+
+    def flush(self):
+        """ Hand the samples collected so far to the writer thread """
+        self._hand_off()
+
+    def close(self):
+        """ Write all remaining samples and close the file """
+        if self._file.closed:
+            return
+        self._hand_off()
+        self._full.put(None)
+        self._thread.join()
+        self._file.close()
+
+
+class Recording(object):
+    """ Memory-mapped view on a file written by `RecordingWriter`
+
+    Nothing is read until it is accessed, so arbitrary sample ranges of long
+    recordings can be sliced without loading the whole file:
+
+        rec = read_recording("recording.bin")
+        rec.header["gain"]
+        rec.channels[1000:2000]     # (1000, n_channels) int16
+        rec[1000:2000]["interval"]
+        rec.to_dataframe(1000, 2000)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            magic = f.read(len(MAGIC))
+            if magic != MAGIC:
+                raise ValueError("{} is not a recording file".format(path))
+            header_len, = struct.unpack("<I", f.read(4))
+            self.header = json.loads(f.read(header_len).decode("utf-8"))
+        self.dtype = _dtype_from_header(self.header["fields"])
+
+        offset = len(MAGIC) + 4 + header_len
+        # a crash may have left a partially written record at the end; ignore it
+        n = (os.path.getsize(path) - offset) // self.dtype.itemsize
+        if n > 0:
+            self.records = np.memmap(path, dtype=self.dtype, mode="r", offset=offset, shape=(n,))
+        else:
+            self.records = np.zeros(0, dtype=self.dtype)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, idx):
+        return self.records[idx]
+
+    @property
+    def timestamps(self):
+        return self.records["timestamp"]
+
+    @property
+    def channels(self):
+        return self.records["channel"]
+
+    def to_dataframe(self, start=None, stop=None):
+        """ Loads samples [start, stop) into a pandas DataFrame indexed by timestamp (converted
+        to wall clock time using the header's `clock_offset`), with columns channel0, channel1,
+        ... and one column per label entry (like ColumnStore.to_dataframe).
+        """
+        records = self.records[start:stop]
+        frame_columns = {}
+        for name in self.dtype.names:
+            if name == "timestamp":
+                continue
+            values = np.asarray(records[name]).reshape((len(records), -1))
+            if self.dtype.fields[name][0].ndim == 0:
+                frame_columns[name] = values[:,0]
+            else:
+                for i in range(values.shape[1]):
+                    frame_columns["{}{}".format(name, i)] = values[:,i]
+        timestamps = records["timestamp"] + np.int64(self.header.get("clock_offset", 0))
+        index = pandas.DatetimeIndex(timestamps.view("datetime64[ns]"), name="timestamp")
+        return pandas.DataFrame(frame_columns, index=index)
+
+
+def read_recording(path):
+    """ Opens a recording file written by `RecordingWriter` (memory-mapped) """
+    return Recording(path)
@@ -0,0 +1,342 @@
+import logging
+import time
+
+import numpy as np
+from twisted.internet import reactor, defer, task
+
+try:
+    from scipy.signal import lfilter
+except ImportError:
+    lfilter = None
+
+from Traumschreiber import Traumschreiber, CommandQueue, async_sleep
+from recording import read_recording
+
+
+def potentials_to_raw(potentials):
+    """ Convert (N, 9) electrode potentials (any common reference, e.g. a rereferenced recording)
+    to the (N, 8) neighbour differences the device reports (inverse of utils.reref_block) """
+    return potentials[:, :-1] - potentials[:, 1:]
+
+
+class SyntheticEEG(object):
+    """ Generates (N, n_electrodes) electrode potentials in raw device units
+
+    Independent 1/f-like background noise on every electrode (low-passed white
+    noise), a 10Hz alpha rhythm, line noise and P300-like ERPs (a positive
+    Gaussian bump `erp_latency` seconds after a stimulus, strongest on the last
+    electrodes). ERPs are injected at the sample indices passed to `stimulus`,
+    and additionally at random with `erp_rate` ERPs per second.
+    """
+    SMOOTHING = 0.9
+
+    def __init__(self, sample_rate=250, n_electrodes=9, noise=20.0, alpha=10.0, line_noise=5.0, line_freq=50,
+                 erp_amplitude=30.0, erp_latency=0.3, erp_width=0.05, erp_rate=0.0, seed=None):
+        self.sample_rate = sample_rate
+        self.n_electrodes = n_electrodes
+        self.noise = noise
+        self.alpha = alpha
+        self.line_noise = line_noise
+        self.line_freq = line_freq
+        self.erp_rate = erp_rate
+        self.rng = np.random.default_rng(seed)
+        # index of the next sample
+        self.index = 0
+        self._smooth = np.zeros(n_electrodes)
+        self._alpha_phase = self.rng.uniform(0, 2*np.pi, n_electrodes)
+
+        t = np.arange(int(round((erp_latency + 3*erp_width)*sample_rate))) / sample_rate
+        self._erp = erp_amplitude * np.exp(-(t - erp_latency)**2 / (2*erp_width**2))[:,None] \
+                  * np.linspace(0.2, 1.0, n_electrodes)[None,:]
+        # onsets (sample indices) of ERPs that still affect future samples
+        self._onsets = []
+
+    def stimulus(self, index=None):
+        """ Inject an ERP with onset at sample `index` (default: the next sample) """
+        self._onsets.append(self.index if index is None else index)
+
+    def generate(self, n, out=None):
+        """ Returns the next `n` samples as an (n, n_electrodes) float array """
+        if out is None:
+            out = np.empty((n, self.n_electrodes))
+        t = np.arange(self.index, self.index + n)[:,None] / self.sample_rate
+
+        # background: white noise low-passed with a one-pole filter
+        white = self.rng.normal(0, self.noise*np.sqrt(1 - self.SMOOTHING**2), (n, self.n_electrodes))
+        if lfilter is not None:
+            out[...], zi = lfilter([1.0], [1.0, -self.SMOOTHING], white, axis=0, zi=self.SMOOTHING*self._smooth[None,:])
+        else:
+            out[0] = self.SMOOTHING*self._smooth + white[0]
+            for i in range(1, n):
+                out[i] = self.SMOOTHING*out[i-1] + white[i]
+        self._smooth[:] = out[n-1]
+
+        out += self.alpha * np.sin(2*np.pi*10*t + self._alpha_phase)
+        out += self.line_noise * np.sin(2*np.pi*self.line_freq*t)
+
+        if self.erp_rate:
+            for i in np.flatnonzero(self.rng.random(n) < self.erp_rate / self.sample_rate):
+                self.stimulus(self.index + i)
+        length = len(self._erp)
+        for onset in self._onsets:
+            start, stop = max(onset, self.index), min(onset + length, self.index + n)
+            if start < stop:
+                out[start-self.index:stop-self.index] += self._erp[start-onset:stop-onset]
+        self.index += n
+        self._onsets = [onset for onset in self._onsets if onset + length > self.index]
+        return out
+
+
+class SimulatedTraumschreiber(Traumschreiber):
+    """ Drop-in for Traumschreiber that does not need a device (or BlueZ/DBus)
+
+    The samples are either synthetic EEG (see SyntheticEEG, `source=None`) or
+    replayed from a recording written by recording.RecordingWriter (`source` is
+    its path; the rereferenced channels are converted back to raw device values),
+    delivered at `speed` times real time. They are packed into notifications of
+    `packet_size` samples (the packet rate is sample_rate*speed/packet_size) and
+    handed to the same decoding path as the device's notifications, so block
+    buffering, timestamps etc. behave as with the real device. In per-sample mode
+    (no `block_size`), every sample is its own notification, like on the device.
+
+    Packets are generated on the reactor every `tick` seconds (all packets due
+    since the last tick), so rates far above what the hardware produces can be
+    sustained. The SampleClock sees each packet arrive at the time it was due
+    rather than with its burst, so bursts are not mistaken for lost samples.
+
+    Usage:
+
+        async with SimulatedTraumschreiber(speed=10, packet_size=4) as t:
+            await t.start_listening(data_callback, block_size=32)
+            t.stimulus()        # inject an ERP (synthetic source only)
+    """
+    def __init__(self, addr=None, scan=0, sample_rate=250, source=None, speed=1.0, packet_size=1, tick=0.01,
+                 loop=True, **synthetic):
+        # the clock has to expect samples at the accelerated rate
+        super().__init__(addr=addr, scan=scan, sample_rate=sample_rate*speed)
+        self.signal_rate = sample_rate
+        self.speed = speed
+        self.packet_size = packet_size
+        self.tick = tick
+        self.loop = loop
+        if source is None:
+            self.synthetic = SyntheticEEG(sample_rate, **synthetic)
+            self.replay = None
+        else:
+            self.synthetic = None
+            self.replay = read_recording(source).channels
+        self.index = 0
+        # values written to the (simulated) config characteristic
+        self.settings = []
+        self.commands = CommandQueue(self._write_config)
+        self._tick_loop = None
+        self._notify = None
+        self._start = None
+        self._arrival = None
+
+    async def __aenter__(self):
+        logging.info("Connecting to simulated device...")
+        return self
+
+    async def __aexit__(self, *args):
+        await self.stop_listening()
+
+    def _write_config(self, value):
+        self.settings.append(value)
+        return defer.succeed(None)
+
+    def stimulus(self, timestamp=None):
+        """ Inject an ERP into the synthetic signal at monotonic `timestamp` (ns, default: now) """
+        if self.synthetic is None:
+            return
+        if timestamp is None or self._start is None:
+            self.synthetic.stimulus()
+            return
+        # sample delivered at `timestamp`, relative to the next sample to be generated
+        index = int(round((timestamp - self._start)/1e9 * self.sample_rate))
+        self.synthetic.stimulus(self.synthetic.index + index - self.index)
+
+    def _samples(self, n):
+        """ Next `n` raw (n, 8) int16 samples """
+        if self.synthetic is not None:
+            raw = potentials_to_raw(self.synthetic.generate(n))
+        else:
+            idx = np.arange(self.index, self.index + n)
+            if self.loop:
+                idx %= len(self.replay)
+            raw = potentials_to_raw(np.asarray(self.replay[idx[idx < len(self.replay)]], dtype=np.int32))
+        return np.clip(np.round(raw), -2**15, 2**15-1).astype('<i2')
+
+    def _emit(self):
+        # whole packets due since listening started
+        due = int((time.monotonic_ns() - self._start)/1e9 * self.sample_rate) // self.packet_size * self.packet_size
+        n = due - self.index
+        if n <= 0:
+            return
+        samples = self._samples(n)
+        self.index += n
+        raw = samples.view(np.uint8).reshape((len(samples), 2*samples.shape[1]))
+        size = self.packet_size if self._block_mode else 1
+        first = self.index - n
+        for start in range(0, len(raw), size):
+            # a packet is due once its last sample has been sampled
+            self._arrival = self._start + int((first + start + size) * 1e9 / self.sample_rate)
+            self._notify(None, {"Value": raw[start:start+size].ravel()}, None)
+        if len(samples) < n:
+            logging.info("Replay finished.")
+            self._tick_loop.stop()
+
+    async def start_listening(self, callback, block_size=None, block_interval=None, timestamps=False):
+        """ See Traumschreiber.start_listening """
+        logging.info("Start listening...")
+        self._block_mode = bool(block_size)
+        self._notify = self._notification_callback(callback, block_size, block_interval, timestamps)
+        if self.clock is not None:
+            self.clock.now = lambda: self._arrival
+        self.index = 0
+        self._start = time.monotonic_ns()
+        self._tick_loop = task.LoopingCall(self._emit)
+        self._tick_loop.start(self.tick, now=False)
+
+    async def stop_listening(self):
+        if self._tick_loop is not None:
+            logging.info("Stop listening...")
+            if self._tick_loop.running:
+                self._tick_loop.stop()
+            self._tick_loop = None
+            self._stop_blocks()
+
+
+class _Signal(object):
+    """ What txdbus hands to addMatch callbacks """
+    def __init__(self, path, body):
+        self.path = path
+        self.body = body
+
+
+class MockBluez(object):
+    """ Local stand-in for the BlueZ DBus API (bus, object manager & remote objects)
+
+    Serves an object tree with one adapter; the Traumschreibers with addresses
+    `addrs` appear as devices `discovery_delay` seconds after StartDiscovery (or
+    right away with `known=True`), and their GATT characteristics
+    `connect_delay` seconds after Connect. Changes are announced with
+    InterfacesAdded & PropertiesChanged signals like BlueZ does, so the
+    fast-connect path of Traumschreiber can be exercised without Bluetooth:
+
+        bluez = MockBluez(addr)
+        t = Traumschreiber(addr, fast_connect=True)
+        await t._fast_connect(bus=bluez, manager=bluez)
+        bluez.notify(addr, payload)     # biosignals notification
+        bluez.drop(addr)                # connection lost
+        await t.reconnect()
+
+    `calls` records all (path, method, args) remote calls. The first
+    `connect_failures` Connect calls fail, like aborted LE connections do.
+    """
+    ADAPTER = "/org/bluez/hci0"
+
+    def __init__(self, addrs, known=False, discovery_delay=0.5, connect_delay=0.5, connect_failures=0):
+        self.addrs = [addrs] if isinstance(addrs, str) else list(addrs)
+        self.discovery_delay = discovery_delay
+        self.connect_delay = connect_delay
+        self.connect_failures = connect_failures
+        self.objects = {self.ADAPTER: {"org.bluez.Adapter1": {"Address": "00:00:00:00:00:00", "Discovering": False}}}
+        self.calls = []
+        self._signal_handlers = {}
+        self._matches = []
+        if known:
+            self._add_devices()
+
+    def device_path(self, addr):
+        return "{}/dev_{}".format(self.ADAPTER, addr.replace(":", "_"))
+
+    def _char_path(self, device_path, i):
+        return "{}/service000a/char{:04x}".format(device_path, 0x0b + 3*i)
+
+    # bus & object manager
+    def callRemote(self, method, *args):
+        return defer.ensureDeferred(self._call("/", method, *args))
+
+    async def notifyOnSignal(self, name, callback, interface=None):
+        self._signal_handlers.setdefault(("/", name), []).append(callback)
+        return ("/", name, callback)
+
+    async def addMatch(self, callback, **rule):
+        self._matches.append(callback)
+        return len(self._matches)
+
+    async def getRemoteObject(self, bus_name, path, interface=None):
+        return _MockRemoteObject(self, path)
+
+    # changes of the tree
+    def _interfaces_added(self, path, interfaces):
+        self.objects.setdefault(path, {}).update(interfaces)
+        for callback in self._signal_handlers.get(("/", "InterfacesAdded"), []):
+            callback(path, interfaces)
+
+    def _properties_changed(self, path, interface, changed):
+        self.objects[path][interface].update(changed)
+        for callback in self._matches:
+            callback(_Signal(path, [interface, changed, []]))
+        for callback in self._signal_handlers.get((path, "PropertiesChanged"), []):
+            callback(interface, changed, [])
+
+    def _add_devices(self):
+        for addr in self.addrs:
+            if self.device_path(addr) not in self.objects:
+                self._interfaces_added(self.device_path(addr), {"org.bluez.Device1": {
+                    "Address": addr, "Name": "traumschreiber", "Paired": True,
+                    "Connected": False, "ServicesResolved": False}})
+
+    def _connected(self, device_path):
+        self._properties_changed(device_path, "org.bluez.Device1", {"Connected": True})
+        for i, uuid in enumerate((Traumschreiber.BIOSIGNALS_UUID, Traumschreiber.LEDS_UUID)):
+            path = self._char_path(device_path, i)
+            if path not in self.objects:
+                self._interfaces_added(path, {"org.bluez.GattCharacteristic1": {"UUID": uuid, "Notifying": False}})
+        self._properties_changed(device_path, "org.bluez.Device1", {"ServicesResolved": True})
+
+    def drop(self, addr):
+        """ Simulate a lost connection """
+        self._properties_changed(self.device_path(addr), "org.bluez.Device1", {"Connected": False, "ServicesResolved": False})
+
+    def notify(self, addr, value):
+        """ Send a biosignals notification with payload `value` (bytes) from device `addr`;
+        like txdbus, the value is delivered as a list of byte values """
+        self._properties_changed(self._char_path(self.device_path(addr), 0), "org.bluez.GattCharacteristic1",
+                {"Value": list(bytes(value))})
+
+    async def _call(self, path, method, *args):
+        self.calls.append((path, method, args))
+        if method == "GetManagedObjects":
+            return {p: {i: dict(props) for i, props in interfaces.items()} for p, interfaces in self.objects.items()}
+        if method == "StartDiscovery":
+            reactor.callLater(self.discovery_delay, self._add_devices)
+        elif method == "Connect":
+            await async_sleep(self.connect_delay)
+            if self.connect_failures > 0:
+                self.connect_failures -= 1
+                raise Exception("org.bluez.Error.Failed: le-connection-abort-by-local")
+            self._connected(path)
+        elif method == "Disconnect":
+            self._properties_changed(path, "org.bluez.Device1", {"Connected": False, "ServicesResolved": False})
+        elif method == "Get":
+            return self.objects[path][args[0]][args[1]]
+
+
+class _MockRemoteObject(object):
+    def __init__(self, bluez, path):
+        self.bluez = bluez
+        self.objectPath = path
+
+    def callRemote(self, method, *args):
+        return defer.ensureDeferred(self.bluez._call(self.objectPath, method, *args))
+
+    async def notifyOnSignal(self, name, callback, interface=None):
+        self.bluez._signal_handlers.setdefault((self.objectPath, name), []).append(callback)
+        return (self.objectPath, name, callback)
+
+    def cancelSignalNotification(self, rule):
+        path, name, callback = rule
+        self.bluez._signal_handlers[(path, name)].remove(callback)
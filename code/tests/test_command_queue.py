@@ -0,0 +1,91 @@
+import time
+
+import pytest
+from twisted.internet import defer
+
+import Traumschreiber as traumschreiber
+from Traumschreiber import CommandQueue
+from utils import run_blocking
+
+
+class FakeWrite(object):
+    """ Acknowledges every write right away, except for the first `failures` """
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.values = []
+        self.times = []
+        self.on_write = None
+
+    def __call__(self, value):
+        self.values.append(value)
+        self.times.append(time.monotonic())
+        if self.on_write is not None:
+            self.on_write(value)
+        if self.failures > 0:
+            self.failures -= 1
+            return defer.fail(IOError("write failed"))
+        return defer.succeed(None)
+
+
+def submit(queue, *values):
+    """ Submit `values` (without the reactor, see run_blocking), returns the results of their Deferreds """
+    results = []
+    async def run():
+        for value in values:
+            queue.submit(value).addBoth(results.append)
+    run_blocking(run())
+    return results
+
+
+def test_updates_during_a_write_are_coalesced():
+    write = FakeWrite()
+    queue = CommandQueue(write, min_interval=0)
+    def on_write(value):
+        if value == 1:
+            queue.submit(2).addBoth(results.append)
+            queue.submit(3).addBoth(results.append)
+    write.on_write = on_write
+    results = []
+    results += submit(queue, 1)
+    assert write.values == [1, 3]
+    # every submit is acknowledged with the value written for it
+    assert sorted(results) == [1, 3, 3]
+    assert (queue.writes, queue.coalesced, queue.failures) == (2, 1, 0)
+
+
+def test_retry_then_fail():
+    write = FakeWrite(failures=2)
+    queue = CommandQueue(write, retries=2, retry_delay=0.001)
+    assert submit(queue, 1) == [1]
+    assert (queue.writes, queue.failures) == (1, 2)
+
+    write.failures = 3
+    [result] = submit(queue, 2)
+    assert result.check(IOError)
+    assert write.values == [1, 1, 1, 2, 2, 2]
+    # failed writes are not counted as writes
+    assert (queue.writes, queue.failures) == (1, 5)
+
+
+def test_rate_limit():
+    write = FakeWrite()
+    queue = CommandQueue(write, min_interval=0.02)
+    for value in range(3):
+        submit(queue, value)
+    assert write.values == [0, 1, 2]
+    assert min(b - a for a, b in zip(write.times, write.times[1:])) >= 0.02
+
+
+def test_unexpected_error_fails_the_waiters(monkeypatch):
+    def async_sleep(seconds):
+        raise RuntimeError("no reactor")
+    monkeypatch.setattr(traumschreiber, "async_sleep", async_sleep)
+    write = FakeWrite()
+    queue = CommandQueue(write, min_interval=10)
+    later = []
+    write.on_write = lambda value: queue.submit(value+1).addBoth(later.append) if value == 0 else None
+    assert submit(queue, 0) == [0]
+    # the second write has to wait for the rate limit, which fails
+    assert write.values == [0]
+    assert later[0].check(Exception)
+    assert not queue._running and not queue._waiters
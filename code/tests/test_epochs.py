@@ -0,0 +1,62 @@
+import numpy as np
+
+from epochs import OnlineEpocher
+
+
+def stream(n, block_size=32):
+    """ Blocks of samples whose value is their squared index, timestamps 4 ms apart """
+    samples = np.repeat(np.arange(n, dtype=np.float32)[:,None]**2, 2, axis=1)
+    timestamps = np.arange(n, dtype=np.int64)*4000000
+    for i in range(0, n, block_size):
+        yield samples[i:i+block_size], timestamps[i:i+block_size]
+
+
+def test_late_event_is_aligned_to_its_sample():
+    epochs = []
+    epocher = OnlineEpocher(2, n_times=10, baseline=(0, 1), history=100, callback=lambda e, c, t: epochs.append(e.copy()))
+    blocks = stream(128)
+    epocher.write(*next(blocks))
+    # the event at sample 20 is only reported after its block has been written
+    epocher.add_event(20*4000000, 1)
+    for block in blocks:
+        epocher.write(*block)
+
+    assert len(epochs) == 1
+    # baseline corrected with the onset sample: 21**2 - 20**2 (an epoch at 32 would give 33**2 - 32**2)
+    assert epochs[0][0,1] == 41
+
+
+def test_event_outside_of_history_is_dropped():
+    epocher = OnlineEpocher(2, n_times=10, history=64)
+    blocks = stream(256)
+    for _ in range(4):
+        epocher.write(*next(blocks))
+    epocher.add_event(10*4000000, 1)
+    epocher.write(*next(blocks))
+
+    assert epocher.dropped == 1
+    assert epocher.averager.counts.sum() == 0
+
+
+def test_event_before_the_first_sample_is_dropped():
+    epocher = OnlineEpocher(2, n_times=10, history=100)
+    epocher.add_event(-4000000, 1)
+    for block in stream(64):
+        epocher.write(*block)
+
+    assert epocher.dropped == 1
+    assert epocher.averager.counts.sum() == 0
+
+
+def test_cleared_events_are_not_epoched():
+    epocher = OnlineEpocher(2, n_times=10, history=100)
+    blocks = stream(64)
+    epocher.write(*next(blocks))
+    epocher.add_event(20*4000000, 1)
+    epocher.add_event(40*4000000, 1)
+    assert epocher.clear_pending() == 2
+    for block in blocks:
+        epocher.write(*block)
+
+    assert epocher.averager.counts.sum() == 0
+    assert epocher.dropped == 0
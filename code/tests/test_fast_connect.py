@@ -0,0 +1,91 @@
+import json
+
+import numpy as np
+import pytest
+from twisted.internet import defer, task
+from twisted.python.failure import Failure
+
+import simulator
+import Traumschreiber as traumschreiber
+from simulator import MockBluez
+from Traumschreiber import Traumschreiber
+
+ADDR = "74:72:61:75:6D:03"
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """ Simulated time for the timeouts & delays of the fast-connect path & MockBluez """
+    clock = task.Clock()
+    monkeypatch.setattr(traumschreiber, "reactor", clock)
+    monkeypatch.setattr(simulator, "reactor", clock)
+    return clock
+
+
+def run(clock, coroutine, step=0.05, limit=60):
+    """ Run `coroutine`, advancing the simulated time until it finished, returns its result """
+    results = []
+    defer.ensureDeferred(coroutine).addBoth(results.append)
+    for _ in range(int(limit/step)):
+        if results:
+            break
+        clock.advance(step)
+    assert results, "did not finish within {}s".format(limit)
+    if isinstance(results[0], Failure):
+        results[0].raiseException()
+    return results[0]
+
+
+def connect(clock, bluez, cache_file):
+    t = Traumschreiber(ADDR, fast_connect=True, cache_file=str(cache_file))
+    return run(clock, t._fast_connect(bus=bluez, manager=bluez))
+
+
+def methods(bluez):
+    return [method for _, method, _ in bluez.calls]
+
+
+def test_discovery_then_cached_path(clock, tmp_path):
+    cache_file = tmp_path / "cache.json"
+    bluez = MockBluez(ADDR)
+    t = connect(clock, bluez, cache_file)
+    assert "StartDiscovery" in methods(bluez)
+    assert t.device.objectPath == bluez.device_path(ADDR)
+    assert json.loads(cache_file.read_text()) == {ADDR: bluez.device_path(ADDR)}
+
+    # BlueZ knows the device: the cached path is used, no discovery
+    bluez = MockBluez(ADDR, known=True)
+    t = connect(clock, bluez, cache_file)
+    assert "StartDiscovery" not in methods(bluez)
+    assert methods(bluez).count("Connect") == 1
+    assert t.device.objectPath == bluez.device_path(ADDR)
+
+
+def test_connect_retries(clock, tmp_path):
+    bluez = MockBluez(ADDR, known=True, connect_failures=Traumschreiber.CONNECT_ATTEMPTS-1)
+    connect(clock, bluez, tmp_path / "cache.json")
+    assert methods(bluez).count("Connect") == Traumschreiber.CONNECT_ATTEMPTS
+
+    bluez = MockBluez(ADDR, known=True, connect_failures=Traumschreiber.CONNECT_ATTEMPTS)
+    with pytest.raises(Exception, match="le-connection-abort"):
+        connect(clock, bluez, tmp_path / "cache.json")
+
+
+def test_notifications_after_reconnect(clock, tmp_path):
+    bluez = MockBluez(ADDR, known=True)
+    t = connect(clock, bluez, tmp_path / "cache.json")
+    received = []
+    run(clock, t.start_listening(lambda sample: received.append(sample.copy())))
+    sample = np.arange(8, dtype='<i2')
+    bluez.notify(ADDR, sample.tobytes())
+
+    bluez.drop(ADDR)
+    assert not t.objects.get(t.device.objectPath, "org.bluez.Device1", "Connected")
+    run(clock, t.reconnect())
+    assert methods(bluez).count("Connect") == 2
+    assert t.objects.get(t.device.objectPath, "org.bluez.Device1", "ServicesResolved")
+    bluez.notify(ADDR, (2*sample).tobytes())
+
+    assert len(received) == 2
+    np.testing.assert_array_equal(received[0], sample[None])
+    np.testing.assert_array_equal(received[1], 2*sample[None])
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from loader import WindowLoader
+from recording import RecordingWriter
+
+
+def write_recording(path, n):
+    channels = np.arange(9*n, dtype='<i2').reshape((n, 9))
+    with RecordingWriter(str(path), n_channels=9) as writer:
+        writer.extend(channels, timestamp=np.arange(n, dtype=np.int64))
+    return str(path), channels
+
+
+def test_short_recording_is_skipped(tmp_path):
+    short, _ = write_recording(tmp_path / "short.bin", 100)
+    long, channels = write_recording(tmp_path / "long.bin", 500)
+    loader = WindowLoader([short, long], window=250, stride=10, batch_size=8, shuffle=False)
+
+    assert len(loader.recordings) == 1
+    assert loader.n_windows == 26
+    batches = list(loader)
+    assert sum(len(b) for b in batches) == 26
+    np.testing.assert_array_equal(batches[0][1], channels[10:260].T)
+
+
+def test_no_windows_raises(tmp_path):
+    short, _ = write_recording(tmp_path / "short.bin", 100)
+    with pytest.raises(ValueError):
+        WindowLoader([short], window=250)
+    with pytest.raises(ValueError):
+        WindowLoader([], window=250)
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.int16])
+def test_batch_across_recordings(tmp_path, dtype):
+    first, a = write_recording(tmp_path / "a.bin", 300)
+    second, b = write_recording(tmp_path / "b.bin", 400)
+    loader = WindowLoader([first, second], window=250, dtype=dtype)
+    # 51 windows of the first recording, then those of the second
+    windows = loader.batch(np.array([60, 3, 51, 0]))
+
+    assert windows.dtype == dtype
+    for window, expected in zip(windows, [a[0:250], a[3:253], b[0:250], b[9:259]]):
+        np.testing.assert_array_equal(window, expected.T)
@@ -0,0 +1,21 @@
+from metrics import StreamMetrics
+
+
+def test_stall_shows_in_snapshot():
+    metrics = StreamMetrics()
+    t0 = 1000000000
+    # 2.5 s of packets every 4 ms
+    for i in range(625):
+        metrics.record(1, t0 + i*4000000, 1000)
+    last = t0 + 624*4000000
+    assert 240 < metrics.snapshot(now=last)["packet_rate"] < 260
+
+    # nothing arrives for 3 s
+    snapshot = metrics.snapshot(now=last + 3000000000)
+    assert snapshot["packet_rate"] == 0
+    assert snapshot["sample_rate"] == 0
+    assert snapshot["since_last_packet"] == 3000
+    assert snapshot["max_interval"] == 3000
+
+    # within the first window of a stall, the rate falls
+    assert metrics.snapshot(now=last + 900000000)["packet_rate"] < 240
@@ -0,0 +1,87 @@
+import numpy as np
+
+from pipeline import SharedRing, Worker, RESERVED, OVERRUNS
+
+
+def block(start, n, n_channels=2):
+    """ Samples whose values are their index in the stream """
+    index = np.arange(start, start+n)
+    return np.repeat(index[:,None], n_channels, axis=1).astype('<i2'), index.astype(np.int64)
+
+
+def test_write_wraps_the_ring():
+    ring = SharedRing(16, 2)
+    try:
+        slot = ring.add_consumer()
+        ring.write(*block(0, 10))
+        assert len(ring.read(slot, 10)[0]) == 10
+        # 10..21 wraps around the end of the ring
+        ring.write(*block(10, 12))
+        samples, timestamps = ring.read(slot, 16)
+        np.testing.assert_array_equal(timestamps, np.arange(10, 22))
+        np.testing.assert_array_equal(samples[:,1], np.arange(10, 22))
+        assert ring.stats(slot) == {"processed": 22, "backlog": 0, "overruns": 0, "errors": 0}
+    finally:
+        ring.unlink()
+
+
+def test_consumer_falling_behind_counts_overruns():
+    ring = SharedRing(16, 2)
+    try:
+        slot = ring.add_consumer()
+        for start in range(0, 40, 8):
+            ring.write(*block(start, 8))
+        # only the newest 16 of the 40 samples are left
+        samples, timestamps = ring.read(slot, 32)
+        np.testing.assert_array_equal(timestamps, np.arange(24, 40))
+        assert ring.consumers[slot,OVERRUNS] == 24
+        assert ring.stats(slot)["processed"] == 16
+        assert ring.pressure == 1
+    finally:
+        ring.unlink()
+
+
+def test_samples_overwritten_during_a_read_are_dropped():
+    ring = SharedRing(16, 2)
+    try:
+        slot = ring.add_consumer()
+        ring.write(*block(0, 16))
+        # the producer started to write 4 more samples (over 0..3) while the consumer copies
+        ring.header[RESERVED] += 4
+        samples, timestamps = ring.read(slot, 16)
+        np.testing.assert_array_equal(timestamps, np.arange(4, 16))
+        np.testing.assert_array_equal(samples[:,0], np.arange(4, 16))
+        assert ring.consumers[slot,OVERRUNS] == 4
+        assert ring.backlog(slot) == 0
+    finally:
+        ring.unlink()
+
+
+class Collect(object):
+    """ Saves everything it gets to `path` on close (a process worker's results) """
+    def __init__(self, path):
+        self.path = path
+        self.timestamps = []
+
+    def __call__(self, samples, timestamps):
+        self.timestamps.append(timestamps.copy())
+
+    def close(self):
+        np.save(self.path, np.concatenate(self.timestamps))
+
+
+def test_process_worker_drains_after_close(tmp_path):
+    ring = SharedRing(1024, 2)
+    path = str(tmp_path / "timestamps.npy")
+    try:
+        worker = Worker(ring, Collect(path), block_size=64, process=True)
+        for start in range(0, 1000, 100):
+            ring.write(*block(start, 100))
+        # everything is written & the ring closed before the worker even starts
+        ring.close()
+        worker.start()
+        worker.join(10)
+        np.testing.assert_array_equal(np.load(path), np.arange(1000))
+        assert worker.stats() == {"processed": 1000, "backlog": 0, "overruns": 0, "errors": 0}
+    finally:
+        ring.unlink()
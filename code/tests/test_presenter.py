@@ -0,0 +1,36 @@
+import time
+
+import numpy as np
+import pytest
+
+from bci_grid.decoder import SpellerDecoder, OnlineSpeller
+from presenter import Presenter
+from utils import async_sleep, run_blocking
+
+
+class ImmediateSpeller(OnlineSpeller):
+    """ Scores every flash right away (as a target), without waiting for its samples """
+    def add_flash(self, timestamp, rowcol, num):
+        condition = num if rowcol == "row" else self.grid_shape[0] + num
+        self._score(np.zeros((9, 200)), condition, timestamp)
+
+
+async def spell(events=None, decoder=None, flashes=40):
+    decoder.reset()
+    for i in range(flashes):
+        decoder.add_flash(time.monotonic_ns(), *(("row", 2), ("col", 3))[i % 2])
+        await async_sleep(0.01)
+        if decoder.decided:
+            break
+    return decoder.decided, decoder.prediction, i
+
+
+@pytest.mark.parametrize("process", [False, True])
+def test_presenter_with_decoder(process):
+    speller = ImmediateSpeller(SpellerDecoder(np.zeros(180), bias=1.0, mu=(0.0, 1.0), sigma=0.5))
+    decided, prediction, i = run_blocking(Presenter(spell, decoder=speller, process=process).run())
+
+    assert decided and i < 39
+    # the same (row, col) in the presenter as on the reactor
+    assert tuple(int(x) for x in prediction) == (2, 3)
+    assert tuple(int(x) for x in speller.prediction) == (2, 3)
@@ -0,0 +1,26 @@
+import time
+
+import pytest
+
+from simulator import SimulatedTraumschreiber
+from utils import run_blocking
+
+
+@pytest.mark.parametrize("speed", [10, 40])
+def test_no_lost_samples_at_high_speed(speed):
+    received = [0]
+    def data_callback(block, timestamps):
+        received[0] += len(block)
+
+    t = SimulatedTraumschreiber(speed=speed, seed=0)
+    run_blocking(t.start_listening(data_callback, block_size=32, timestamps=True))
+    # tick by hand, like the reactor would (longer than the clock's gap_time)
+    end = time.monotonic() + 1.5
+    while time.monotonic() < end:
+        time.sleep(t.tick)
+        t._emit()
+    run_blocking(t.stop_listening())
+
+    assert received[0] == t.index > 1.5*250*speed*0.9
+    assert t.clock.lost == 0
+    assert t.metrics.lost == 0
@@ -2,70 +2,71 @@ import pygame
 from OpenGL.GL import *
 from OpenGL.GLU import *
 from functools import reduce
-import collections
+import logging
+import time
 import numpy as np
 from twisted.internet import reactor, defer, task
 
+# re-exported for the experiments (`from utils import *`) & the presenter
+from Traumschreiber import async_sleep, run_blocking
+
 class Trace(object):
+    """ Fading trail of recent positions, drawn as a quad strip of varying width
+
+    Positions are kept in a ring buffer; `draw` computes the geometry of the whole
+    strip (segment normals, offsets, alpha ramp) in one numpy pass and draws it
+    from vertex/color arrays with a single call.
+    """
     def __init__(self, color=(38,139,210), length=100):
+        self.length = length
         self.pos = np.zeros((length,2))
         self.width = np.zeros((length,1))
+        # position the next point is written to
+        self.index = 0
         self.color = color if reduce(lambda x, y: x and 0<y<1, color) else (color[0]/255,color[1]/255,color[2]/255)
 
+        # preallocated geometry: 4 vertices per segment, alpha fading from newest to oldest
+        self._vertices = np.zeros((length-1, 4, 2), dtype=np.float32)
+        self._colors = np.zeros((length-1, 4, 4), dtype=np.float32)
+        self._colors[:,:,:3] = self.color
+        self._alpha = (1 - np.arange(1, length)/length)[:,None]
+        self._order = np.arange(length)
+
     def update(self, pos, width):
-        self.pos = np.roll(self.pos, 1, axis=0)
-        self.width = np.roll(self.width, 1, axis=0)
-        self.pos[0,:] = pos
-        self.width[0] = width
+        self.pos[self.index,:] = pos
+        self.width[self.index] = width
+        self.index = (self.index + 1) % self.length
 
     def draw(self):
-        glDisable(GL_TEXTURE_2D)
-        glBegin(GL_QUAD_STRIP)
-        for i in range(len(self.width)):
-            glColor4f(*self.color, 1-i/100)
-            if i==0:
-                continue
-            x_old,y_old, x, y = self.pos[i-1:i+1, :].ravel()
-            w = self.width[i]
-            dx, dy = x-x_old, y-y_old
-            if dx == 0 or dy == 0:
-                continue
-            c = w*1.0/np.sqrt(dx**2 + dy**2)
-            nx, ny = -dy*c, dx*c
-            glVertex2f(x_old+nx, y_old+ny)
-            glVertex2f(x_old-nx, y_old-ny)
-            glVertex2f(x+nx, y+ny)
-            glVertex2f(x-nx, y-ny)
-        glEnd()
+        # newest point first
+        np.subtract(self.index-1, np.arange(self.length), out=self._order)
+        self._order %= self.length
+        pos = self.pos[self._order]
+        w = self.width[self._order[1:]]
 
-class Symbol(object):
-    def __init__(self, texture, pos, slice_rect=((0,0),(1,1)), size=(0.01, 0.01), color = (1,1,1)):
-        self.highlighted = False
-        self.pos = np.array(pos)
-        self.texture = texture
-        self.slice_rect = slice_rect
-        self.size = np.array(size)
-        self.color = np.hstack([color[:3], 0.25])
+        d = pos[1:] - pos[:-1]
+        norm = np.sqrt((d**2).sum(axis=1, keepdims=True))
+        # skip degenerate (zero length) segments
+        valid = norm[:,0] > 0
+        n = w[valid]/norm[valid] * d[valid][:,::-1] * (-1, 1)
+
+        m = int(valid.sum())
+        vertices = self._vertices[:m]
+        vertices[:,0] = pos[:-1][valid] + n
+        vertices[:,1] = pos[:-1][valid] - n
+        vertices[:,2] = pos[1:][valid] + n
+        vertices[:,3] = pos[1:][valid] - n
+        colors = self._colors[:m]
+        colors[:,:,3] = self._alpha[valid]
 
-    def draw(self):
-        color = self.color.copy()
-        if self.highlighted:
-            color[3] = 1.0
-        glEnable(GL_TEXTURE_2D)
-        glBindTexture(GL_TEXTURE_2D, self.texture)
-        glBegin(GL_QUADS)
-        glColor4fv(color)
-        glTexCoord2f(self.slice_rect[0][0],self.slice_rect[1][1])
-        glVertex2fv((self.pos+self.size*np.array([-0.5,-0.5])))
-        glTexCoord2fv(self.slice_rect[1])
-        glVertex2fv((self.pos+self.size*np.array([ 0.5,-0.5])))
-        glTexCoord2f(self.slice_rect[1][0],self.slice_rect[0][1])
-        glVertex2fv((self.pos+self.size*np.array([ 0.5,0.5])))
-        glTexCoord2fv(self.slice_rect[0])
-        glVertex2fv((self.pos+self.size*np.array([-0.5,0.5])))
-        glEnd()
         glDisable(GL_TEXTURE_2D)
-        glBindTexture(GL_TEXTURE_2D, 0)
+        glEnableClientState(GL_VERTEX_ARRAY)
+        glEnableClientState(GL_COLOR_ARRAY)
+        glVertexPointer(2, GL_FLOAT, 0, vertices)
+        glColorPointer(4, GL_FLOAT, 0, colors)
+        glDrawArrays(GL_QUAD_STRIP, 0, 4*m)
+        glDisableClientState(GL_COLOR_ARRAY)
+        glDisableClientState(GL_VERTEX_ARRAY)
 
 class Grid(object):
     def __init__(self, num_rows, num_cols, symbols_img, img_rows=None, img_cols=None, coords=((-1,1), (1,-1)), space=0, point_size=10, point_color=(1.0, 0, 0, 1.0), base_color=(1.0, 1.0, 1.0, 1.0)):
@@ -99,37 +100,60 @@ class Grid(object):
         xs = np.linspace(0, 1, img_cols+1, endpoint=True)
         ys = np.linspace(0, 1, img_rows+1, endpoint=True)
 
-        symbols = []
-        for i,y in enumerate(ys[:-1]):
-            for j,x in enumerate(xs[:-1]):
-                symbols.append(Symbol(self.texid, (pos_xs[j], pos_ys[i]), ((x,y),(xs[j+1], ys[i+1])), size, color=base_color))
+        # Static geometry of all symbols: 4 corners (quads) per symbol, laid out like the image
+        corners = np.array([[-0.5,-0.5], [0.5,-0.5], [0.5,0.5], [-0.5,0.5]])
+        centers = np.stack(np.meshgrid(pos_xs[:img_cols], pos_ys[:img_rows]), axis=-1)
+        vertices = centers[:,:,None,:] + size*corners
+        x0, y0 = np.meshgrid(xs[:-1], ys[:-1])
+        x1, y1 = np.meshgrid(xs[1:], ys[1:])
+        texcoords = np.stack([np.stack([x0,y1], -1), np.stack([x1,y1], -1), np.stack([x1,y0], -1), np.stack([x0,y0], -1)], axis=2)
+
+        self.shape = (num_rows, num_cols)
+        self._vertices = np.ascontiguousarray(vertices.reshape((-1,2)), dtype=np.float32)
+        self._texcoords = np.ascontiguousarray(texcoords.reshape((-1,2)), dtype=np.float32)
+        self._vertex_colors = np.zeros((num_rows, num_cols, 4, 4), dtype=np.float32)
+
+        # Per-symbol state: color (RGBA, alpha used when not highlighted) & highlight mask
+        self.colors = np.zeros((num_rows, num_cols, 4), dtype=np.float32)
+        self.colors[:,:,:3] = base_color[:3]
+        self.colors[:,:,3] = 0.25
+        self.highlighted = np.zeros(self.shape, dtype=bool)
+        self._row_mask = np.zeros(num_rows, dtype=bool)
+        self._col_mask = np.zeros(num_cols, dtype=bool)
 
-        self.symbols = np.array(symbols, dtype=object).reshape((num_rows, num_cols))
         self.coords = np.array(coords)
         self.point_size = point_size
         self.point_color = point_color
 
     def flash(self, rows=None, cols=None):
-        if rows is None:
-            rows = range(self.symbols.shape[0])
-        if cols is None:
-            cols = range(self.symbols.shape[1])
-        if not isinstance(rows, collections.Iterable):
-            rows = (rows,)
-        if not isinstance(cols, collections.Iterable):
-            cols = (cols,)
-
-        flashed = np.zeros(self.symbols.shape, dtype=bool)
-        for i,row in enumerate(self.symbols):
-            for j,s in enumerate(row):
-                flash = ((i in rows) and (j in cols))
-                s.highlighted = flash
-                flashed[i,j] = flash
-        return flashed
+        """ Highlight all symbols in the given rows & columns (default: all), returns the highlight mask """
+        self._row_mask[:] = rows is None
+        self._col_mask[:] = cols is None
+        if rows is not None:
+            self._row_mask[np.asarray(rows, dtype=int).ravel()] = True
+        if cols is not None:
+            self._col_mask[np.asarray(cols, dtype=int).ravel()] = True
+        np.logical_and(self._row_mask[:,None], self._col_mask[None,:], out=self.highlighted)
+        return self.highlighted.copy()
 
     def draw(self):
-        for s in self.symbols.ravel():
-            s.draw()
+        self._vertex_colors[...] = self.colors[:,:,None,:]
+        self._vertex_colors[...,3][self.highlighted] = 1.0
+
+        glEnable(GL_TEXTURE_2D)
+        glBindTexture(GL_TEXTURE_2D, self.texid)
+        glEnableClientState(GL_VERTEX_ARRAY)
+        glEnableClientState(GL_TEXTURE_COORD_ARRAY)
+        glEnableClientState(GL_COLOR_ARRAY)
+        glVertexPointer(2, GL_FLOAT, 0, self._vertices)
+        glTexCoordPointer(2, GL_FLOAT, 0, self._texcoords)
+        glColorPointer(4, GL_FLOAT, 0, self._vertex_colors)
+        glDrawArrays(GL_QUADS, 0, len(self._vertices))
+        glDisableClientState(GL_COLOR_ARRAY)
+        glDisableClientState(GL_TEXTURE_COORD_ARRAY)
+        glDisableClientState(GL_VERTEX_ARRAY)
+        glDisable(GL_TEXTURE_2D)
+        glBindTexture(GL_TEXTURE_2D, 0)
 
         glPointSize(self.point_size)
         glBegin(GL_POINTS)
@@ -137,6 +161,94 @@ class Grid(object):
         glVertex2fv(self.coords.mean(axis=0))
         glEnd()
 
+class Scope(object):
+    """ Streaming multi-channel signal renderer (sweep oscilloscope)
+
+    Every channel has its own vertex buffer object holding one (x,y) vertex per
+    sample slot. New samples are written into a host-side copy at the write index
+    (no GL calls, so this is cheap enough to do from the data callback); `draw`
+    uploads only the slots changed since the last frame and draws each channel
+    with a single call. Per-channel offset and scale are applied by the modelview
+    matrix, so the raw sample values are uploaded as they are.
+
+    Usage:
+
+        scope = Scope(n_channels=9, length=2500)
+        scope.write(reref_channels(data_in, 5))   # (N,9) block of samples
+        scope.draw()                                # once per frame
+    """
+    def __init__(self, n_channels=9, length=2500, coords=((-1,1), (1,-1)), offsets=None, scales=None, full_scale=2**12, color=(1.0, 1.0, 1.0, 1.0)):
+        self.n_channels = n_channels
+        self.length = length
+        self.color = color
+
+        # by default, stack the channels in equally high rows
+        row_height = (coords[0][1] - coords[1][1]) / n_channels
+        self.offsets = np.array(offsets if offsets is not None else
+                coords[0][1] - row_height*(np.arange(n_channels)+0.5), dtype=np.float32)
+        self.scales = np.array(scales if scales is not None else
+                np.full(n_channels, 0.5*row_height/full_scale), dtype=np.float32)
+
+        self.vertices = np.zeros((n_channels, length, 2), dtype=np.float32)
+        self.vertices[:,:,0] = np.linspace(coords[0][0], coords[1][0], length, dtype=np.float32)
+        self.index = 0
+        # range of sample slots changed since the last upload
+        self._dirty = (0, length)
+
+        self.vbos = np.atleast_1d(glGenBuffers(n_channels))
+        for c, vbo in enumerate(self.vbos):
+            glBindBuffer(GL_ARRAY_BUFFER, vbo)
+            glBufferData(GL_ARRAY_BUFFER, self.vertices[c].nbytes, self.vertices[c], GL_DYNAMIC_DRAW)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+    def write(self, block):
+        """ Append an (N, n_channels) block of samples at the write index """
+        n = len(block)
+        if n >= self.length:
+            block = block[n-self.length:]
+            self.index, n = 0, self.length
+        k = min(n, self.length - self.index)
+        self.vertices[:, self.index:self.index+k, 1] = block[:k].T
+        if k < n:
+            self.vertices[:, :n-k, 1] = block[k:].T
+            self._dirty = (0, self.length)
+        else:
+            start, stop = self._dirty
+            self._dirty = (min(start, self.index), max(stop, self.index+k)) if stop > start else (self.index, self.index+k)
+        self.index = (self.index + n) % self.length
+
+    def upload(self):
+        """ Upload the sample slots changed since the last upload to the vertex buffers """
+        start, stop = self._dirty
+        if stop <= start:
+            return
+        offset, nbytes = start*self.vertices.strides[1], (stop-start)*self.vertices.strides[1]
+        for c, vbo in enumerate(self.vbos):
+            glBindBuffer(GL_ARRAY_BUFFER, vbo)
+            glBufferSubData(GL_ARRAY_BUFFER, offset, nbytes, self.vertices[c, start:stop])
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        self._dirty = (0, 0)
+
+    def draw(self):
+        self.upload()
+        # draw older and newer samples as separate strips, so the sweep is not connected
+        firsts = np.array([self.index, 0], dtype=np.int32)
+        counts = np.array([self.length-self.index, self.index], dtype=np.int32)
+
+        glDisable(GL_TEXTURE_2D)
+        glEnableClientState(GL_VERTEX_ARRAY)
+        glColor4fv(self.color)
+        for c, vbo in enumerate(self.vbos):
+            glBindBuffer(GL_ARRAY_BUFFER, vbo)
+            glVertexPointer(2, GL_FLOAT, 0, None)
+            glPushMatrix()
+            glTranslatef(0, self.offsets[c], 0)
+            glScalef(1, self.scales[c], 1)
+            glMultiDrawArrays(GL_LINE_STRIP, firsts, counts, 2)
+            glPopMatrix()
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        glDisableClientState(GL_VERTEX_ARRAY)
+
 def get_mouse_coords(width, height):
     x,y = pygame.mouse.get_pos()
     x/=width/2
@@ -159,16 +271,129 @@ def boilerplate():
     return width, height
 
 
-def async_sleep(time):
-    d = defer.Deferred()
-    reactor.callLater(time, d.callback, None)
-    return d
+class FrameClock(object):
+    """ Frame-locked stimulus timing
+
+    Stimuli are planned in display frames rather than seconds: `present` renders
+    and flips for a number of frames and waits for each buffer swap to complete
+    (glFinish after the flip), so the recorded monotonic timestamps (ns, see
+    time.monotonic_ns) are those of the actual flips. `stats` reports the flip
+    jitter and the number of missed frames.
+
+    The flip blocks the calling thread until the vertical sync, i.e. for up to a
+    frame. Called on the reactor, this delays the handling of BLE notifications
+    by as much on every frame, so the train scripts run their experiment in a
+    presenter.Presenter (thread or process) by default, which keeps the flips
+    off the reactor; the flip timestamps use the same clock as the samples.
+
+    Usage:
+
+        clock = FrameClock()
+        clock.calibrate()
+        await clock.present(render, clock.frames(0.125), onset=lambda t: state.update(flip_time=t))
+    """
+    def __init__(self, refresh_rate=None):
+        self.frame_time = 1e9/refresh_rate if refresh_rate else None
+        self.intervals = []
+        self.missed = 0
+        self._last_flip = None
+
+    def flip(self):
+        """ Flip the display, wait for the swap and return its timestamp (ns). Blocks for up to a
+        frame, see the class docstring. """
+        pygame.display.flip()
+        glFinish()
+        t = time.monotonic_ns()
+        if self._last_flip is not None:
+            interval = t - self._last_flip
+            self.intervals.append(interval)
+            if self.frame_time and interval > 1.5*self.frame_time:
+                self.missed += int(round(interval/self.frame_time)) - 1
+        self._last_flip = t
+        return t
+
+    def interrupt(self):
+        """ Call when the display is not flipped every frame for a while (e.g. pause), so
+        the gap is not counted as missed frames """
+        self._last_flip = None
+
+    def calibrate(self, n_frames=60, render=None):
+        """ Measure the duration of a frame from `n_frames` consecutive flips """
+        self.interrupt()
+        t = []
+        for i in range(n_frames):
+            if render is not None:
+                render()
+            t.append(self.flip())
+        self.frame_time = float(np.median(np.diff(t)))
+        self.intervals = []
+        self.missed = 0
+        logging.info("Measured refresh rate: {:.2f} Hz".format(1e9/self.frame_time))
+        return self.frame_time
+
+    def frames(self, seconds):
+        """ Number of frames (at least 1) closest to the duration `seconds` """
+        return max(1, int(round(seconds*1e9/self.frame_time)))
+
+    async def present(self, render, n_frames, onset=None):
+        """ Render & flip `n_frames` consecutive frames, handing control back to the reactor
+        after every flip. `onset(t)` is called right after the first flip with its timestamp,
+        which is also returned.
+        """
+        first = None
+        for i in range(n_frames):
+            render()
+            t = self.flip()
+            if first is None:
+                first = t
+                if onset is not None:
+                    onset(t)
+            await async_sleep(0)
+        return first
+
+    def stats(self):
+        """ Flip statistics since the calibration: frames, mean interval & jitter (ms), missed frames """
+        intervals = np.array(self.intervals, dtype=np.float64)/1e6
+        return {
+            "flips": len(intervals),
+            "frame_time": self.frame_time/1e6 if self.frame_time else None,
+            "mean_interval": float(intervals.mean()) if len(intervals) else None,
+            "jitter": float(intervals.std()) if len(intervals) else None,
+            "max_interval": float(intervals.max()) if len(intervals) else None,
+            "missed_frames": self.missed,
+        }
+
+_reref_matrices = {}
+
+def reref_matrix(electrode_id=1, n_channels=8, dtype=np.int64):
+    """ Returns the (n_channels, n_channels+1) matrix M, such that `data_in @ M` rereferences
+    a block of raw samples with respect to electrode `electrode_id` [1, ..., n_channels+1].
+
+    The device reports the differences between neighbouring electrodes, so the potential of
+    electrode k relative to electrode 1 is the cumulative sum of the first k-1 values. The
+    matrices are cached and read-only.
+    """
+    assert 1 <= electrode_id <= n_channels+1, "Electrode ID out of range. [1,...,{}]".format(n_channels+1)
+    key = (electrode_id, n_channels, np.dtype(dtype))
+    if key not in _reref_matrices:
+        i = np.arange(1, n_channels+1)[:,None]
+        k = np.arange(n_channels+1)[None,:]
+        m = ((i <= electrode_id-1).astype(dtype) - (i <= k).astype(dtype))
+        m.setflags(write=False)
+        _reref_matrices[key] = m
+    return _reref_matrices[key]
+
+def reref_block(data_in, electrode_id=1, out=None):
+    """ rereference an (N,8) block of samples with respect to electrode `electrode_id` [1, ..., 9]
+
+    The (N,9) result is written into `out` if given (e.g. a preallocated int16 buffer),
+    without any temporary arrays.
+    """
+    if out is None:
+        return np.matmul(data_in, reref_matrix(electrode_id, data_in.shape[-1]))
+    return np.matmul(data_in, reref_matrix(electrode_id, data_in.shape[-1], out.dtype), out=out)
 
 def reref_channels(data_in, electrode_id=1):
     """ rereference with respect to electrode `electrode_id` [1, ..., 9]"""
     assert 1 <= electrode_id <= 9, "Electrode ID out of range. [1,...,9]"
-
-    cs = np.cumsum(np.hstack(([[0]],data_in)), 1)
-    cs -= cs[0,electrode_id-1]
-    cs = -cs
-    return cs
+    return reref_block(data_in, electrode_id)
@@ -0,0 +1,290 @@
+# pipelined inference on the compute stick (or an in-process stand-in for it)
+
+import abc
+import collections
+import itertools
+import queue
+import threading
+import time
+
+import numpy as np
+
+
+class PipelinedRunner(object):
+    """ Keeps up to `depth` tensors queued on an mvncapi graph
+
+    With a single tensor in flight the stick idles during every host round trip
+    (transfer of the input, GetResult, python overhead). Submitting the next
+    tensor before collecting the previous result overlaps them. Results are
+    matched to their inputs by the user object passed to LoadTensor, and the
+    latency (LoadTensor until the result is collected) of each is recorded.
+
+    Usage:
+
+        runner = PipelinedRunner(graph, depth=2)
+        for output, user_obj, latency in runner.run(tensors):
+            ...
+        runner.stats()
+    """
+
+    def __init__(self, graph, depth=2):
+        self.graph = graph
+        self.depth = depth
+        # sequence number -> (user object, submit time) of the tensors in flight
+        self._in_flight = collections.OrderedDict()
+        self._sequence = 0
+        self.latencies = []
+        self._start = None
+        self._stop = None
+
+    def __len__(self):
+        return len(self._in_flight)
+
+    def submit(self, tensor, user_obj=None):
+        """ Queue a tensor; returns the results collected to make room for it (if the pipeline was full) """
+        results = []
+        while len(self._in_flight) >= self.depth:
+            results.append(self.collect())
+        if self._start is None:
+            self._start = time.perf_counter()
+        key = self._sequence
+        self._sequence += 1
+        self._in_flight[key] = (user_obj, time.perf_counter())
+        self.graph.LoadTensor(tensor, key)
+        return results
+
+    def collect(self):
+        """ Wait for the next result, returns (output, user object, latency in seconds) """
+        output, key = self.graph.GetResult()
+        now = time.perf_counter()
+        user_obj, submitted = self._in_flight.pop(key)
+        latency = now - submitted
+        self.latencies.append(latency)
+        self._stop = now
+        return output, user_obj, latency
+
+    def drain(self):
+        """ Collect all results still in flight """
+        return [self.collect() for _ in range(len(self._in_flight))]
+
+    def run(self, tensors, user_objs=None):
+        """ Generator evaluating all `tensors`, yields (output, user object, latency) in input order.
+        The user objects default to the index of each tensor.
+        """
+        if user_objs is None:
+            user_objs = itertools.count()
+        for tensor, user_obj in zip(tensors, user_objs):
+            yield from self.submit(tensor, user_obj)
+        yield from self.drain()
+
+    def reset_stats(self):
+        self.latencies = []
+        self._start = self._stop = None
+
+    def stats(self):
+        """ Throughput (inferences/s) & latency statistics (ms) of the collected results """
+        latencies = np.array(self.latencies) * 1e3
+        if len(latencies) == 0:
+            return {"inferences": 0}
+        elapsed = self._stop - self._start
+        return {
+            "inferences": len(latencies),
+            "depth": self.depth,
+            "throughput": len(latencies) / elapsed if elapsed > 0 else float("inf"),
+            "mean_latency": latencies.mean(),
+            "median_latency": np.median(latencies),
+            "p95_latency": np.percentile(latencies, 95),
+            "max_latency": latencies.max()}
+
+
+class SimulatedGraph(object):
+    """ In-process stand-in for an mvncapi Graph
+
+    Tensors are evaluated by `function` one after the other on a worker thread
+    (the "stick"), taking `inference_time` seconds each. LoadTensor blocks for
+    `transfer_time` (the USB transfer), and as long as `fifo_size` tensors are
+    waiting already; GetResult blocks until the oldest result is ready. Outputs
+    are float16 like the ones of the stick.
+    """
+
+    def __init__(self, function=None, inference_time=0.002, transfer_time=0.0005, fifo_size=2):
+        self.function = function if function is not None else (lambda x: -x**3 + x**2 + x)
+        self.inference_time = inference_time
+        self.transfer_time = transfer_time
+        self._inputs = queue.Queue(fifo_size)
+        self._results = queue.Queue()
+        self._worker = threading.Thread(target=self._evaluate, daemon=True)
+        self._worker.start()
+
+    def _evaluate(self):
+        while True:
+            item = self._inputs.get()
+            if item is None:
+                break
+            tensor, user_obj = item
+            deadline = time.perf_counter() + self.inference_time
+            output = np.asarray(self.function(np.asarray(tensor, dtype=np.float32))).astype(np.float16)
+            remaining = deadline - time.perf_counter()
+            if remaining > 0:
+                time.sleep(remaining)
+            self._results.put((output, user_obj))
+
+    def LoadTensor(self, tensor, user_obj):
+        if self.transfer_time:
+            time.sleep(self.transfer_time)
+        self._inputs.put((np.array(tensor), user_obj))
+        return True
+
+    def GetResult(self):
+        return self._results.get()
+
+    def DeallocateGraph(self):
+        self._inputs.put(None)
+        self._worker.join()
+
+
+class SimulatedDevice(object):
+    """ In-process stand-in for an mvncapi Device, AllocateGraph returns a SimulatedGraph
+    (the graph file is ignored; keyword arguments are passed on to the graph) """
+
+    def __init__(self, name="simulated", **graph_kwargs):
+        self.name = name
+        self.graph_kwargs = graph_kwargs
+
+    def OpenDevice(self):
+        pass
+
+    def AllocateGraph(self, graphfile):
+        return SimulatedGraph(**self.graph_kwargs)
+
+    def CloseDevice(self):
+        pass
+
+
+class simulated_mvnc(object):
+    """ Drop-in for `mvncapi` (as far as run.py uses it): `mvnc = simulated_mvnc` """
+    Device = SimulatedDevice
+
+    @staticmethod
+    def EnumerateDevices():
+        return ["simulated"]
+
+
+class InferenceBackend(abc.ABC):
+    """ Evaluates the exported MLP on a batch of inputs, wherever it runs
+
+    `infer` takes an (N, input_size) batch (or anything reshapeable to it, e.g. the
+    (N_CHANNELS, N_WINDOWWIDTH) timesteps of run.py) and returns the (N, output_size)
+    outputs, so the decoding code does not need to know whether the stick or the
+    host CPU does the work.
+    """
+
+    @abc.abstractmethod
+    def infer(self, batch):
+        """ (N, input_size) batch -> (N, output_size) outputs """
+
+    def __call__(self, batch):
+        return self.infer(batch)
+
+    def close(self):
+        pass
+
+
+class NumpyBackend(InferenceBackend):
+    """ The tanh MLP of ncs_minimal_example.ipynb evaluated with numpy on the host CPU
+
+    A whole batch is evaluated with one matmul per layer. `dtype` is the precision
+    of weights & activations (np.float16 matches the stick, np.float32 is faster
+    on most CPUs).
+
+    Usage:
+
+        backend = NumpyBackend.from_checkpoint("tmp/model.ckpt")
+        backend.save("model.npz")
+        outputs = NumpyBackend.load("model.npz", dtype=np.float16).infer(inputs)
+    """
+    PARAMETERS = ("weights_layer1", "bias_layer1", "weights_layer2", "bias_layer2")
+
+    def __init__(self, weights_layer1, bias_layer1, weights_layer2, bias_layer2, dtype=np.float32):
+        self.dtype = np.dtype(dtype)
+        self.weights_layer1 = np.asarray(weights_layer1, dtype=self.dtype)
+        self.bias_layer1 = np.asarray(bias_layer1, dtype=self.dtype)
+        self.weights_layer2 = np.asarray(weights_layer2, dtype=self.dtype)
+        self.bias_layer2 = np.asarray(bias_layer2, dtype=self.dtype)
+
+    @property
+    def input_size(self):
+        return self.weights_layer1.shape[0]
+
+    @property
+    def output_size(self):
+        return self.weights_layer2.shape[1]
+
+    def infer(self, batch):
+        x = np.asarray(batch, dtype=self.dtype).reshape((-1, self.input_size))
+        hidden = x @ self.weights_layer1
+        hidden += self.bias_layer1
+        np.tanh(hidden, out=hidden)
+        output = hidden @ self.weights_layer2
+        output += self.bias_layer2
+        return np.tanh(output, out=output)
+
+    @classmethod
+    def from_checkpoint(cls, path, dtype=np.float32):
+        """ Load the weights from a tensorflow checkpoint (requires tensorflow) """
+        import tensorflow as tf
+        reader = tf.train.load_checkpoint(path)
+        return cls(*(reader.get_tensor(name) for name in cls.PARAMETERS), dtype=dtype)
+
+    def save(self, path):
+        """ Export the weights to a compact .npz file (loads without tensorflow) """
+        np.savez(path, **{name: getattr(self, name) for name in self.PARAMETERS})
+
+    @classmethod
+    def load(cls, path, dtype=np.float32):
+        f = np.load(path)
+        return cls(*(f[name] for name in cls.PARAMETERS), dtype=dtype)
+
+
+class NCSBackend(InferenceBackend):
+    """ The compiled graph on the compute stick (or a SimulatedGraph)
+
+    The stick evaluates one input at a time; the rows of a batch are pipelined
+    through a PipelinedRunner (see there for the latency statistics).
+    """
+
+    def __init__(self, graph, depth=2, input_shape=None):
+        self.graph = graph
+        self.runner = PipelinedRunner(graph, depth)
+        self.input_shape = input_shape
+
+    def infer(self, batch):
+        batch = np.asarray(batch, dtype=np.float16)
+        if self.input_shape is not None:
+            batch = batch.reshape((-1,) + tuple(self.input_shape))
+        outputs = [None] * len(batch)
+        for output, i, _ in self.runner.run(batch):
+            outputs[i] = np.ravel(output)
+        return np.array(outputs)
+
+    def close(self):
+        self.graph.DeallocateGraph()
+
+
+def benchmark(backend, inputs, batch_size=None, repeat=10):
+    """ Throughput (inferences/s) & latency (ms per batch) of `backend` on identical `inputs`,
+    evaluated in batches of `batch_size` (default: all at once) """
+    batch_size = batch_size or len(inputs)
+    latencies = []
+    for _ in range(repeat):
+        for start in range(0, len(inputs), batch_size):
+            t0 = time.perf_counter()
+            backend.infer(inputs[start:start+batch_size])
+            latencies.append(time.perf_counter() - t0)
+    latencies = np.array(latencies) * 1e3
+    return {
+        "inferences": repeat * len(inputs),
+        "batch_size": batch_size,
+        "throughput": repeat * len(inputs) / latencies.sum() * 1e3,
+        "mean_latency": latencies.mean(),
+        "p95_latency": np.percentile(latencies, 95)}
@@ -1,14 +1,28 @@
 # small example that (hopefully) runs a graph on the compute stick
+# (pass --simulate to run it against an in-process stand-in, --cpu to evaluate the weights with numpy)
 
+import os
 import sys
 import numpy as np
 
-from mvnc import mvncapi as mvnc
+from inference import NCSBackend, NumpyBackend, benchmark, simulated_mvnc
+
+if "--simulate" in sys.argv:
+    mvnc = simulated_mvnc
+elif "--cpu" not in sys.argv:
+    from mvnc import mvncapi as mvnc
 
 # params
 N_CHANNELS = 1
 N_WINDOWWIDTH = 1
 T_TIMESTEPS = 100
+# number of tensors queued on the stick at once (1 = wait for each result before loading the next)
+PIPELINE_DEPTH = 2
+# inputs evaluated per call of the backend when measuring throughput & latency
+BATCH_SIZE = T_TIMESTEPS
+# trained model (see ncs_minimal_example.ipynb) & its compact export for --cpu
+CHECKPOINT = "tmp/model.ckpt"
+MODEL_FILE = "model.npz"
 
 def random_data():
     """ Generate random input with some non-linear transform as the
@@ -19,45 +33,52 @@ def random_data():
 
     return input_.astype(np.float32), output.astype(np.float32)
 
-def eval_on_usb(input_, graph):
-    """ Load input onto the USB-Device graph and evaluate.
+if "--cpu" in sys.argv:
+    # evaluate the exported weights on the host instead (see inference.NumpyBackend.save)
+    backend = NumpyBackend.load(MODEL_FILE) if os.path.exists(MODEL_FILE) else NumpyBackend.from_checkpoint(CHECKPOINT)
+else:
+    """
+    mvnc.EnumerateDevices() returns a list of usb devices with
+    the Intel(r) Movidius Neural Compute Stick as the first element
     """
-    graph.LoadTensor(input_, 'user object')
-    output, _ = graph.GetResult()
-    return output
-
-"""
-mvnc.EnumerateDevices() returns a list of usb devices with
-the Intel(r) Movidius Neural Compute Stick as the first element
-"""
-devices = mvnc.EnumerateDevices()
-if len(devices) == 0:
-    print('No devices found')
-    sys.exit()
-
-# Open the first neural compute stick device
-device = mvnc.Device(devices[0])
-device.OpenDevice()
-
-# The graphfile contains the tensorflow graph compiled for the NCS
-# via mvNCCompile
-with open('graph', 'rb') as f:
-    graphfile = f.read()
-
-# Load the graph on the USB-Device
-graph = device.AllocateGraph(graphfile)
-
-# get T_TIMESTEPS examples.
+    devices = mvnc.EnumerateDevices()
+    if len(devices) == 0:
+        print('No devices found')
+        sys.exit()
+
+    # Open the first neural compute stick device
+    device = mvnc.Device(devices[0])
+    device.OpenDevice()
+
+    # The graphfile contains the tensorflow graph compiled for the NCS
+    # via mvNCCompile
+    if mvnc is simulated_mvnc:
+        graphfile = None
+    else:
+        with open('graph', 'rb') as f:
+            graphfile = f.read()
+
+    # Load the graph on the USB-Device; PIPELINE_DEPTH timesteps are kept in flight
+    graph = device.AllocateGraph(graphfile)
+    backend = NCSBackend(graph, depth=PIPELINE_DEPTH, input_shape=(N_CHANNELS, N_WINDOWWIDTH))
+
+# get T_TIMESTEPS examples, one (N_CHANNELS, N_WINDOWWIDTH) input per timestep
 inp_, target = random_data()
+inputs = np.moveaxis(inp_, 2, 0)
 
-print("Eval on the NCS...")
+print("Eval on {}...".format("the CPU" if isinstance(backend, NumpyBackend) else "the NCS"))
 
+yhat = backend.infer(inputs)
 err = 0
 for t in range(T_TIMESTEPS):
-    yhat = eval_on_usb(inp_[:,:,t], graph)
-    print("Input: {} \t \t Target: {} \t \t Result: {}".format(inp_[:,:,t], target[:,:,t], yhat))
-    err += (yhat - target[:,:,t]) ** 2
+    print("Input: {} \t \t Target: {} \t \t Result: {}".format(inp_[:,:,t], target[:,:,t], yhat[t]))
+    err += (yhat[t] - target[:,:,t]) ** 2
 
 RMSE = np.sqrt( 1/T_TIMESTEPS * err )
 print("Average RMSE: {}".format(RMSE))
+stats = benchmark(backend, inputs, batch_size=BATCH_SIZE)
+print("Throughput: {throughput:.1f} inferences/s, latency: {mean_latency:.2f}ms mean, {p95_latency:.2f}ms 95th percentile per batch of {batch_size}".format(**stats))
 
+backend.close()
+if not isinstance(backend, NumpyBackend):
+    device.CloseDevice()